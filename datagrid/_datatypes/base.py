@@ -77,7 +77,7 @@ class Asset:
         return self.asset_id
 
     @classmethod
-    def get_statistics(cls, datagrid, column_name, field_name):
+    def get_statistics(cls, datagrid, column_name, field_name, first_row_id=None):
         pass
 
     @classmethod
@@ -11,6 +11,7 @@
 #    All rights reserved                             #
 ######################################################
 
+import concurrent.futures
 import csv
 import io
 import json
@@ -28,7 +29,9 @@ from ..utils import (
     ProgressBar,
 )
 from .base import Asset
+from .embedding import delete_nearest_index, delete_projectors, nearest
 from .serialize import ASSET_TYPE_MAP, DATAGRID_TYPES
+from .sketches import HyperLogLog, QuantileSketch
 from .utils import (
     RESERVED_NAMES,
     _verify_box,
@@ -38,11 +41,13 @@ from .utils import (
     convert_to_type,
     convert_to_value,
     create_columns,
+    create_table_index,
     download_filename,
     expand_mask,
     get_annotations_from_layers,
     get_labels_from_annotations,
     get_mask_from_annotations,
+    has_table,
     is_null,
     make_dict_factory,
     python_to_markdown,
@@ -85,6 +90,24 @@ def _createAssetEncoder(datagrid):
     return AssetEncoder
 
 
+def _generate_asset_thumbnail(asset_type, asset_data, metadata):
+    """
+    Generate an asset's thumbnail; run in a worker process.
+    """
+    return ASSET_TYPE_MAP[asset_type.lower()].generate_thumbnail(asset_data, metadata)
+
+
+def _merge_extreme(function, value1, value2):
+    """
+    Apply min or max to two values, either of which may be None.
+    """
+    if value1 is None:
+        return value2
+    elif value2 is None:
+        return value1
+    return function(value1, value2)
+
+
 def _convert_with_assets_to_json(metadata, datagrid):
     """
     Go through metadata, convert to JSON, logging
@@ -117,6 +140,12 @@ class _DataGrid:
     MAX_COLS = 101
     MAX_COL_NAME_LENGTH = 50
     MAX_COL_STRING_LENGTH = 10000
+    # Rows written per executemany(), when loading:
+    BULK_CHUNK_SIZE = 10000
+    # Bytes of pending asset data before they are written:
+    BULK_ASSET_BYTES = 64 * 1024 * 1024
+    # Rows of each JSON column sampled for completions:
+    COMPLETIONS_SAMPLE_SIZE = 1000
 
     def __init__(
         self,
@@ -776,8 +805,8 @@ class _DataGrid:
                     new_image = Image(image)
                     bitmap1 = expand_mask(mask1, label)
                     bitmap2 = expand_mask(mask2, label)
-                    intersection = sum(bitmap1 & bitmap2)
-                    union = sum(bitmap1 | bitmap2)
+                    intersection = np.count_nonzero(bitmap1 & bitmap2)
+                    union = np.count_nonzero(bitmap1 | bitmap2)
                     layer1_mask = (bitmap1 & np.logical_not(bitmap2)) * 1
                     layer2_mask = (bitmap2 & np.logical_not(bitmap1)) * 2
                     both_mask = (bitmap1 & bitmap2) * 3
@@ -802,6 +831,20 @@ class _DataGrid:
         Remove any assets that don't have a reference to them
         from the datagrid table.
         """
+        if self._delete_unused_assets() > 0:
+            schema = self.get_schema()
+            self._compute_stats(
+                [
+                    column_name
+                    for column_name in schema
+                    if schema[column_name]["type"].endswith("-ASSET")
+                ]
+            )
+
+    def _delete_unused_assets(self):
+        """
+        Delete the unused assets, and return how many were deleted.
+        """
         # First, get all columns that are -ASSET
         schema = self.get_schema()
         columns = [
@@ -810,7 +853,7 @@ class _DataGrid:
             if column["type"].endswith("-ASSET")
         ]
         if len(columns) == 0:
-            return
+            return 0
         # Delete any asset that is not used
         cursor = self.conn.cursor()
         cursor.execute(
@@ -821,10 +864,17 @@ class _DataGrid:
             )
         )
         result = cursor.rowcount
+        for table_name in ["vectors", "projections", "nearest_lists"]:
+            if has_table(self.conn, table_name):
+                cursor.execute(
+                    "DELETE FROM {table_name} WHERE asset_id NOT IN (SELECT asset_id FROM assets);".format(
+                        table_name=table_name
+                    )
+                )
         self.conn.commit()
         if result > 0:
             print("Deleted %s unused assets" % result)
-            self._compute_stats()
+        return result
 
     def remove_select(
         self,
@@ -878,7 +928,9 @@ class _DataGrid:
                 self.conn.execute("""VACUUM""")
                 self.conn.execute("""UPDATE datagrid SET column_0 = rowid""")
                 self.conn.commit()
-                self.remove_unused_assets()
+                self._delete_unused_assets()
+                # Removed rows can't be taken out of the running stats:
+                self.recompute_stats()
         else:
             raise Exception("unable to delete rows from in-memory data")
 
@@ -934,9 +986,11 @@ class _DataGrid:
                     )
                     cursor.execute(delete_column_sql)
                     self.conn.commit()
-            # 3. re-create the schema, drops all metadata/stats
-            self._create_schema(self._columns)
-            self._compute_stats()
+            delete_projectors(self.conn, column_names)
+            delete_nearest_index(self.conn, column_names)
+            # 3. re-create the schema, keeping the stats of unchanged columns
+            missing = self._create_schema(self._columns, keep_stats=True)
+            self._compute_stats(missing)
         else:
             raise Exception("unable to delete column from in-memory data")
 
@@ -1087,10 +1141,17 @@ class _DataGrid:
         else:
             raise Exception("an in-memory DataGrid doesn't have assets; save first")
 
-    def extend(self, rows, verify=True):
+    def extend(self, rows, verify=True, workers=None):
         """
         Extend the datagrid with the given rows.
 
+        Args:
+            rows: (list) the rows, as lists or dicts
+            verify: (optional, bool) if True, check each row
+            workers: (optional, int) the number of processes
+                used to create thumbnails, if create_thumbnails
+                is set. Rows are still written in order.
+
         Example:
         ```python
         >>> dg.extend([
@@ -1125,34 +1186,77 @@ class _DataGrid:
             field_name_map = {
                 column_name: schema[column_name]["field_name"] for column_name in schema
             }
-            index = self.nrows + 1
+            field_names = list(field_name_map.values())
+            insert_sql = "INSERT INTO datagrid (%s) VALUES (%s)" % (
+                ", ".join(field_names),
+                ", ".join(["?"] * len(field_names)),
+            )
+            index = first_row_id = self.nrows + 1
             # Get datagrid ready to append:
             self._asset_id_cache = set(self.get_asset_ids())
+            self._asset_rows = []
+            self._vector_rows = []
+            self._asset_rows_size = 0
+            if workers and workers > 1 and self.create_thumbnails:
+                self._thumbnail_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers
+                )
+            else:
+                self._thumbnail_pool = None
             self.cursor = self.conn.cursor()
+            self._begin_bulk_load()
             print("Extending data...")
-            for row in ProgressBar(rows):
-                if not isinstance(row, (dict,)):
-                    row_dict = {
-                        column_name: value
-                        for column_name, value in zip(self.get_columns(), row)
-                    }
-                else:
-                    row_dict = {
-                        column_name: value for column_name, value in row.items()
-                    }
-                if verify:
-                    # verify each and every row
-                    self._convert_values_row_dict(row_dict)
-                    column_types = self._verify_row_dict(row_dict)
-                    self._check_column_types(column_types)
-
-                self._append_row_dict_to_db(index, row_dict, field_name_map)
-                index += 1
-            self.conn.commit()
-            self._asset_id_cache = None
-
-            # Deletes and recomputes metadata:
-            self._compute_stats()
+            try:
+                chunk = []
+                for row in ProgressBar(rows):
+                    if not isinstance(row, (dict,)):
+                        row_dict = {
+                            column_name: value
+                            for column_name, value in zip(self.get_columns(), row)
+                        }
+                    else:
+                        row_dict = {
+                            column_name: value for column_name, value in row.items()
+                        }
+                    if verify:
+                        # verify each and every row
+                        self._convert_values_row_dict(row_dict)
+                        column_types = self._verify_row_dict(row_dict)
+                        self._check_column_types(column_types)
+
+                    chunk.append(
+                        self._row_dict_to_db_values(
+                            index, row_dict, field_name_map, field_names
+                        )
+                    )
+                    index += 1
+                    if len(chunk) >= self.BULK_CHUNK_SIZE:
+                        self._flush_assets()
+                        self.cursor.executemany(insert_sql, chunk)
+                        chunk = []
+
+                self._flush_assets()
+                if chunk:
+                    self.cursor.executemany(insert_sql, chunk)
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self._end_bulk_load()
+                if self._thumbnail_pool is not None:
+                    # Any thumbnails still pending weren't needed
+                    # (shutdown's cancel_futures is Python 3.9+):
+                    for asset_row in self._asset_rows:
+                        if isinstance(asset_row[4], concurrent.futures.Future):
+                            asset_row[4].cancel()
+                    self._thumbnail_pool.shutdown(wait=True)
+                    self._thumbnail_pool = None
+                self._asset_id_cache = None
+                self._asset_rows = None
+                self._vector_rows = None
+
+            # Merges the new rows into the stats:
+            self._compute_stats(first_row_id=first_row_id)
         else:
             ## Append to memory
             for row in rows:
@@ -1177,6 +1281,10 @@ class _DataGrid:
     def _append_col_to_db(self, column_name, rows, verify=True):
         # Get datagrid ready to append:
         self._asset_id_cache = set(self.get_asset_ids())
+        self._asset_rows = []
+        self._vector_rows = []
+        self._asset_rows_size = 0
+        self._thumbnail_pool = None
         self.cursor = self.conn.cursor()
 
         # 1. Add new columns for type inference:
@@ -1206,6 +1314,7 @@ class _DataGrid:
                 item, column_name, row_id=index + 1
             )
             data.append(row_dict)
+        self._flush_assets()
 
         # 3. Final type check for new columns (checks all):
         self._columns = {
@@ -1213,8 +1322,8 @@ class _DataGrid:
             for column_name, ctype in self._columns.items()
         }
 
-        # 4. re-create the schema; clears all metadata/stats
-        self._create_schema(self._columns)
+        # 4. re-create the schema, keeping the stats of unchanged columns
+        missing = self._create_schema(self._columns, keep_stats=True)
 
         # 5. create a temp in-memory table with data
         new_columns = {}  # DG type
@@ -1240,21 +1349,34 @@ class _DataGrid:
         self.conn.commit()
 
         # 6. copy the data into datagrid
-        for index, row in enumerate(data, start=1):
+        self._begin_bulk_load()
+        try:
             for column_name, field_name in zip(new_columns, field_names):
-                field_value = row.get(column_name)
                 sql_update = "UPDATE datagrid SET %s = ? where column_0 = ?" % (
                     field_name,
                 )
-                cursor.execute(sql_update, [field_value, index])
-        self.conn.commit()
+                cursor.executemany(
+                    sql_update,
+                    [
+                        [row.get(column_name), index]
+                        for index, row in enumerate(data, start=1)
+                    ],
+                )
+        finally:
+            self._end_bulk_load()
 
         self._asset_id_cache = None
+        self._asset_rows = None
+        self._vector_rows = None
 
         # Update and clear cache:
-        self._compute_stats()
+        self._compute_stats(missing)
 
-    def _append_row_dict_to_db(self, index, row_dict, field_name_map):
+    def _row_dict_to_db_values(self, index, row_dict, field_name_map, field_names):
+        """
+        Log the row's assets, and return its values in
+        field_names order, for an INSERT.
+        """
         # Only for user-suppplied columns; collects column names
         # as a side efect, it logs the assets!
         new_columns = {}
@@ -1276,17 +1398,61 @@ class _DataGrid:
         # Add row-id:
         row_dict["row-id"] = index
 
-        # SQL insert as a dict:
         field_dict = {
             field_name_map[column_name]: value
             for column_name, value in row_dict.items()
         }
-        field_names = ", ".join(field_dict.keys())
-        value_names = ", ".join([":" + field_name for field_name in field_dict])
-        self.cursor.execute(
-            "INSERT INTO datagrid (%s) VALUES (%s)" % (field_names, value_names),
-            field_dict,
-        )
+        return [field_dict.get(field_name) for field_name in field_names]
+
+    def _begin_bulk_load(self):
+        """
+        Write with a write-ahead log, and without syncing, until
+        _end_bulk_load().
+        """
+        self.conn.commit()
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("PRAGMA synchronous=OFF;")
+        except sqlite3.OperationalError as exc:
+            LOGGER.debug("unable to start bulk load: %s", exc)
+
+    def _end_bulk_load(self):
+        """
+        Commit the load, and return to a fully-synced, single
+        file database.
+        """
+        self.conn.commit()
+        try:
+            self.conn.execute("PRAGMA synchronous=FULL;")
+            self.conn.execute("PRAGMA journal_mode=DELETE;")
+        except sqlite3.OperationalError as exc:
+            LOGGER.debug("unable to end bulk load: %s", exc)
+
+    def _flush_assets(self):
+        """
+        Write the pending assets from _log() to the database,
+        in order, waiting for any thumbnails being generated.
+        """
+        for asset_row in self._asset_rows:
+            if isinstance(asset_row[4], concurrent.futures.Future):
+                asset_row[4] = asset_row[4].result()
+
+        if self._asset_rows:
+            self.cursor.executemany(
+                "INSERT INTO assets (asset_id, asset_type, asset_data, asset_metadata, asset_thumbnail) VALUES (?, ?, ?, ?, ?);",
+                self._asset_rows,
+            )
+        if self._vector_rows:
+            self.cursor.execute(
+                "CREATE TABLE IF NOT EXISTS vectors (asset_id TEXT PRIMARY KEY, vector BLOB);"
+            )
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO vectors (asset_id, vector) VALUES (?, ?);",
+                self._vector_rows,
+            )
+        self._asset_rows = []
+        self._vector_rows = []
+        self._asset_rows_size = 0
 
     def get_schema(self):
         """
@@ -1657,7 +1823,7 @@ class _DataGrid:
                     for row in results
                 ]
 
-    def save(self, filename=None, create_thumbnails=None):
+    def save(self, filename=None, create_thumbnails=None, workers=None):
         """
         Create the SQLite database on disk.
 
@@ -1666,6 +1832,8 @@ class _DataGrid:
                 to save to
             create_thumbnails: (optional, bool) if True, then
                 create thumbnail images for assets
+            workers: (optional, int) the number of processes
+                used to create thumbnails
 
         Example:
         ```python
@@ -1748,6 +1916,12 @@ class _DataGrid:
         )
         self.conn.execute(drop_assets_sql)
         self.conn.execute(create_assets_sql)
+        self.conn.execute("DROP TABLE IF EXISTS vectors;")
+        self.conn.execute("DROP TABLE IF EXISTS projections;")
+        self.conn.execute("DROP TABLE IF EXISTS projectors;")
+        self.conn.execute("DROP TABLE IF EXISTS nearest_centroids;")
+        self.conn.execute("DROP TABLE IF EXISTS nearest_lists;")
+        self.conn.execute("DROP TABLE IF EXISTS metadata_sketches;")
         self._create_schema(new_columns)
         self._create_settings(
             heuristics=self.heuristics,
@@ -1757,7 +1931,8 @@ class _DataGrid:
         )
 
         self._on_disk = True
-        self.extend(self._data, verify=False)
+        self.extend(self._data, verify=False, workers=workers)
+        self._create_indexes()
         self.filename = filename
         self._data = []
         self._schema = None
@@ -1766,6 +1941,35 @@ class _DataGrid:
             column_name: schema[column_name]["type"] for column_name in schema
         }
 
+    def _create_indexes(self):
+        """
+        Create the indexes used by every row and asset lookup.
+        """
+        create_table_index(self.conn, "datagrid", "column_0")
+        create_table_index(self.conn, "assets", "asset_id")
+
+    def create_index(self, column_name):
+        """
+        Create an index on a column, to speed up sorting,
+        filtering, and grouping by it.
+
+        Args:
+            column_name: (str) the name of the column
+
+        Example:
+        ```python
+        >>> dg.create_index("Score")
+        ```
+        """
+        if not self._on_disk:
+            raise Exception("Unable to create_index before saving")
+
+        schema = self.get_schema()
+        if column_name not in schema:
+            raise Exception("no such column: %r" % column_name)
+
+        create_table_index(self.conn, "datagrid", schema[column_name]["field_name"])
+
     def _create_settings(self, **settings):
         drop_settings_sql = "DROP TABLE IF EXISTS settings;"
         create_settings_sql = """CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)"""
@@ -1855,28 +2059,176 @@ class _DataGrid:
 
         self.conn.row_factory = None
 
-    def _create_schema(self, new_columns):
+    def _create_schema(self, new_columns, keep_stats=False):
+        """
+        Create the metadata table for new_columns. If keep_stats,
+        the stats of unchanged columns are kept. Returns the names
+        of the columns that need their stats computed.
+        """
         drop_metadata_sql = "DROP TABLE IF EXISTS metadata;"
         create_metadata_sql = """CREATE TABLE IF NOT EXISTS metadata (name TEXT, field_name TEXT, type TEXT, minimum FLOAT, maximum FLOAT, average FLOAT, variance FLOAT, total FLOAT, stddev FLOAT, other JSON)"""
-        insert_metadata_sql = (
-            """INSERT INTO metadata (name, field_name, type) VALUES (?,?,?)"""
-        )
+        insert_metadata_sql = """INSERT INTO metadata (name, field_name, type, minimum, maximum, average, variance, total, stddev, other) VALUES (?,?,?,?,?,?,?,?,?,?)"""
+
+        old_stats = {}
+        if keep_stats:
+            for row in self.conn.execute(
+                "SELECT name, field_name, type, minimum, maximum, average, variance, total, stddev, other FROM metadata;"
+            ):
+                old_stats[tuple(row[:3])] = list(row[3:])
 
         self.conn.execute(drop_metadata_sql)
         self.conn.execute(create_metadata_sql)
 
         cursor = self.conn.cursor()
+        missing = []
         for i, (column_name, column_type) in enumerate(new_columns.items()):
             field_name = "column_%s" % i
-            cursor.execute(insert_metadata_sql, [column_name, field_name, column_type])
+            key = (column_name, field_name, column_type)
+            if key not in old_stats:
+                missing.append(column_name)
+            stats = old_stats.get(key, [None] * 7)
+            cursor.execute(insert_metadata_sql, list(key) + stats)
+
+        # The sketches of the running stats are kept with them:
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata_sketches (name TEXT PRIMARY KEY, state JSON);"
+        )
+        kept = [
+            column_name for column_name in new_columns if column_name not in missing
+        ]
+        cursor.execute(
+            "DELETE FROM metadata_sketches WHERE name NOT IN (%s);"
+            % ",".join(["?"] * len(kept)),
+            kept,
+        )
         self.conn.commit()
         self._schema = None
+        return missing
+
+    def recompute_stats(self):
+        """
+        Recompute the statistics of all columns, from all rows.
+
+        Statistics are otherwise updated from just the rows
+        added by extend(). Embedding projections are not fitted
+        again; see refit_projections().
+
+        Example:
+        ```python
+        >>> dg.recompute_stats()
+        ```
+        """
+        if not self._on_disk:
+            raise Exception("Unable to recompute_stats before saving")
+
+        self._compute_stats()
 
-    def _compute_stats(self, columns=None):
+    def nearest(self, asset_id, k=10, column_name=None):
         """
-        Compute the stats and metadata for all columns.
+        Find the embeddings nearest to an embedding, in its
+        column, with the nearest-neighbor index that is built
+        when the datagrid is saved.
+
+        Args:
+            asset_id: (str or Embedding) the embedding, or its asset_id
+            k: (optional, int) the number of embeddings to find
+            column_name: (optional, str) the embedding's column; only
+                needed if the embedding is in more than one column
+
+        Returns a list of (asset_id, distance), nearest first.
+
+        Example:
+        ```python
+        >>> dg.nearest(embedding.asset_id, 5)
+        [('2a4b...', 0.12), ('77fe...', 0.31), ...]
+        ```
+        """
+        if not self._on_disk:
+            raise Exception("Unable to find nearest before saving")
+
+        if isinstance(asset_id, Asset):
+            asset_id = asset_id.asset_id
+        return nearest(self.conn, asset_id, k, name=column_name)
+
+    def refit_projections(self, *column_names):
+        """
+        Fit the projections of embedding columns again, from all
+        of their rows. Otherwise, the projection fitted when the
+        column was first saved is used to project new rows.
+
+        Args:
+            column_names: names of embedding columns (default all)
+
+        Example:
+        ```python
+        >>> dg.refit_projections("Embedding")
+        ```
+        """
+        if not self._on_disk:
+            raise Exception("Unable to refit_projections before saving")
+
+        schema = self.get_schema()
+        if not column_names:
+            column_names = [
+                column_name
+                for column_name in schema
+                if schema[column_name]["type"] == "EMBEDDING-ASSET"
+            ]
+        for column_name in column_names:
+            if column_name not in schema:
+                raise Exception("no such column: %r" % column_name)
+
+        delete_projectors(self.conn, column_names)
+        self._compute_stats(column_names)
+
+    def _get_running_stats(self, columns):
+        """
+        Get the stored stats that can be merged with those of
+        new rows. Returns a dict mapping column name to
+        (minimum, maximum, total, other), or None if any
+        column doesn't have them. The sketches of a column are
+        in other["running"].
+        """
+        sketches = {}
+        if has_table(self.conn, "metadata_sketches"):
+            for name, state in self.conn.execute(
+                "SELECT name, state FROM metadata_sketches;"
+            ):
+                sketches[name] = json.loads(state)
+
+        stats = {}
+        for name, minimum, maximum, total, other in self.conn.execute(
+            "SELECT name, minimum, maximum, total, other FROM metadata;"
+        ):
+            if name in columns:
+                other = json.loads(other or "null")
+                if other is not None and name in sketches:
+                    other["running"] = sketches[name]
+                stats[name] = (minimum, maximum, total, other)
+
+        for col_name in columns:
+            col_type = columns[col_name]["type"]
+            other = stats.get(col_name, (None, None, None, None))[3]
+            if col_type in ["FLOAT", "INTEGER", "ROW_ID"]:
+                if not other or "quantiles" not in other.get("running", {}):
+                    return None
+            elif col_type == "TEXT":
+                if not other or "running" not in other:
+                    return None
+            elif col_type in ["JSON", "DATETIME"]:
+                if not other or "count" not in other:
+                    return None
+        return stats
+
+    def _compute_stats(self, columns=None, first_row_id=None):
+        """
+        Compute the stats and metadata for columns (default all).
+
+        If first_row_id is given, only the rows from it on are
+        scanned, and merged into the stored running stats.
         """
         insert_metadata_sql = """UPDATE metadata SET minimum = ?, maximum = ?, average = ?, variance = ?, total = ?, stddev= ? , other = ? WHERE name = ?;"""
+        insert_sketches_sql = """INSERT OR REPLACE INTO metadata_sketches (name, state) VALUES (?, ?);"""
 
         if columns is not None:
             schema = self.get_schema()
@@ -1884,36 +2236,135 @@ class _DataGrid:
         else:
             columns = self.get_schema()
 
+        previous = None
+        if first_row_id is not None:
+            previous = self._get_running_stats(columns)
+        if previous is None:
+            # Compute from all of the rows:
+            first_row_id = 0
+
+        # The aggregates of all columns are computed in a single pass:
+        aggregates = {}
+        parameters = []
+        for col_name in columns:
+            col_type = columns[col_name]["type"]
+            field_name = columns[col_name]["field_name"]
+            if col_type in ["FLOAT", "INTEGER", "ROW_ID"]:
+                # Sums are shifted by a value of the column, so that
+                # the variance from them is numerically stable:
+                shift = "COALESCE(?, (SELECT CAST({field_name} AS REAL) FROM datagrid WHERE {field_name} IS NOT NULL AND column_0 >= ? LIMIT 1))".format(
+                    field_name=field_name
+                )
+                shifted = "(CAST(%s AS REAL) - %s)" % (field_name, shift)
+                shift_value = None
+                if previous:
+                    shift_value = previous[col_name][3]["running"]["shift"]
+                aggregates[col_name] = [
+                    "MIN(%s)" % field_name,
+                    "MAX(%s)" % field_name,
+                    "TOTAL(%s)" % field_name,
+                    "COUNT(%s)" % field_name,
+                    shift,
+                    "TOTAL(%s)" % shifted,
+                    "TOTAL(%s * %s)" % (shifted, shifted),
+                ]
+                parameters.extend([shift_value, first_row_id] * 4)
+            elif col_type == "JSON":
+                aggregates[col_name] = ["COUNT(%s)" % field_name]
+            elif col_type == "DATETIME":
+                aggregates[col_name] = [
+                    "MIN(%s)" % field_name,
+                    "MAX(%s)" % field_name,
+                    "TOTAL(%s)" % field_name,
+                    "COUNT(%s)" % field_name,
+                ]
+            elif col_type == "TEXT":
+                aggregates[col_name] = ["COUNT(%s)" % field_name]
+
+        results = {}
+        if aggregates:
+            row = self.conn.execute(
+                "SELECT %s from datagrid WHERE column_0 >= ?;"
+                % ", ".join(
+                    [
+                        aggregate
+                        for col_aggregates in aggregates.values()
+                        for aggregate in col_aggregates
+                    ]
+                ),
+                parameters + [first_row_id],
+            ).fetchone()
+            position = 0
+            for col_name, col_aggregates in aggregates.items():
+                results[col_name] = row[position : position + len(col_aggregates)]
+                position += len(col_aggregates)
+
+        # Distinct counts and quantiles are estimated from sketches:
+        distinct, quantiles = self._sketch_values(columns, first_row_id, previous)
+
         data = []
+        sketches = []
         print("Computing statistics...")
         for col_name in ProgressBar(columns):
             col_type = columns[col_name]["type"]
             field_name = columns[col_name]["field_name"]
             if col_type in ["FLOAT", "INTEGER", "ROW_ID"]:
-                row = self.conn.execute(
-                    """SELECT MIN({field_name}),
-                              MAX({field_name}),
-                              AVG({field_name}),
-                              TOTAL({field_name}),
-                              COUNT({field_name}),
-                              COUNT(DISTINCT {field_name}) from datagrid;""".format(
-                        field_name=field_name
-                    )
-                ).fetchone()
-                minimum, maximum, avg, total, count, count_unique = row
-
-                other = json.dumps({"count": count, "count_unique": count_unique})
-                ## FIXME: somebody check my math:
-                deviations = []
-                for row in self.conn.execute(
-                    """SELECT {field_name} from datagrid;""".format(
-                        field_name=field_name
+                (
+                    minimum,
+                    maximum,
+                    total,
+                    count,
+                    shift,
+                    shifted_total,
+                    shifted_squares,
+                ) = results[col_name]
+
+                if previous:
+                    (
+                        previous_minimum,
+                        previous_maximum,
+                        previous_total,
+                        previous_other,
+                    ) = previous[col_name]
+                    running = previous_other["running"]
+                    minimum = _merge_extreme(min, previous_minimum, minimum)
+                    maximum = _merge_extreme(max, previous_maximum, maximum)
+                    total += previous_total or 0.0
+                    count += previous_other["count"]
+                    shifted_total += running["shifted_total"]
+                    shifted_squares += running["shifted_squares"]
+
+                avg = total / count if count > 0 else None
+                quartiles = quantiles[col_name].quantiles([0.25, 0.50, 0.75])
+                other = json.dumps(
+                    {
+                        "count": count,
+                        "count_unique": min(distinct[col_name].count(), count),
+                        "quantiles": {
+                            "25%": quartiles[0],
+                            "50%": quartiles[1],
+                            "75%": quartiles[2],
+                        },
+                    }
+                )
+                running = json.dumps(
+                    {
+                        "shift": shift,
+                        "shifted_total": shifted_total,
+                        "shifted_squares": shifted_squares,
+                        "distinct": distinct[col_name].to_json(),
+                        "quantiles": quantiles[col_name].to_json(),
+                    }
+                )
+                sketches.append([col_name, running])
+                if count > 0:
+                    variance = max(
+                        (shifted_squares - shifted_total * shifted_total / count)
+                        / count,
+                        0.0,
                     )
-                ):
-                    if not is_null(row[0]):
-                        deviations.append((row[0] - avg) ** 2)
-
-                variance = sum(deviations) / count if count > 0 else None
+                else:
+                    variance = None
                 if not is_null(variance):
                     stddev = math.sqrt(variance)
                     # min, max, avg, variance, total, stddev, other, name
@@ -1951,10 +2402,24 @@ class _DataGrid:
                 )
 
             elif col_type == "JSON":
+                # Completions come from a sample of the (new) rows:
+                (count,) = results[col_name]
+                stride = max(count // self.COMPLETIONS_SAMPLE_SIZE, 1)
                 rows = self.conn.execute(
-                    "SELECT {field_name} from datagrid;".format(field_name=field_name)
+                    "SELECT {field_name} from datagrid WHERE {field_name} IS NOT NULL AND column_0 >= ? AND column_0 % {stride} = 0 LIMIT {limit};".format(
+                        field_name=field_name,
+                        stride=stride,
+                        limit=self.COMPLETIONS_SAMPLE_SIZE,
+                    ),
+                    [first_row_id],
                 )
                 completions = defaultdict(set)
+                if previous:
+                    previous_other = previous[col_name][3]
+                    count += previous_other["count"]
+                    for key, value in previous_other["completions"].items():
+                        completions[key].update(value)
+
                 for row in rows:
                     # get key, type from all rows for fields
                     if row[0]:
@@ -1965,7 +2430,8 @@ class _DataGrid:
                     {
                         "completions": {
                             key: list(value) for key, value in completions.items()
-                        }
+                        },
+                        "count": count,
                     }
                 )
 
@@ -1984,46 +2450,55 @@ class _DataGrid:
                 )
 
             elif col_type == "DATETIME":
-                row = self.conn.execute(
-                    "SELECT MIN({field_name}), MAX({field_name}), TOTAL({field_name}) from datagrid;".format(
-                        field_name=field_name
-                    )
-                ).fetchone()
+                minimum, maximum, total, count = results[col_name]
+                if previous:
+                    (
+                        previous_minimum,
+                        previous_maximum,
+                        previous_total,
+                        previous_other,
+                    ) = previous[col_name]
+                    minimum = _merge_extreme(min, previous_minimum, minimum)
+                    maximum = _merge_extreme(max, previous_maximum, maximum)
+                    total += previous_total or 0.0
+                    count += previous_other["count"]
                 # min, max, avg, variance, total, stddev, other, name
                 data.append(
                     [
-                        row[0],
-                        row[1],
-                        None,
+                        minimum,
+                        maximum,
                         None,
-                        row[2],
                         None,
+                        total,
                         None,
+                        json.dumps({"count": count}),
                         col_name,
                     ]
                 )
             elif col_type.endswith("-ASSET"):
                 # min, max, avg, variance, total, stddev, other, name
                 stats = DATAGRID_TYPES[col_type]["get_statistics"](
-                    self, col_name, field_name
+                    self,
+                    col_name,
+                    field_name,
+                    first_row_id=first_row_id if previous else None,
                 )
                 if stats:
                     data.append(stats)
             else:
                 if col_type == "TEXT":
-                    row = self.conn.execute(
-                        """SELECT COUNT({field_name}), COUNT(DISTINCT {field_name}) from datagrid;""".format(
-                            field_name=field_name
-                        )
-                    ).fetchone()
-                    count, count_unique = row
+                    (count,) = results[col_name]
+                    if previous:
+                        count += previous[col_name][3]["count"]
                     other = json.dumps(
                         {
                             "completions": {"": ["str"]},
                             "count": count,
-                            "count_unique": count_unique,
+                            "count_unique": min(distinct[col_name].count(), count),
                         }
                     )
+                    running = json.dumps({"distinct": distinct[col_name].to_json()})
+                    sketches.append([col_name, running])
                 else:
                     other = None
                 # min, max, avg, variance, total, stddev, other, name
@@ -2043,8 +2518,55 @@ class _DataGrid:
         cursor = self.conn.cursor()
         for row in data:
             cursor.execute(insert_metadata_sql, row)
+        for row in sketches:
+            cursor.execute(insert_sketches_sql, row)
         self.conn.commit()
 
+    def _sketch_values(self, columns, first_row_id, previous):
+        """
+        Sketch the distinct values of the numeric and TEXT
+        columns, and the quantiles of the numeric columns, from
+        the rows from first_row_id on, merged into any previous
+        sketches. Returns two dicts mapping column name to
+        HyperLogLog, and to QuantileSketch.
+        """
+        distinct = {}
+        quantiles = {}
+        for col_name in columns:
+            col_type = columns[col_name]["type"]
+            if col_type in ["FLOAT", "INTEGER", "ROW_ID", "TEXT"]:
+                if previous:
+                    running = previous[col_name][3]["running"]
+                    distinct[col_name] = HyperLogLog.from_json(running["distinct"])
+                else:
+                    distinct[col_name] = HyperLogLog()
+            if col_type in ["FLOAT", "INTEGER", "ROW_ID"]:
+                if previous:
+                    quantiles[col_name] = QuantileSketch.from_json(
+                        running["quantiles"]
+                    )
+                else:
+                    quantiles[col_name] = QuantileSketch()
+
+        if not distinct:
+            return distinct, quantiles
+
+        cursor = self.conn.execute(
+            "SELECT %s FROM datagrid WHERE column_0 >= ?;"
+            % ", ".join(columns[col_name]["field_name"] for col_name in distinct),
+            [first_row_id],
+        )
+        while True:
+            rows = cursor.fetchmany(self.BULK_CHUNK_SIZE)
+            if not rows:
+                break
+            for col_name, values in zip(distinct, zip(*rows)):
+                distinct[col_name].update(values)
+                if col_name in quantiles:
+                    quantiles[col_name].update(values)
+
+        return distinct, quantiles
+
     def _log_and_serialize_data(self):
         """
         Log and serialize each row.
@@ -2083,9 +2605,10 @@ class _DataGrid:
         else:
             return None
 
-    def _log(self, asset_id, asset_type, asset_data, metadata, row_id):
+    def _log(self, asset_id, asset_type, asset_data, metadata, row_id, vector=None):
         """
         Log the asset. As a side-effect, possibly create a thumbnail.
+        If vector (bytes) is given, it is stored in the vectors table.
 
         NOTE: asset_thumbnail is:
             * bytes, if there is one
@@ -2098,16 +2621,30 @@ class _DataGrid:
             # Log to database
             # If we should make a thumbnail, do it
             if self.create_thumbnails and hasattr(ASSET_TYPE_MAP[asset_type.lower()], "generate_thumbnail"):
-                asset_thumbnail = ASSET_TYPE_MAP[asset_type.lower()].generate_thumbnail(
-                    asset_data, metadata
-                )
+                if self._thumbnail_pool is not None:
+                    # Resolved, in order, by _flush_assets():
+                    asset_thumbnail = self._thumbnail_pool.submit(
+                        _generate_asset_thumbnail, asset_type, asset_data, metadata
+                    )
+                else:
+                    asset_thumbnail = ASSET_TYPE_MAP[
+                        asset_type.lower()
+                    ].generate_thumbnail(asset_data, metadata)
             else:
                 asset_thumbnail = None  # means one hasn't been created yet
-            self.cursor.execute(
-                "INSERT INTO assets (asset_id, asset_type, asset_data, asset_metadata, asset_thumbnail) VALUES (?, ?, ?, ?, ?);",
-                [asset_id, asset_type, asset_data, json_string, asset_thumbnail],
+            # Written in batches by _flush_assets():
+            self._asset_rows.append(
+                [asset_id, asset_type, asset_data, json_string, asset_thumbnail]
             )
+            self._asset_rows_size += len(asset_data or "")
+            if vector is not None:
+                self._vector_rows.append([asset_id, vector])
+                self._asset_rows_size += len(vector)
+            if isinstance(asset_thumbnail, (str, bytes)):
+                self._asset_rows_size += len(asset_thumbnail)
             self._asset_id_cache.add(asset_id)
+            if self._asset_rows_size >= self.BULK_ASSET_BYTES:
+                self._flush_assets()
 
     def upgrade(self):
         """
@@ -2123,7 +2660,8 @@ class _DataGrid:
                 self._upgrade_table(
                     "column_0", schema[column_name]["field_name"], "datagrid"
                 )
-        self._compute_stats()
+        self._create_indexes()
+        self.recompute_stats()
 
     def _upgrade_table(self, column_id_name, column_metadata_name, table_name):
         """
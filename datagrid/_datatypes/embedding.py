@@ -12,34 +12,546 @@
 ######################################################
 
 import json
+import math
 import random
-import time
+
+import numpy as np
 
 from ..server.utils import Cache
 from .base import Asset
-from .utils import get_color, get_file_extension, is_valid_file_path
+from .utils import get_color, get_file_extension, has_table, is_valid_file_path
 
 PROJECTION_DIMENSIONS = 50
+# So that the same dimensions are sampled each time:
+PROJECTION_SEED = 0
+# Embeddings are read and projected in chunks of this many:
+PROJECTION_CHUNK_SIZE = 10000
+# PCA of more embeddings than this is fitted in chunks, with
+# IncrementalPCA, rather than all in memory:
+PROJECTION_MEMORY_ROWS = 100000
+# The nearest-neighbor index has about sqrt(n) lists, with
+# centroids trained (k-means) on a sample of this many:
+NEAREST_INDEX_SAMPLE = 20000
+NEAREST_INDEX_ITERATIONS = 10
+# The number of lists searched by nearest():
+NEAREST_PROBES = 8
+# Vectors are stored as little-endian float32:
+VECTOR_DTYPE = "<f4"
 
 SAMPLE_CACHE = Cache(100)
 
 
-def prepare_embedding(embedding, dimensions, seed):
-    if len(embedding) <= dimensions:
-        return embedding
+def vector_to_blob(vector):
+    """
+    Encode a vector as bytes, for the vectors table.
+    """
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def blob_to_vector(blob):
+    """
+    Decode a vector from the vectors table, without copying.
+    """
+    return np.frombuffer(blob, dtype=VECTOR_DTYPE)
+
+
+def sample_dimensions(length, dimensions, seed):
+    """
+    Pick dimensions of the length indices at random, in
+    order. Returns None if there is no need to sample.
+    """
+    if length <= dimensions:
+        return None
 
-    key = (seed, dimensions)
-    if not SAMPLE_CACHE.contains(key):
+    key = (seed, length, dimensions)
+    indices = SAMPLE_CACHE.get(key, None)
+    if indices is None:
         random.seed(seed)
-        indices = list(range(len(embedding)))
+        indices = list(range(length))
         random.shuffle(indices)
-        SAMPLE_CACHE.put(key, set(indices[:dimensions]))
+        indices = np.array(sorted(indices[:dimensions]))
+        SAMPLE_CACHE.put(key, indices)
+    return indices
+
+
+def prepare_embedding(embedding, dimensions, seed):
+    indices = sample_dimensions(len(embedding), dimensions, seed)
+    if indices is None:
+        return embedding
+    return np.asarray(embedding)[indices]
+
+
+class Projector:
+    """
+    A fitted projection of embedding vectors to 2D, which can be
+    saved in the datagrid and used to project new vectors.
+    """
+
+    def __init__(self, projection, indices=None, scale=None, pca=None, model=None):
+        if projection not in ["pca", "t-sne", "umap"]:
+            raise Exception("projection not found: %r" % projection)
+        self.projection = projection
+        # The sampled dimensions, if any:
+        self.indices = indices
+        # The (scale, min) of a MinMaxScaler, if any:
+        self.scale = scale
+        # The (mean, components, explained_variance, whiten) of PCA:
+        self.pca = pca
+        # A fitted UMAP (not saved; see can_save()):
+        self.model = model
+        # [x_min, x_max, y_min, y_max] of the included projections:
+        self.bounds = None
+
+    def can_transform(self):
+        """
+        Can the projector project new vectors? (t-SNE can't.)
+        """
+        return self.projection != "t-sne"
+
+    def can_save(self):
+        """
+        Can the projector be saved in the datagrid? PCA is saved
+        as plain arrays; a fitted UMAP would have to be pickled,
+        which isn't safe to load from a shared datagrid, so it is
+        fitted again instead.
+        """
+        return self.projection == "pca"
+
+    def _prepare(self, vectors):
+        if self.indices is not None:
+            vectors = vectors[:, self.indices]
+        if self.scale is not None:
+            vectors = vectors * self.scale[0] + self.scale[1]
+        return vectors
+
+    def _fit_prepare(self, vectors, dimensions, scaler=None):
+        """
+        Sample the dimensions (the first time), and scale the
+        vectors with the scaler, if any.
+        """
+        if self.indices is None:
+            self.indices = sample_dimensions(
+                vectors.shape[1], dimensions, PROJECTION_SEED
+            )
+        if self.indices is not None:
+            vectors = vectors[:, self.indices]
+        if scaler is not None:
+            vectors = scaler.transform(vectors)
+        return vectors
+
+    def _fit_scaler(self, scaler):
+        if scaler is not None:
+            self.scale = (scaler.scale_, scaler.min_)
+
+    def fit(self, vectors, dimensions, scale, kwargs):
+        """
+        Fit the projector to vectors, all in memory.
+        """
+        scaler = None
+        if scale:
+            from sklearn.preprocessing import MinMaxScaler
+
+            scaler = MinMaxScaler().fit(self._fit_prepare(vectors, dimensions))
+        vectors = self._fit_prepare(vectors, dimensions, scaler)
+        self._fit_scaler(scaler)
+
+        if self.projection == "pca":
+            from sklearn.decomposition import PCA
+
+            if "n_components" not in kwargs:
+                kwargs["n_components"] = 2
+
+            self._fit_pca(PCA(**kwargs).fit(vectors))
+
+        elif self.projection == "umap":
+            from umap import UMAP
+
+            self.model = UMAP(**kwargs).fit(vectors)
+
+    def fit_chunks(self, read_chunks, dimensions, scale, kwargs):
+        """
+        Fit a PCA projector with IncrementalPCA, one chunk of
+        vectors at a time. read_chunks() returns a new iterator
+        over the chunks, as it is called once per pass.
+        """
+        from sklearn.decomposition import IncrementalPCA
+
+        scaler = None
+        if scale:
+            from sklearn.preprocessing import MinMaxScaler
 
-    indices = SAMPLE_CACHE.get(key)
+            scaler = MinMaxScaler()
+            for vectors in read_chunks():
+                scaler.partial_fit(self._fit_prepare(vectors, dimensions))
 
-    return [v for i, v in enumerate(embedding) if i in indices]
+        model = IncrementalPCA(
+            **{
+                key: kwargs[key]
+                for key in ["n_components", "whiten", "batch_size"]
+                if key in kwargs
+            },
+        )
+        if model.n_components is None:
+            model.n_components = 2
+        # Each chunk needs at least n_components vectors:
+        pending = []
+        for vectors in read_chunks():
+            pending.append(self._fit_prepare(vectors, dimensions, scaler))
+            if sum(len(chunk) for chunk in pending) >= model.n_components:
+                model.partial_fit(np.concatenate(pending))
+                pending = []
+        if not hasattr(model, "components_"):
+            raise Exception("too few embeddings to fit the projection")
+
+        self._fit_scaler(scaler)
+        self._fit_pca(model)
+
+    def _fit_pca(self, model):
+        self.pca = (
+            model.mean_,
+            model.components_,
+            model.explained_variance_,
+            model.whiten,
+        )
 
-    SAMPLE_CACHE.get(key)
+    def fit_transform(self, vectors, included, dimensions, scale, kwargs):
+        """
+        Fit the projector to the included vectors, and return the
+        projections of all of them.
+        """
+        if self.projection == "t-sne":
+            from sklearn.manifold import TSNE
+
+            scaler = None
+            if scale:
+                from sklearn.preprocessing import MinMaxScaler
+
+                scaler = MinMaxScaler().fit(self._fit_prepare(vectors, dimensions))
+            # t-SNE can't handle rows where include=False
+            return TSNE(**kwargs).fit_transform(
+                self._fit_prepare(vectors, dimensions, scaler)
+            )
+
+        self.fit(vectors[included], dimensions, scale, kwargs)
+        return self.transform(vectors)
+
+    def transform(self, vectors):
+        """
+        Project vectors with the fitted projector.
+        """
+        return self._project(self._prepare(vectors))
+
+    def _project(self, vectors):
+        if self.projection == "pca":
+            mean, components, explained_variance, whiten = self.pca
+            transformed = (vectors - mean) @ components.T
+            if whiten:
+                transformed /= np.sqrt(explained_variance)
+            return transformed
+        else:
+            return self.model.transform(vectors)
+
+    def update_bounds(self, transformed):
+        """
+        Extend the bounds to include transformed.
+        """
+        if len(transformed) == 0:
+            return
+        bounds = [
+            float(transformed[:, 0].min()),
+            float(transformed[:, 0].max()),
+            float(transformed[:, 1].min()),
+            float(transformed[:, 1].max()),
+        ]
+        if self.bounds is not None:
+            bounds = [
+                min(bounds[0], self.bounds[0]),
+                max(bounds[1], self.bounds[1]),
+                min(bounds[2], self.bounds[2]),
+                max(bounds[3], self.bounds[3]),
+            ]
+        self.bounds = bounds
+
+    def get_ranges(self):
+        """
+        The x and y ranges of the bounds, with a margin.
+        """
+        x_min, x_max, y_min, y_max = self.bounds
+        x_span = abs(x_max - x_min)
+        y_span = abs(y_max - y_min)
+        return {
+            "x_range": [x_min - x_span * 0.1, x_max + x_span * 0.1],
+            "y_range": [y_min - y_span * 0.1, y_max + y_span * 0.1],
+        }
+
+    def to_json(self):
+        def tolist(array):
+            return np.asarray(array).tolist() if array is not None else None
+
+        return {
+            "projection": self.projection,
+            "indices": tolist(self.indices),
+            "scale": [tolist(array) for array in self.scale] if self.scale else None,
+            "pca": (
+                [tolist(array) for array in self.pca[:3]] + [bool(self.pca[3])]
+                if self.pca
+                else None
+            ),
+            "bounds": self.bounds,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        def toarray(values):
+            return np.array(values) if values is not None else None
+
+        projector = cls(
+            data["projection"],
+            indices=toarray(data["indices"]),
+            scale=(
+                [toarray(values) for values in data["scale"]] if data["scale"] else None
+            ),
+            pca=(
+                [toarray(values) for values in data["pca"][:3]] + [data["pca"][3]]
+                if data["pca"]
+                else None
+            ),
+        )
+        projector.bounds = data["bounds"]
+        return projector
+
+
+def read_vector_chunks(conn, field_name, first_row_id, included_only=False):
+    """
+    Read the embeddings of a column, from first_row_id on, in
+    chunks of (asset_ids, vectors, included).
+    """
+    if has_table(conn, "vectors"):
+        # asset_data is only needed for vectors stored as JSON:
+        sql = """SELECT {field_name} as assetId, json_extract(asset_metadata, '$.include'), vectors.vector, CASE WHEN vectors.vector IS NULL THEN asset_data END FROM datagrid JOIN assets ON assetId = assets.asset_id LEFT JOIN vectors ON vectors.asset_id = assetId WHERE column_0 >= ? AND asset_metadata != ''"""
+    else:
+        sql = """SELECT {field_name} as assetId, json_extract(asset_metadata, '$.include'), NULL, asset_data from datagrid JOIN assets ON assetId = assets.asset_id WHERE column_0 >= ? AND asset_metadata != ''"""
+    if included_only:
+        sql += " AND json_extract(asset_metadata, '$.include')"
+
+    cursor = conn.execute(sql.format(field_name=field_name), [first_row_id])
+    while True:
+        rows = cursor.fetchmany(PROJECTION_CHUNK_SIZE)
+        if not rows:
+            break
+        vectors = [
+            (
+                blob_to_vector(vector_blob)
+                if vector_blob is not None
+                else json.loads(asset_data_json)["vector"]
+            )
+            for asset_id, include, vector_blob, asset_data_json in rows
+        ]
+        yield (
+            [row[0] for row in rows],
+            np.array(vectors, dtype=np.float32),
+            np.array([bool(row[1]) for row in rows]),
+        )
+
+
+def write_projections(cursor, asset_ids, transformed):
+    """
+    Write the 2D projections of assets, in one batch.
+    """
+    cursor.executemany(
+        "INSERT OR REPLACE INTO projections (asset_id, x, y) VALUES (?, ?, ?);",
+        zip(asset_ids, transformed[:, 0].tolist(), transformed[:, 1].tolist()),
+    )
+
+
+def assign_lists(vectors, centroids):
+    """
+    Get the index of the nearest centroid of each vector.
+    """
+    # |v - c|^2 without the |v|^2 term, which is the same for all c:
+    distances = (centroids**2).sum(axis=1)[None, :] - 2 * (vectors @ centroids.T)
+    return distances.argmin(axis=1)
+
+
+def train_centroids(vectors, count):
+    """
+    Find count centroids of vectors with k-means.
+    """
+    rng = np.random.default_rng(PROJECTION_SEED)
+    centroids = vectors[rng.choice(len(vectors), count, replace=False)].copy()
+    for iteration in range(NEAREST_INDEX_ITERATIONS):
+        lists = assign_lists(vectors, centroids)
+        sums = np.zeros(centroids.shape, dtype=np.float64)
+        np.add.at(sums, lists, vectors)
+        counts = np.bincount(lists, minlength=count)
+        # Empty lists keep their centroid:
+        used = counts > 0
+        centroids[used] = sums[used] / counts[used, None]
+    return centroids
+
+
+def update_nearest_index(conn, name, field_name, first_row_id):
+    """
+    Update the nearest-neighbor index (an inverted file, IVF)
+    of an embedding column. The vectors of each asset are
+    assigned to the list of their nearest centroid. If
+    first_row_id is 0, the centroids are trained again;
+    otherwise, just the rows from first_row_id on are added.
+    """
+    if not has_table(conn, "vectors"):
+        # Vectors stored as JSON aren't indexed:
+        return
+
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS nearest_centroids (name TEXT PRIMARY KEY, centroids BLOB, dimensions INTEGER);"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS nearest_lists (name TEXT, asset_id TEXT, list INTEGER, PRIMARY KEY (name, asset_id));"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS nearest_lists_name_list_index ON nearest_lists (name, list);"
+    )
+
+    row = conn.execute(
+        "SELECT centroids, dimensions FROM nearest_centroids WHERE name = ?;", [name]
+    ).fetchone()
+    if row is None or first_row_id == 0:
+        (count,) = conn.execute(
+            """SELECT COUNT(*) FROM datagrid JOIN vectors ON {field_name} = vectors.asset_id;""".format(
+                field_name=field_name
+            )
+        ).fetchone()
+        if count == 0:
+            return
+        rng = np.random.default_rng(PROJECTION_SEED)
+        sample = np.concatenate(
+            [
+                chunk[1][rng.random(len(chunk[1])) < NEAREST_INDEX_SAMPLE / count]
+                for chunk in read_vector_chunks(conn, field_name, 0)
+            ]
+        )
+        if len(sample) == 0:
+            return
+        centroids = train_centroids(
+            sample, min(max(int(math.sqrt(count)), 1), len(sample))
+        )
+        conn.execute("DELETE FROM nearest_lists WHERE name = ?;", [name])
+        conn.execute(
+            "INSERT OR REPLACE INTO nearest_centroids (name, centroids, dimensions) VALUES (?, ?, ?);",
+            [name, vector_to_blob(centroids), centroids.shape[1]],
+        )
+        first_row_id = 0
+    else:
+        centroids = blob_to_vector(row[0]).reshape(-1, row[1])
+
+    for asset_ids, vectors, included in read_vector_chunks(
+        conn, field_name, first_row_id
+    ):
+        lists = assign_lists(vectors, centroids).tolist()
+        conn.executemany(
+            "INSERT OR REPLACE INTO nearest_lists (asset_id, name, list) VALUES (?, ?, ?);",
+            [[asset_id, name, index] for asset_id, index in zip(asset_ids, lists)],
+        )
+    conn.commit()
+
+
+def nearest(conn, asset_id, k=10, probes=NEAREST_PROBES, name=None):
+    """
+    Find the k embeddings nearest to the embedding asset_id, in
+    the column name, by searching the probes nearest lists of
+    the index. name may be None if asset_id is only in one
+    column. Returns a list of (asset_id, distance), nearest
+    first.
+    """
+    if not has_table(conn, "nearest_lists"):
+        raise Exception("datagrid has no nearest-neighbor index; save it again")
+
+    sql = "SELECT nearest_lists.name, vectors.vector, nearest_centroids.centroids, nearest_centroids.dimensions FROM nearest_lists JOIN vectors USING (asset_id) JOIN nearest_centroids USING (name) WHERE asset_id = ?"
+    parameters = [asset_id]
+    if name is not None:
+        sql += " AND nearest_lists.name = ?"
+        parameters.append(name)
+    rows = conn.execute(sql + " LIMIT 2;", parameters).fetchall()
+    if not rows:
+        raise Exception("no indexed embedding with asset_id %r" % asset_id)
+    elif len(rows) > 1:
+        raise Exception(
+            "asset_id %r is in more than one column; give the column name" % asset_id
+        )
+
+    name, vector_blob, centroids_blob, dimensions = rows[0]
+    vector = blob_to_vector(vector_blob)
+    centroids = blob_to_vector(centroids_blob).reshape(-1, dimensions)
+    distances = ((centroids - vector) ** 2).sum(axis=1)
+    lists = np.argsort(distances)[:probes].tolist()
+
+    sql = "SELECT asset_id, vector FROM nearest_lists JOIN vectors USING (asset_id) WHERE name = ? AND list IN ({lists}) AND asset_id != ?;".format(
+        lists=", ".join(["?"] * len(lists))
+    )
+    rows = conn.execute(sql, [name] + lists + [asset_id]).fetchall()
+    if not rows:
+        return []
+    vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=VECTOR_DTYPE)
+    distances = np.sqrt(((vectors.reshape(len(rows), -1) - vector) ** 2).sum(axis=1))
+    order = np.argsort(distances, kind="stable")[:k]
+    return [(rows[index][0], float(distances[index])) for index in order]
+
+
+def delete_nearest_index(conn, names):
+    """
+    Delete the nearest-neighbor index of columns.
+    """
+    for table_name in ["nearest_centroids", "nearest_lists"]:
+        if has_table(conn, table_name):
+            conn.executemany(
+                "DELETE FROM {table_name} WHERE name = ?;".format(
+                    table_name=table_name
+                ),
+                [[name] for name in names],
+            )
+    conn.commit()
+
+
+def load_projector(conn, name):
+    """
+    Load the saved projector of a column, or None.
+    """
+    if not has_table(conn, "projectors"):
+        return None
+    row = conn.execute(
+        "SELECT projector FROM projectors WHERE name = ?;", [name]
+    ).fetchone()
+    if row is None:
+        return None
+    data = json.loads(row[0])
+    if data["projection"] != "pca":
+        return None
+    return Projector.from_json(data)
+
+
+def save_projector(conn, name, projector):
+    """
+    Save the projector of a column.
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS projectors (name TEXT PRIMARY KEY, projector JSON);"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO projectors (name, projector) VALUES (?, ?);",
+        [name, json.dumps(projector.to_json())],
+    )
+
+
+def delete_projectors(conn, names):
+    """
+    Delete the saved projectors of columns, so that they will
+    be fitted again.
+    """
+    if has_table(conn, "projectors"):
+        conn.executemany(
+            "DELETE FROM projectors WHERE name = ?;", [[name] for name in names]
+        )
+        conn.commit()
 
 
 class Embedding(Asset):
@@ -63,6 +575,7 @@ class Embedding(Asset):
         unserialize=False,
         dimensions=PROJECTION_DIMENSIONS,
         scale=False,
+        fit_sample=None,
         **kwargs
     ):
         """
@@ -83,6 +596,8 @@ class Embedding(Asset):
             dimensions: (int) maximum number of dimensions
             kwargs: (dict) optional keyword arguments for projection algorithm
             scale: (bool) boolean indicating whether each column should be normalized
+            fit_sample: (int) if given, fit the projection on a random sample of
+                about this many embeddings, and then project all of them
             kwargs: (keys, values) passed to the projection constructor
 
         NOTE: when using 't-sne', you cannot have any row that is excluded from
@@ -105,6 +620,7 @@ class Embedding(Asset):
             )
 
         super().__init__(source)
+        self.vector = None
         if unserialize:
             self._unserialize = unserialize
             return
@@ -129,6 +645,7 @@ class Embedding(Asset):
         self.metadata["include"] = include
         self.metadata["dimensions"] = dimensions
         self.metadata["scale"] = scale
+        self.metadata["fit_sample"] = fit_sample
         self.metadata["kwargs"] = kwargs
 
         if file_name:
@@ -149,9 +666,10 @@ class Embedding(Asset):
             else:
                 raise ValueError("file not found: %r" % file_name)
         else:
+            # The vector is logged separately, as bytes:
+            self.vector = np.asarray(embedding, dtype=VECTOR_DTYPE)
             self.asset_data = json.dumps(
                 {
-                    "vector": embedding,
                     "name": name,
                     "color": color,
                     "text": text,
@@ -165,19 +683,59 @@ class Embedding(Asset):
 
     def log_and_serialize(self, datagrid, row_id):
         """
-        Override to save row_id.
+        Override to save row_id, and the vector.
         """
         # Put row_id in asset_data and metadata:
         asset_data = json.loads(self.asset_data)
         asset_data["row_id"] = row_id
         self.asset_data = json.dumps(asset_data)
         self.metadata["row_id"] = row_id
-        return super().log_and_serialize(datagrid, row_id)
+        datagrid._log(
+            self.asset_id,
+            self.ASSET_TYPE,
+            self.asset_data,
+            self.metadata,
+            row_id,
+            vector=vector_to_blob(self.vector) if self.vector is not None else None,
+        )
+        return self.asset_id
 
     @classmethod
-    def get_statistics(cls, datagrid, col_name, field_name):
-        import numpy as np
+    def unserialize(cls, datagrid, row, column_name):
+        """
+        Override to also load the vector.
+        """
+        obj = super().unserialize(datagrid, row, column_name)
+        unserialize_asset = obj._unserialize
+
+        def _unserialize(obj, get_remote_asset=True):
+            unserialize_asset(obj, get_remote_asset)
+            if has_table(datagrid.conn, "vectors"):
+                row = datagrid.conn.execute(
+                    "SELECT vector FROM vectors WHERE asset_id = ?", [obj._asset_id]
+                ).fetchone()
+                if row:
+                    obj.vector = blob_to_vector(row[0])
+
+        obj._unserialize = _unserialize
+        return obj
 
+    @classmethod
+    def get_statistics(cls, datagrid, col_name, field_name, first_row_id=None):
+        """
+        Project the embeddings to 2D, and store the projections.
+
+        A fitted PCA projector is saved in the datagrid. When it
+        can be reused, just the rows from first_row_id on are
+        projected with it (or all rows, if first_row_id is None).
+        Otherwise, it is fitted from all of the rows (or from a
+        sample of them, with fit_sample). See
+        DataGrid.refit_projections().
+
+        Embeddings are read and projected in chunks, and large
+        PCA columns are fitted in chunks too, so a column need
+        not fit in memory.
+        """
         # FIXME: compute min and max of eigenspace
         minimum = None
         maximum = None
@@ -187,131 +745,96 @@ class Embedding(Asset):
         stddev = None
         other = None
         name = col_name
-        seed = time.time()  # set the same for all embeddings
 
-        projection = None
-        batch = []
-        batch_asset_ids = []
-        not_included = []
-        not_included_asset_ids = []
-
-        for row in datagrid.conn.execute(
-            """SELECT {field_name} as assetId, asset_data, asset_metadata from datagrid JOIN assets ON assetId = assets.asset_id;""".format(
+        projector = load_projector(datagrid.conn, col_name)
+        if projector is None or not projector.can_save():
+            projector = None
+            first_row_id = 0
+        elif first_row_id is None:
+            # Project all of the rows again:
+            first_row_id = 0
+            projector.bounds = None
+
+        # The settings are taken from the last embedding:
+        row = datagrid.conn.execute(
+            """SELECT asset_metadata FROM datagrid JOIN assets ON {field_name} = assets.asset_id WHERE column_0 >= ? AND asset_metadata != '' ORDER BY column_0 DESC LIMIT 1;""".format(
                 field_name=field_name
+            ),
+            [first_row_id],
+        ).fetchone()
+        if row is None:
+            if projector is not None and projector.bounds is not None:
+                other = json.dumps(projector.get_ranges())
+            # min, max, avg, variance, total, stddev, other, name
+            return [minimum, maximum, avg, variance, total, stddev, other, name]
+
+        asset_metadata = json.loads(row[0])
+        dimensions = asset_metadata["dimensions"]
+        scale = asset_metadata["scale"]
+        kwargs = asset_metadata["kwargs"]
+        fit_sample = asset_metadata.get("fit_sample")
+
+        def read_chunks(included_only=False):
+            return read_vector_chunks(
+                datagrid.conn, field_name, first_row_id, included_only
             )
-        ):
-            asset_id, asset_data_json, asset_metadata_json = row
-            if not asset_metadata_json:
-                continue
-
-            asset_metadata = json.loads(asset_metadata_json)
-
-            projection = asset_metadata["projection"]
-            include = asset_metadata["include"]
-            dimensions = asset_metadata["dimensions"]
-            scale = asset_metadata["scale"]
-            kwargs = asset_metadata["kwargs"]
-
-            if projection == "pca":
-                projection_name = "pca"
-            elif projection == "t-sne":
-                projection_name = "t-sne"
-            elif projection == "umap":
-                projection_name = "umap"
-            else:
-                raise Exception("projection not found for %s" % asset_id)
-
-            asset_data = json.loads(asset_data_json)
-            vector = prepare_embedding(asset_data["vector"], dimensions, seed)
-
-            if include:
-                batch.append(vector)
-                batch_asset_ids.append(asset_id)
-            else:
-                not_included.append(vector)
-                not_included_asset_ids.append(asset_id)
-
-        batch = np.array(batch)
-        not_included = np.array(not_included)
-
-        if scale:
-            from sklearn.preprocessing import MinMaxScaler
-
-            if len(batch) > 0:
-                scaler = MinMaxScaler()
-                batch = scaler.fit_transform(batch)
-            if len(not_included) > 0:
-                scaler = MinMaxScaler()
-                not_included = scaler.fit_transform(not_included)
-
-        if projection_name == "pca":
-            from sklearn.decomposition import PCA
 
-            if "n_components" not in kwargs:
-                kwargs["n_components"] = 2
-
-            projection = PCA(**kwargs)
-            transformed = projection.fit_transform(batch)
-            if not_included:
-                transformed_not_included = projection.transform(not_included)
-            else:
-                transformed_not_included = np.array([])
-
-        elif projection_name == "t-sne":
-            from sklearn.manifold import TSNE
-
-            projection = TSNE(**kwargs)
-            transformed = projection.fit_transform(batch)
-            # t-SNE can't handle rows where include=False
-            transformed_not_included = np.array([])
-
-        elif projection_name == "umap":
-            from umap import UMAP
-
-            projection = UMAP(**kwargs)
-            transformed = projection.fit_transform(batch)
-            if not_included:
-                transformed_not_included = projection.transform(not_included)
-            else:
-                transformed_not_included = np.array([])
-
-        x_max = float(transformed[:, 0].max())
-        x_min = float(transformed[:, 0].min())
-        y_max = float(transformed[:, 1].max())
-        y_min = float(transformed[:, 1].min())
-        x_span = abs(x_max - x_min)
-        x_max += x_span * 0.1
-        x_min -= x_span * 0.1
-        y_span = abs(y_max - y_min)
-        y_max += y_span * 0.1
-        y_min -= y_span * 0.1
-        other = json.dumps(
-            {
-                "x_range": [x_min, x_max],
-                "y_range": [y_min, y_max],
-            }
+        cursor = datagrid.conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS projections (asset_id TEXT PRIMARY KEY, x FLOAT, y FLOAT);"
         )
 
-        # update assets with transformed
-        cursor = datagrid.conn.cursor()
-        if not_included_asset_ids:
-            batch_asset_ids = batch_asset_ids + not_included_asset_ids
-            transformed = np.concatenate((transformed, transformed_not_included))
-
-        for asset_id, tran in zip(batch_asset_ids, transformed):
-            sql = """SELECT asset_data from assets WHERE asset_id = ?;"""
-            asset_data_json = datagrid.conn.execute(sql, (asset_id,)).fetchone()[0]
-            asset_data = json.loads(asset_data_json)
-            asset_data["projection_transform"] = tran.tolist()
-            asset_data_json = json.dumps(asset_data)
-            sql = """UPDATE assets SET asset_data = ? WHERE asset_id = ?;"""
-            cursor.execute(
-                sql,
-                (
-                    asset_data_json,
-                    asset_id,
-                ),
-            )
+        projected = False
+        if projector is None:
+            projector = Projector(asset_metadata["projection"])
+            (count,) = datagrid.conn.execute(
+                """SELECT COUNT(*) FROM datagrid JOIN assets ON {field_name} = assets.asset_id WHERE asset_metadata != '' AND json_extract(asset_metadata, '$.include');""".format(
+                    field_name=field_name
+                )
+            ).fetchone()
+            if projector.can_transform() and fit_sample and fit_sample < count:
+                # Fit on a random sample, then project all:
+                rng = np.random.default_rng(PROJECTION_SEED)
+                sample = np.concatenate(
+                    [
+                        chunk[1][rng.random(len(chunk[1])) < fit_sample / count]
+                        for chunk in read_chunks(True)
+                    ]
+                )
+                projector.fit(sample, dimensions, scale, kwargs)
+            elif projector.projection == "pca" and count > PROJECTION_MEMORY_ROWS:
+                projector.fit_chunks(
+                    lambda: (chunk[1] for chunk in read_chunks(True)),
+                    dimensions,
+                    scale,
+                    kwargs,
+                )
+            else:
+                # Fit and project, all in memory:
+                chunks = list(read_chunks())
+                asset_ids = [asset_id for chunk in chunks for asset_id in chunk[0]]
+                vectors = np.concatenate([chunk[1] for chunk in chunks])
+                included = np.concatenate([chunk[2] for chunk in chunks])
+                transformed = projector.fit_transform(
+                    vectors, included, dimensions, scale, kwargs
+                )
+                projector.update_bounds(transformed[included])
+                write_projections(cursor, asset_ids, transformed)
+                projected = True
+
+        if not projected:
+            # Project the rows, one chunk at a time:
+            for asset_ids, vectors, included in read_chunks():
+                transformed = projector.transform(vectors)
+                projector.update_bounds(transformed[included])
+                write_projections(cursor, asset_ids, transformed)
+
+        if projector.can_save():
+            save_projector(datagrid.conn, col_name, projector)
         datagrid.conn.commit()
 
+        update_nearest_index(datagrid.conn, col_name, field_name, first_row_id)
+        if projector.bounds is not None:
+            other = json.dumps(projector.get_ranges())
+
         return [minimum, maximum, avg, variance, total, stddev, other, name]
@@ -28,6 +28,7 @@ from .utils import (
     _verify_marker,
     convert_tensor_to_numpy,
     download_filename,
+    encode_mask_array,
     fast_flatten,
     flatten,
     generate_image,
@@ -36,7 +37,6 @@ from .utils import (
     image_to_fp,
     is_valid_file_path,
     rescale_array,
-    rle_encode,
 )
 
 LOGGER = logging.getLogger(__name__)
@@ -580,6 +580,7 @@ class Image(Asset):
         layer_name="(uncategorized)",
         id=None,
         column_first=False,
+        binary=False,
         **metadata
     ):
         """
@@ -597,6 +598,8 @@ class Image(Asset):
             column_first: (optional, bool) normally, mask data is given
                in row-first order (mask[row][col]). Use this flag to indicate
                that you are passing in a mask in column-first order
+            binary: (optional, bool) store the mask runs as compact
+               binary, rather than as a list of numbers
 
         Example:
         ```python
@@ -654,18 +657,12 @@ class Image(Asset):
             image = image.quantize()
             width, height = image.size
             array = np.array(image)
-            array = array.flatten().tolist()
         else:
-            array = fast_flatten(array, int).tolist()
+            array = fast_flatten(array, int)
 
         self._init_annotations(layer_name)
 
-        rle_array = rle_encode(array)
-        if len(rle_array) < len(array):
-            array = rle_array
-            format = "rle"
-        else:
-            format = "raw"
+        array, format = encode_mask_array(array, binary=binary)
 
         self._update_annotations(
             layer_name,
@@ -696,6 +693,7 @@ class Image(Asset):
         id=None,
         column_first=False,
         colorlevels=64,
+        binary=False,
         **metadata
     ):
         """
@@ -717,6 +715,8 @@ class Image(Asset):
             column_first: (optional, bool) normally, mask data is given
                in row-first order (mask[row][col]). Use this flag to indicate
                that you are passing in a mask in column-first order
+            binary: (optional, bool) store the mask runs as compact
+               binary, rather than as a list of numbers
 
         Notes:
 
@@ -782,23 +782,18 @@ class Image(Asset):
             array = np.array(image)
             array = array.flatten()
             # convert 0-255 floats to 0-colorlevels ints
-            array = (array / 255 * (colorlevels - 1)).astype(int).tolist()
+            array = (array / 255 * (colorlevels - 1)).astype(int)
         else:
             # converts to numpy array too:
             array = fast_flatten(array, float)
             # Set any negative numbers to zero:
             array[array < 0] = 0
             # convert 0.0-1.0 floats to 0-colorlevels ints
-            array = (array * (colorlevels - 1)).astype(int).tolist()
+            array = (array * (colorlevels - 1)).astype(int)
 
         self._init_annotations(layer_name)
 
-        rle_array = rle_encode(array)
-        if len(rle_array) < len(array):
-            array = rle_array
-            format = "rle"
-        else:
-            format = "raw"
+        array, format = encode_mask_array(array, binary=binary)
 
         self._update_annotations(
             layer_name,
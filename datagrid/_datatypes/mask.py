@@ -12,7 +12,8 @@
 ######################################################
 
 import math
-import random
+
+import numpy as np
 
 from .utils import _verify_box
 
@@ -23,10 +24,6 @@ def distance(p1, p2):
     return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
 
-def avg(list_of_numbers):
-    return sum(list_of_numbers) / len(list_of_numbers)
-
-
 def flatten(mask):
     import itertools
 
@@ -34,9 +31,14 @@ def flatten(mask):
 
 
 class Mask:
+    """
+    A mask, as a 2D NumPy array (mask[row][col]) of label ids
+    or metric values.
+    """
+
     def __init__(self, size):
         self.width, self.height = size
-        self._mask = [[0 for col in range(self.width)] for row in range(self.height)]
+        self._mask = np.zeros((self.height, self.width), dtype=np.int64)
         self._labels = {}
 
     def _next_label_id(self):
@@ -45,6 +47,34 @@ class Mask:
         else:
             return 1
 
+    def _distances(self, center):
+        """
+        The distance of each pixel from center (x, y).
+        """
+        cols = np.arange(self.width) - center[0]
+        rows = np.arange(self.height) - center[1]
+        return np.hypot(cols[None, :], rows[:, None])
+
+    def _neighbors(self, radius):
+        """
+        For each pixel, the count and the sum of the neighbors
+        within radius that are alive (not zero).
+        """
+        padded = np.pad(self._mask, radius)
+        count = np.zeros(self._mask.shape, dtype=np.int64)
+        total = np.zeros(self._mask.shape, dtype=padded.dtype)
+        for x in range(-radius, radius + 1):
+            for y in range(-radius, radius + 1):
+                if x == 0 and y == 0:
+                    continue
+                shifted = padded[
+                    radius + y : radius + y + self.height,
+                    radius + x : radius + x + self.width,
+                ]
+                count += shifted != 0
+                total += shifted
+        return count, total
+
     def get_array(self):
         return self._mask
 
@@ -76,10 +106,11 @@ class Mask:
         p1 = self._verify([int(x), int(y)])
         p2 = self._verify([int(x + w), int(y + h)])
         value = self.get_label_id(label)
-        for row in range(p1[1], p2[1]):
-            for col in range(p1[0], p2[0]):
-                if overwrite or self._mask[row][col] == 0:
-                    self._mask[row][col] = value
+        region = self._mask[p1[1] : p2[1], p1[0] : p2[0]]
+        if overwrite:
+            region[:] = value
+        else:
+            region[region == 0] = value
 
     def add_regions(self, label, *points_list, score=None, overwrite=True):
         for points in points_list:
@@ -90,107 +121,89 @@ class Mask:
 
         polygon = matplotlib.path.Path(points, closed=True)
         value = self.get_label_id(label)
-        for row in range(self.height):
-            for col in range(self.width):
-                if overwrite or self._mask[row][col] == 0:
-                    if polygon.contains_point([col, row]):
-                        self._mask[row][col] = value
+        # Only pixels in the polygon's bounding box can be inside:
+        xys = np.asarray(points, dtype=float).reshape(-1, 2)
+        x1, y1 = np.maximum(np.floor(xys.min(axis=0)).astype(int), 0)
+        x2, y2 = np.minimum(
+            np.ceil(xys.max(axis=0)).astype(int) + 1, [self.width, self.height]
+        )
+        cols, rows = np.meshgrid(np.arange(x1, x2), np.arange(y1, y2))
+        inside = polygon.contains_points(
+            np.column_stack([cols.ravel(), rows.ravel()])
+        ).reshape(cols.shape)
+        region = self._mask[y1:y2, x1:x2]
+        if not overwrite:
+            inside &= region == 0
+        region[inside] = value
 
     def add_circle(self, center, radius, label, score=None):
         value = self.get_label_id(label)
-        for row in range(self.height):
-            for col in range(self.width):
-                d = distance([col, row], center)
-                if d < radius:
-                    self._mask[row][col] = value
+        self._mask[self._distances(center) < radius] = value
 
     def live(self, threshold=3, radius=1):
         # game of life
-        new_mask = [
-            [self._mask[row][col] for col in range(self.width)]
-            for row in range(self.height)
-        ]
-        for row in range(self.height):
-            for col in range(self.width):
-                near = self.neighbors([col, row], radius)
-                if len(near) >= threshold:
-                    new_mask[row][col] = int(avg(near))
+        count, total = self._neighbors(radius)
+        alive = count >= threshold
+        new_mask = self._mask.copy()
+        new_mask[alive] = np.trunc(total[alive] / count[alive])
         self._mask = new_mask
 
     def die(self, threshold=3, radius=1):
         # game of life
-        new_mask = [
-            [self._mask[row][col] for col in range(self.width)]
-            for row in range(self.height)
-        ]
-        for row in range(self.height):
-            for col in range(self.width):
-                near = self.neighbors([col, row], radius)
-                if len(near) <= threshold:
-                    new_mask[row][col] = 0
+        count, total = self._neighbors(radius)
+        new_mask = self._mask.copy()
+        new_mask[count <= threshold] = 0
         self._mask = new_mask
 
     def neighbors(self, col_row, radius):
         col, row = col_row
         # neighbors that are alive (not zero)
-        retval = []
-        for x in range(-radius, radius + 1):
-            for y in range(-radius, radius + 1):
-                if (
-                    ((x + col >= 0) and (x + col < self.width))
-                    and ((y + row >= 0) and (y + row < self.height))
-                    and (not ((x == 0) and (y == 0)))
-                    and self._mask[row][col] > 0
-                ):
-                    retval.append(self._mask[row][col])
-        return retval
+        window = self._mask[
+            max(row - radius, 0) : row + radius + 1,
+            max(col - radius, 0) : col + radius + 1,
+        ].copy()
+        window[row - max(row - radius, 0), col - max(col - radius, 0)] = 0
+        return window[window != 0].tolist()
 
     def threshold(self, lower=None, upper=None, new_value=None):
-        for row in range(self.height):
-            for col in range(self.width):
-                if lower is not None and self._mask[row][col] < lower:
-                    self._mask[row][col] = new_value
-                elif upper is not None and self._mask[row][col] > upper:
-                    self._mask[row][col] = new_value
+        outside = np.zeros(self._mask.shape, dtype=bool)
+        if lower is not None:
+            outside |= self._mask < lower
+        if upper is not None:
+            outside |= self._mask > upper
+        self._mask[outside] = new_value if new_value is not None else 0
 
     def add_gaussian(self, center, radius=None, mu=None, sigma=None, score=None):
-        import statistics
-
         center = [int(v) for v in center]
         radius = int(radius if radius else max(self.width / 2, self.height / 2))
         mu = mu if mu else 1.0
         sigma = sigma if sigma else 0.5
-        distribution = statistics.NormalDist(mu=mu, sigma=sigma)
         max_dist = int(distance([0, 0], [radius, radius]))
-        for row in range(self.height):
-            for col in range(self.width):
-                d = distance([col, row], center)
-                if d < radius:
-                    if self._mask[row][col]:
-                        self._mask[row][col] = (
-                            self._mask[row][col] + distribution.pdf(1 - d / max_dist)
-                        ) / 2
-                    else:
-                        self._mask[row][col] = distribution.pdf(1 - d / max_dist)
-                    self._mask[row][col] = min(self._mask[row][col], 1.0)
+        distances = self._distances(center)
+        inside = distances < radius
+        # The normal distribution's pdf:
+        x = 1 - distances[inside] / max_dist
+        pdf = np.exp(-(((x - mu) / sigma) ** 2) / 2) / (sigma * math.sqrt(2 * math.pi))
+        self._mask = self._mask.astype(np.float64)
+        values = self._mask[inside]
+        values = np.where(values != 0, (values + pdf) / 2, pdf)
+        self._mask[inside] = np.minimum(values, 1.0)
 
     def gitter(self, radius=2):
-        new_mask = [
-            [self._mask[row][col] for col in range(self.width)]
-            for row in range(self.height)
-        ]
-        for row in range(self.height):
-            for col in range(self.width):
-                x, y = self._verify(
-                    [
-                        col + random.randint(-radius, radius + 1),
-                        row + random.randint(-radius, radius + 1),
-                    ]
-                )
-                new_mask[row][col], new_mask[y][x] = (
-                    self._mask[y][x],
-                    self._mask[row][col],
-                )
+        rows, cols = np.indices(self._mask.shape)
+        xs = np.clip(
+            cols + np.random.randint(-radius, radius + 2, size=cols.shape),
+            0,
+            self.width - 1,
+        )
+        ys = np.clip(
+            rows + np.random.randint(-radius, radius + 2, size=rows.shape),
+            0,
+            self.height - 1,
+        )
+        # Each pixel swaps with a random nearby pixel:
+        new_mask = self._mask[ys, xs]
+        new_mask[ys, xs] = self._mask
         self._mask = new_mask
 
     def _value_to_char(self, value, max_value):
@@ -203,7 +216,7 @@ class Mask:
         return colors[index]
 
     def show(self, max_value=None):
-        max_value = max_value if max_value is not None else max(flatten(self._mask))
+        max_value = max_value if max_value is not None else self._mask.max()
         max_value = 1 if max_value == 0 else max_value
         for row in range(self.height):
             for col in range(self.width):
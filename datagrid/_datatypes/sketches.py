@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+######################################################
+#     _____                  _____      _     _      #
+#    (____ \       _        |  ___)    (_)   | |     #
+#     _   \ \ ____| |_  ____| | ___ ___ _  _ | |     #
+#    | |  | )/ _  |  _)/ _  | |(_  / __) |/ || |     #
+#    | |__/ ( ( | | | ( ( | | |__| | | | ( (_| |     #
+#    |_____/ \_||_|___)\_||_|_____/|_| |_|\____|     #
+#                                                    #
+#    Copyright (c) 2023-2024 Kangas Development Team #
+#    All rights reserved                             #
+######################################################
+
+import base64
+import hashlib
+import math
+import numbers
+
+import numpy as np
+
+
+def _mix(hashes):
+    """
+    The splitmix64 finalizer, applied to an array of uint64.
+    """
+    hashes = hashes + np.uint64(0x9E3779B97F4A7C15)
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def hash_values(values):
+    """
+    Hash values to uint64, the same way in every process.
+    Numbers are hashed by value (so 1 and 1.0 are the same),
+    and everything else by its text.
+    """
+    numbers_list = []
+    others = []
+    for value in values:
+        if value is None:
+            continue
+        elif isinstance(value, numbers.Number) and not isinstance(value, bool):
+            numbers_list.append(value)
+        else:
+            others.append(value)
+
+    # + 0.0 makes -0.0 the same as 0.0:
+    number_hashes = _mix(
+        (np.array(numbers_list, dtype=np.float64) + 0.0).view(np.uint64)
+    )
+    other_hashes = np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(
+                    value if isinstance(value, bytes) else str(value).encode("utf-8"),
+                    digest_size=8,
+                ).digest(),
+                "little",
+            )
+            for value in others
+        ],
+        dtype=np.uint64,
+    )
+    return np.concatenate([number_hashes, other_hashes])
+
+
+class HyperLogLog:
+    """
+    A mergeable sketch of the number of distinct values.
+
+    The relative error is about 1.04 / sqrt(2 ** precision).
+    Until there are more than 2 ** precision / 4 distinct
+    values, their hashes are kept too, so small counts are
+    exact.
+    """
+
+    def __init__(self, precision=12, registers=None, exact=None):
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros(2**precision, dtype=np.uint8)
+            exact = np.zeros(0, dtype=np.uint64)
+        self.registers = registers
+        # The sorted distinct hashes, or None once there are too many:
+        self.exact = exact
+
+    def _update_exact(self, hashes):
+        if self.exact is not None:
+            self.exact = np.union1d(self.exact, hashes)
+            if len(self.exact) > len(self.registers) // 4:
+                self.exact = None
+
+    def update(self, values):
+        """
+        Add values (numbers or strings) to the sketch. None
+        is ignored.
+        """
+        hashes = hash_values(values)
+        if len(hashes) == 0:
+            return
+
+        self._update_registers(hashes)
+        self._update_exact(hashes)
+
+    def _update_registers(self, hashes):
+        width = 64 - self.precision
+        index = (hashes >> np.uint64(width)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)
+        # The rank is the position of the first 1 bit of the
+        # rest; frexp is exact on the top 53 bits:
+        _, exponent = np.frexp((rest >> np.uint64(11)).astype(np.float64))
+        rank = np.where(exponent > 0, 54 - exponent, width + 1)
+        rank = np.minimum(rank, width + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """
+        Merge another sketch (of the same precision) into this one.
+        """
+        if other.precision != self.precision:
+            raise Exception("unable to merge sketches of different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        if other.exact is None:
+            self.exact = None
+        else:
+            self._update_exact(other.exact)
+        return self
+
+    def count(self):
+        """
+        Estimate the number of distinct values (exact, when
+        there are few of them).
+        """
+        if self.exact is not None:
+            return len(self.exact)
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and zeros > 0:
+            # Linear counting, for small counts:
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def to_json(self):
+        # The registers can be rebuilt from the exact hashes, so
+        # only one of them is saved:
+        if self.exact is not None:
+            return {
+                "precision": self.precision,
+                "exact": base64.b64encode(self.exact.tobytes()).decode("utf-8"),
+            }
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(self.registers.tobytes()).decode("utf-8"),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        if data.get("registers") is None:
+            sketch = cls(data["precision"])
+            exact = np.frombuffer(base64.b64decode(data["exact"]), dtype=np.uint64)
+            sketch._update_registers(exact)
+            sketch.exact = exact.copy()
+            return sketch
+
+        registers = np.frombuffer(
+            base64.b64decode(data["registers"]), dtype=np.uint8
+        ).copy()
+        exact = None
+        # Sketches saved with the registers only estimate, unless
+        # they kept the exact hashes too:
+        if data.get("exact") is not None:
+            exact = np.frombuffer(
+                base64.b64decode(data["exact"]), dtype=np.uint64
+            ).copy()
+        return cls(data["precision"], registers, exact)
+
+
+class QuantileSketch:
+    """
+    A mergeable sketch of the distribution of numbers (a KLL
+    sketch), for approximate quantiles.
+
+    Values are kept in levels, where each value in level i
+    stands for 2 ** i of the original values. When a level
+    is full, it is sorted and every other value moves up.
+    """
+
+    def __init__(self, k=200, levels=None):
+        self.k = k
+        if levels is None:
+            levels = [np.empty(0, dtype=np.float64)]
+        self.levels = levels
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * (2.0 / 3.0) ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(self.levels[level])
+                # An odd item stays behind, so no weight is lost:
+                keep = items[len(items) - len(items) % 2 :]
+                items = items[: len(items) - len(items) % 2]
+                # Alternate which half moves up, to cancel the bias:
+                offset = (len(self.levels[level + 1]) + level) % 2
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], items[offset::2]]
+                )
+                self.levels[level] = keep
+            level += 1
+
+    def update(self, values):
+        """
+        Add numbers to the sketch. Other values, and NaN, are
+        ignored.
+        """
+        values = np.array(
+            [value for value in values if isinstance(value, numbers.Number)],
+            dtype=np.float64,
+        )
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+        """
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float64))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+        return self
+
+    def count(self):
+        """
+        The number of values added to the sketch.
+        """
+        return sum(len(items) << level for level, items in enumerate(self.levels))
+
+    def quantiles(self, qs):
+        """
+        Estimate the quantiles qs (each between 0 and 1). Returns
+        None for each if the sketch is empty.
+        """
+        if self.count() == 0:
+            return [None for q in qs]
+        values = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(items), 2**level) for level, items in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        values = values[order]
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(
+            cumulative, np.array(qs, dtype=np.float64) * cumulative[-1], side="left"
+        )
+        positions = np.minimum(positions, len(values) - 1)
+        return [values[position].item() for position in positions]
+
+    def to_json(self):
+        return {
+            "k": self.k,
+            "levels": [
+                base64.b64encode(items.astype(np.float64).tobytes()).decode("utf-8")
+                for items in self.levels
+            ],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        levels = [
+            np.frombuffer(base64.b64decode(items), dtype=np.float64).copy()
+            for items in data["levels"]
+        ]
+        return cls(data["k"], levels)
@@ -11,9 +11,12 @@
 #    All rights reserved                             #
 ######################################################
 
+import base64
+import collections
 import datetime
 import functools
 import gzip
+import hashlib
 import io
 import logging
 import math
@@ -21,6 +24,7 @@ import numbers
 import os
 import re
 import shutil
+import threading
 import urllib.parse
 import urllib.request
 import uuid
@@ -40,6 +44,10 @@ RESERVED_NAMES = ["row-id"]
 LOGGER = logging.getLogger(__name__)
 INFINITY = float("inf")
 CONVERSION_METHODS = ["as_py", "to_pydatetime"]
+# Number of resampled mask annotations to keep:
+MASK_CACHE_SIZE = 256
+MASK_CACHE = collections.OrderedDict()
+MASK_CACHE_LOCK = threading.Lock()
 
 if st is not None and st.runtime.exists():
 
@@ -487,6 +495,36 @@ def generate_guid():
     return uuid.uuid4().hex
 
 
+def create_table_index(conn, table_name, field_name):
+    """
+    Create an index on a table's field, if there isn't one.
+
+    Args:
+        conn: a writable sqlite3 connection
+        table_name: (str) the name of the table
+        field_name: (str) the name of the field in the table
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS {table_name}_{field_name}_index ON {table_name} ({field_name});".format(
+            table_name=table_name, field_name=field_name
+        )
+    )
+    conn.commit()
+
+
+def has_table(conn, table_name):
+    """
+    Does the database have a table with this name?
+    """
+    return (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+            [table_name],
+        ).fetchone()
+        is not None
+    )
+
+
 def generate_image(asset_data):
     """
     Given the asset data, generate a PIL Image.
@@ -506,7 +544,12 @@ def generate_image(asset_data):
 
 
 def generate_thumbnail(
-    asset_data, size=None, force=False, annotations=None, return_image=False
+    asset_data,
+    size=None,
+    force=False,
+    annotations=None,
+    return_image=False,
+    asset_id=None,
 ):
     """
     Given the asset data, generate a thumbnail-sized image
@@ -521,6 +564,8 @@ def generate_thumbnail(
         size: (tuple, optional) max (width, height)
         force: (bool, optional) if True, force resize;
             else only if not too small
+        asset_id: (str, optional) the asset's id, used to
+            cache its resampled masks
 
     Returns:
         bytes of image (PNG if created, but may be the original
@@ -544,7 +589,9 @@ def generate_thumbnail(
             new_image = contain(image, size)
 
     if annotations:
-        draw_annotations_on_image(new_image, annotations, image.width, image.height)
+        draw_annotations_on_image(
+            new_image, annotations, image.width, image.height, asset_id=asset_id
+        )
 
     fp = image_to_fp(new_image, "png")
     image_data = fp.read()
@@ -606,9 +653,59 @@ def make_tag(layer_name, label):
         return "%s: %s" % (layer_name, label)
 
 
-def draw_annotations_on_image(image, annotations, width, height, includes=None):
+def get_mask_digest(mask):
+    """
+    Get a digest of a mask annotation's values and shape.
+    """
+    digest = hashlib.sha1(
+        ("%s:%s:%s:" % (mask["format"], mask["width"], mask["height"])).encode("utf-8")
+    )
+    if isinstance(mask["array"], str):
+        digest.update(mask["array"].encode("utf-8"))
+    else:
+        array = np.asarray(mask["array"])
+        digest.update(("%s:%s:" % (array.dtype, array.shape)).encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def get_resampled_mask(mask, size, key=None):
+    """
+    Decode a mask annotation, and resample it (nearest
+    neighbor) to size (width, height), as a 2D array. If key is
+    given, the result is cached under key, size, and the mask's
+    digest, so that a different mask under the same key isn't
+    served from the cache.
+    """
+    if key is not None:
+        key = (key, get_mask_digest(mask), size)
+        with MASK_CACHE_LOCK:
+            if key in MASK_CACHE:
+                MASK_CACHE.move_to_end(key)
+                return MASK_CACHE[key]
+
+    array = decode_mask_array(mask)
+    # don't assume it keeps aspect ratio:
+    scale_x = mask["width"] / size[0]
+    scale_y = mask["height"] / size[1]
+    xs = (np.arange(size[0]) * scale_x).astype(np.int64)
+    ys = (np.arange(size[1]) * scale_y).astype(np.int64)
+    resampled = array[ys[:, None] * mask["width"] + xs[None, :]]
+
+    if key is not None:
+        with MASK_CACHE_LOCK:
+            MASK_CACHE[key] = resampled
+            while len(MASK_CACHE) > MASK_CACHE_SIZE:
+                MASK_CACHE.popitem(last=False)
+    return resampled
+
+
+def draw_annotations_on_image(
+    image, annotations, width, height, includes=None, asset_id=None
+):
     # annotations: "mask", "boxes", "points", "markers", or "lines"
-    from PIL import ImageDraw
+    # asset_id: (optional) to cache the asset's resampled masks
+    from PIL import Image, ImageDraw
 
     from .colormaps import get_colormap
 
@@ -625,21 +722,18 @@ def draw_annotations_on_image(image, annotations, width, height, includes=None):
     # assumes images keep aspect ratio
     scale = image.size[0] / width  # scale of thumbnail
     # Draw masks first:
-    for annotation_layer in annotations:
-        for annotation in annotation_layer["data"]:
+    for layer_index, annotation_layer in enumerate(annotations):
+        for index, annotation in enumerate(annotation_layer["data"]):
             if "mask" in annotation and annotation["mask"]:
                 if pixels is None:
-                    pixels = image.load()
+                    pixels = np.array(image)
 
                 mask = annotation["mask"]
-                if mask["format"] == "rle":
-                    array = rle_decode(mask["array"])
-                else:
-                    array = mask["array"]
-                scale_x = mask["width"] / image.size[0]  # scale of mask
-                scale_y = (
-                    mask["height"] / image.size[1]
-                )  # don't assume it keeps aspect ratio
+                array = get_resampled_mask(
+                    mask,
+                    image.size,
+                    None if asset_id is None else (asset_id, layer_index, index),
+                )
                 if mask["type"] == "segmentation":
                     palette = {
                         int(index): get_rgb_from_hex(
@@ -647,45 +741,32 @@ def draw_annotations_on_image(image, annotations, width, height, includes=None):
                         )
                         for index, label in mask["map"].items()
                     }
-                    # Fill in x,y of thumbnail:
-                    for x in range(image.size[0]):
-                        for y in range(image.size[1]):
-                            # get position from mask:
-                            class_value = array[
-                                int(y * scale_y) * mask["width"] + int(x * scale_x)
-                            ]
-                            if class_value in palette:
-                                # blend the colors for transparency:
-                                pixels[(x, y)] = tuple(
-                                    [
-                                        int((v1 + v2) / 2)
-                                        for v1, v2 in zip(
-                                            pixels[(x, y)], palette[class_value]
-                                        )
-                                    ]
-                                )
+                    # Look up the colors of the mask's values:
+                    values, inverse = np.unique(array, return_inverse=True)
+                    colors = np.array(
+                        [palette.get(value, (0, 0, 0)) for value in values.tolist()],
+                        dtype=np.uint16,
+                    )
+                    found = np.array(
+                        [value in palette for value in values.tolist()], dtype=bool
+                    )
+                    inverse = inverse.reshape(array.shape)
+                    blend_pixels(pixels, found[inverse], colors[inverse])
 
                 if mask["type"] == "metric":
                     colorlevels = mask["colorlevels"] if "colorlevels" in mask else 255
                     colormap = get_colormap(
                         name=mask["colormap"], resolution=colorlevels
                     )
+                    colors = np.array(colormap, dtype=np.uint16)
+                    found = array > 0
+                    indexes = np.minimum(
+                        np.where(found, array, 0), len(colormap) - 1
+                    ).astype(np.int64)
+                    blend_pixels(pixels, found, colors[indexes])
 
-                    for x in range(image.size[0]):
-                        for y in range(image.size[1]):
-                            # get value from mask:
-                            index = array[
-                                int(y * scale_y) * mask["width"] + int(x * scale_x)
-                            ]
-                            if index > 0:
-                                rgb = colormap[min(index, len(colormap) - 1)]
-                                # blend the colors for transparency:
-                                pixels[(x, y)] = tuple(
-                                    [
-                                        int((v1 + v2) / 2)
-                                        for v1, v2 in zip(pixels[(x, y)], rgb)
-                                    ]
-                                )
+    if pixels is not None:
+        image.paste(Image.fromarray(pixels, image.mode))
 
     for annotation_layer in annotations:
         for annotation in annotation_layer["data"]:
@@ -935,26 +1016,114 @@ def _verify_marker(marker, shape, size, border_width):
 
 def rle_encode(sequence):
     """
-    Run-length encoding of a given sequence.
+    Run-length encoding of a given sequence (list or NumPy
+    array), as an array of alternating values and counts.
     """
-    encoding = [sequence[0], 1]
-    for value in sequence[1:]:
-        if value == encoding[-2]:
-            encoding[-1] += 1
-        else:
-            encoding.extend((value, 1))
+    array = np.asarray(sequence).reshape(-1)
+    if len(array) == 0:
+        return array
+    starts = np.flatnonzero(np.concatenate([[True], array[1:] != array[:-1]]))
+    counts = np.diff(np.append(starts, len(array)))
+    encoding = np.empty(len(starts) * 2, dtype=np.result_type(array, counts))
+    encoding[0::2] = array[starts]
+    encoding[1::2] = counts
     return encoding
 
 
 def rle_decode(encoding):
     """
-    Run-length decoding of a given encoding.
+    Run-length decoding of a given encoding, as a NumPy array.
+    """
+    encoding = np.asarray(encoding)
+    return np.repeat(encoding[0::2], encoding[1::2].astype(np.int64))
+
+
+def varint_encode(values):
+    """
+    Encode an array of non-negative integers as bytes, with
+    7 bits per byte (LEB128), so that small numbers take one
+    byte.
+    """
+    values = np.asarray(values).astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(lengths) - lengths
+    data = np.empty(lengths.sum(), dtype=np.uint8)
+    for position in range(lengths.max(initial=0)):
+        selected = lengths > position
+        byte = (values[selected] >> np.uint64(7 * position)) & np.uint64(0x7F)
+        more = (lengths[selected] > position + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[selected] + position] = byte | more
+    return data.tobytes()
+
+
+def varint_decode(data):
+    """
+    Decode bytes from varint_encode() to an array of integers.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    # The last byte of each value has the high bit clear:
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    lengths = ends - starts + 1
+    values = np.zeros(len(ends), dtype=np.uint64)
+    for position in range(lengths.max(initial=0)):
+        selected = lengths > position
+        byte = (data[starts[selected] + position] & 0x7F).astype(np.uint64)
+        values[selected] |= byte << np.uint64(7 * position)
+    return values.astype(np.int64)
+
+
+def encode_mask_array(array, binary=False):
+    """
+    Encode a flat array of mask values for a mask annotation,
+    as whichever is smaller of raw or run-length encoded. If
+    binary is True, integer runs are stored as base64 varints
+    rather than as a list.
+
+    Returns (array, format).
+    """
+    array = np.asarray(array).reshape(-1)
+    encoding = rle_encode(array)
+    if len(encoding) >= len(array):
+        return array.tolist(), "raw"
+    elif (
+        binary
+        and np.issubdtype(encoding.dtype, np.integer)
+        and (encoding >= 0).all()
+    ):
+        data = base64.b64encode(varint_encode(encoding)).decode("utf-8")
+        return data, "rle-varint"
+    else:
+        return encoding.tolist(), "rle"
+
+
+def decode_mask_array(mask):
     """
-    sequence = []
-    for index in range(0, len(encoding), 2):
-        value, count = encoding[index : index + 2]
-        sequence.extend([value] * count)
-    return sequence
+    Decode the values of a mask annotation, in any format, as
+    a flat NumPy array.
+    """
+    if mask["format"] == "rle":
+        return rle_decode(mask["array"])
+    elif mask["format"] == "rle-varint":
+        return rle_decode(varint_decode(base64.b64decode(mask["array"])))
+    else:
+        return np.asarray(mask["array"])
+
+
+def blend_pixels(pixels, where, colors):
+    """
+    Blend colors (an array of RGB, the shape of the image)
+    half and half into the image's pixels, where where is
+    True. Blended pixels are opaque.
+    """
+    blended = (pixels[..., :3].astype(np.uint16) + colors) // 2
+    pixels[..., :3] = np.where(where[..., None], blended, pixels[..., :3])
+    if pixels.shape[-1] == 4:
+        pixels[..., 3] = np.where(where, 255, pixels[..., 3])
 
 
 def compress(series, precision=0):
@@ -1057,14 +1226,11 @@ def get_mask_from_annotations(annotations, label):
 
 
 def expand_mask(mask, label):
-    if mask["format"] == "rle":
-        array = rle_decode(mask["array"])
-    else:
-        array = mask["array"]
+    array = decode_mask_array(mask)
     # mask["map"] {1: "person", 14: "person"}
     # only interested in label
     indices = [int(index) for index in mask["map"] if mask["map"][index] == label]
-    return np.array([value in indices for value in array])
+    return np.isin(array, indices)
 
 
 def is_comment(line):
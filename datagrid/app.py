@@ -22,7 +22,6 @@ from ._datatypes.utils import (
     get_color,
     get_rgb_from_hex,
     get_contrasting_color,
-    generate_thumbnail,
     generate_image,
     image_to_fp,
     draw_annotations_on_image,
@@ -36,6 +35,9 @@ from .server.queries import (
     select_histogram,
     select_asset_group_thumbnail,
     select_asset_group,
+    select_group_summaries,
+    select_thumbnail,
+    build_asset_group_gallery,
     generate_chart_image,
     get_completions,
     verify_where,
@@ -84,7 +86,10 @@ def build_header_row(column_names, width):
     return retval
 
 
-def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
+def build_row(
+    DATAGRID, group_by, where, r, row, schema, experiment, config, summaries=None
+):
+    summaries = summaries if summaries is not None else {}
     retval = "<tr>"
     if group_by:
         max_height = 116
@@ -94,17 +99,21 @@ def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
         linkable = True
         if group_by:
             if isinstance(value, dict):
+                summary = summaries.get((value["columnValue"], column_name))
                 if value["type"] in ["integer-group", "text-group"]:
-                    results = select_category(
-                        DATAGRID,
-                        group_by,
-                        where=None,
-                        column_name=column_name,
-                        column_value=value["columnValue"],
-                        where_description=None,
-                        computed_columns=None,
-                        where_expr=where,
-                    )
+                    if summary is not None:
+                        results = summary
+                    else:
+                        results = select_category(
+                            DATAGRID,
+                            group_by,
+                            where=None,
+                            column_name=column_name,
+                            column_value=value["columnValue"],
+                            where_description=None,
+                            computed_columns=None,
+                            where_expr=where,
+                        )
                     if results["type"] == "category":
                         xy = sorted(
                             [(x, y) for x, y in results["values"].items()],
@@ -139,16 +148,19 @@ def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
                     value = value["type"]
 
                 elif value["type"] == "float-group":
-                    results = select_histogram(
-                        DATAGRID,
-                        group_by,
-                        where=where,
-                        column_name=column_name,
-                        column_value=value["columnValue"],
-                        where_description=None,
-                        computed_columns=None,
-                        where_expr=where,
-                    )
+                    if summary is not None:
+                        results = summary
+                    else:
+                        results = select_histogram(
+                            DATAGRID,
+                            group_by,
+                            where=where,
+                            column_name=column_name,
+                            column_value=value["columnValue"],
+                            where_description=None,
+                            computed_columns=None,
+                            where_expr=where,
+                        )
                     if results["type"] == "histogram":
                         # st.write(results)
                         trace = {
@@ -169,23 +181,35 @@ def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
                         linkable = False
 
                 elif value["type"] == "asset-group":
-                    image_data = select_asset_group_thumbnail(
-                        experiment,
-                        experiment.id,
-                        DATAGRID,
-                        group_by,
-                        where=where,
-                        column_name=column_name,
-                        column_value=value["columnValue"],
-                        column_offset=0,
-                        computed_columns=None,
-                        where_expr=where,
-                        gallery_size=[3, 2],
-                        background_color=(255, 255, 255),
-                        image_size=(80, 50),
-                        border_width=1,
-                        distinct=True,
-                    )
+                    if summary is not None:
+                        image_data = build_asset_group_gallery(
+                            experiment,
+                            experiment.id,
+                            DATAGRID,
+                            summary["values"],
+                            gallery_size=[3, 2],
+                            background_color=(255, 255, 255),
+                            image_size=(80, 50),
+                            border_width=1,
+                        )
+                    else:
+                        image_data = select_asset_group_thumbnail(
+                            experiment,
+                            experiment.id,
+                            DATAGRID,
+                            group_by,
+                            where=where,
+                            column_name=column_name,
+                            column_value=value["columnValue"],
+                            column_offset=0,
+                            computed_columns=None,
+                            where_expr=where,
+                            gallery_size=[3, 2],
+                            background_color=(255, 255, 255),
+                            image_size=(80, 50),
+                            border_width=1,
+                            distinct=True,
+                        )
                     data = (
                         f"data:image/png;base64,{base64.b64encode(image_data).decode()}"
                     )
@@ -207,19 +231,13 @@ def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
             # "IMAGE-ASSET", "VIDEO-ASSET", "CURVE-ASSET", "ASSET-ASSET", "AUDIO-ASSET"
             if schema[column_name]["type"] == "IMAGE-ASSET":
 
-                asset_data = experiment_get_asset(
+                result = select_thumbnail(
                     experiment,
                     experiment.id,
+                    DATAGRID,
                     value["assetData"]["asset_id"],
-                    return_type="binary",
-                )
-
-                bytes, image = generate_thumbnail(
-                    asset_data,
                     annotations=value["assetData"].get("annotations"),
-                    return_image=True,
                 )
-                result = image_to_fp(image, "png").read()
                 data = "data:image/png;base64," + base64.b64encode(result).decode(
                     "utf-8"
                 )
@@ -266,15 +284,52 @@ def build_row(DATAGRID, group_by, where, r, row, schema, experiment, config):
     return retval
 
 
+def get_group_summaries(DATAGRID, group_by, where, data):
+    """
+    Summarize all of the grouped cells on this page with
+    one query, rather than one query per cell.
+    """
+    if not group_by:
+        return {}
+
+    group_values = []
+    column_names = []
+    for row in data:
+        for column_name, value in row.items():
+            if isinstance(value, dict) and value["type"] in [
+                "integer-group",
+                "text-group",
+                "float-group",
+                "asset-group",
+            ]:
+                if value["columnValue"] not in group_values:
+                    group_values.append(value["columnValue"])
+                if column_name not in column_names:
+                    column_names.append(column_name)
+
+    if not group_values or not column_names:
+        return {}
+
+    return select_group_summaries(
+        DATAGRID,
+        group_by,
+        group_values,
+        column_names,
+        where_expr=where,
+        column_limit=3 * 2,
+    )
+
+
 def build_table(DATAGRID, group_by, where, data, schema, experiment, table_id, config):
     width = 300 if group_by else 150
     retval = f"""
     <div style="display: block; width: -webkit-fill-available; overflow: auto;">
         <table id="{table_id}" style="width: {len(data[0].keys()) * width}px; border-collapse: collapse; table-layout: fixed;">"""
     retval += build_header_row(data[0].keys(), width)
+    summaries = get_group_summaries(DATAGRID, group_by, where, data)
     for r, row in enumerate(data):
         retval += build_row(
-            DATAGRID, group_by, where, r, row, schema, experiment, config
+            DATAGRID, group_by, where, r, row, schema, experiment, config, summaries
         )
     retval += "</table></div>"
     return retval, len(data[0].keys()) * width
@@ -364,6 +419,7 @@ def render_image_dialog(BASEURL, group_by, value, schema, experiment, config):
             where_expr=value["whereExpr"],
             distinct=True,
         )
+        dgid = value["dgid"]
         data = [json.loads(item.replace("&comma;", ",")) for item in results["values"]]
         if len(data) < 20:
             st.write(
@@ -373,17 +429,14 @@ def render_image_dialog(BASEURL, group_by, value, schema, experiment, config):
             st.write("Loading first 20 images in group; click image to open in tab")
         images = ""
         for i, value in enumerate(data):
-            asset_data = experiment_get_asset(
-                experiment, experiment.id, value["asset_id"], return_type="binary"
-            )
-
-            bytes, image = generate_thumbnail(
-                asset_data,
+            result = select_thumbnail(
+                experiment,
+                experiment.id,
+                dgid,
+                value["asset_id"],
                 annotations=value.get("annotations"),
-                return_image=True,
             )
 
-            result = image_to_fp(image, "png").read()
             image_data = "data:image/png;base64," + base64.b64encode(result).decode(
                 "utf-8"
             )
@@ -434,6 +487,7 @@ def render_image_dialog(BASEURL, group_by, value, schema, experiment, config):
                 image.size[0],
                 image.size[1],
                 includes=labels,
+                asset_id=value["assetData"]["asset_id"],
             )
 
         # columns[1].image(image, use_container_width=True)
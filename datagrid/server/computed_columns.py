@@ -12,10 +12,16 @@
 ######################################################
 
 import ast
+import functools
 import hashlib
+import re
 
 import astor
 
+# Number of translated (computed_columns, where_expr, schema)
+# combinations to keep:
+TRANSLATION_CACHE_SIZE = 256
+
 ## FIXME:
 ## 1. No support for substrings
 ## 2. No support for slices, [:]
@@ -48,6 +54,102 @@ class AttributeNode:
         )
 
 
+def is_reference(arg):
+    """
+    Is arg a column, or a JSON field of one? These are cheap
+    to use more than once in an SQL expression.
+    """
+    if isinstance(arg, AttributeNode):
+        return is_reference(arg.obj)
+    return (
+        isinstance(arg, str)
+        and arg.startswith("{'")
+        and arg.endswith("'}")
+        and arg.count("{") == 1
+    )
+
+
+# SQL for Python functions of a list, used when the value is
+# a JSON array; otherwise, the Python function is called:
+JSON_ARRAY_FUNCTIONS = {
+    "LENGTH": "json_array_length({arg})",
+    "SUM_OF_LIST": (
+        "(SELECT CASE WHEN COUNT(*) = COUNT(CASE WHEN type IN"
+        + " ('integer', 'real', 'true', 'false') THEN 1 END)"
+        + " THEN IFNULL(SUM(value), 0) ELSE {function_name}({arg}) END"
+        + " FROM json_each({arg}))"
+    ),
+    "IN_OBJ": "EXISTS (SELECT 1 FROM json_each({arg}) WHERE value IS {item})",
+}
+
+
+def json_array_function(function_name, arg, item=None):
+    """
+    Use the SQL for function_name(arg) when arg is a JSON array,
+    and the Python function otherwise.
+    """
+    if function_name == "IN_OBJ":
+        function_call = "IN_OBJ({item}, {arg})"
+    else:
+        function_call = "{function_name}({arg})"
+    return json_array_case(
+        arg,
+        JSON_ARRAY_FUNCTIONS[function_name].format(
+            arg=arg, item=item, function_name=function_name
+        ),
+        function_call.format(arg=arg, item=item, function_name=function_name),
+    )
+
+
+def json_array_case(arg, sql, fallback):
+    """
+    Use sql when arg is a JSON array, and fallback otherwise.
+    (Not in parentheses, which would look like a tuple.)
+    """
+    return "CASE WHEN json_valid(%s) AND json_type(%s) = 'array'" % (
+        arg,
+        arg,
+    ) + " THEN %s ELSE %s END" % (sql, fallback)
+
+
+# JSON types that SQL and Python treat alike:
+NUMBER_TYPES = "('integer', 'real', 'true', 'false')"
+SCALAR_TYPES = "('integer', 'real', 'true', 'false', 'text')"
+
+
+def type_category(item_type):
+    """
+    The category of a constant JSON type (a quoted literal):
+    "number", "text", "null", or "other"; or None if item_type
+    is SQL for a type only known per item.
+    """
+    if item_type is None:
+        # Conditions are 0 or 1:
+        return "number"
+    elif not item_type.startswith("'"):
+        return None
+    elif item_type in ["'integer'", "'real'", "'true'", "'false'"]:
+        return "number"
+    elif item_type == "'text'":
+        return "text"
+    elif item_type == "'null'":
+        return "null"
+    return "other"
+
+
+def item_path_type(path):
+    """
+    SQL for the JSON type at path in a list comprehension's
+    item, or NULL if there is nothing there.
+    """
+    if not path:
+        return "item.type"
+    return (
+        "(CASE WHEN item.type IN ('object', 'array') THEN json_type(item.value, '$%s') END)"
+        % path
+    )
+
+
 class Evaluator:
     def __init__(self):
         # Selections keep track of aggregate select clauses
@@ -181,6 +283,12 @@ class Evaluator:
                     "sum": "SUM_OF_LIST",
                     "range": "RANGE",
                 }
+                if (
+                    function_map[function_name] in JSON_ARRAY_FUNCTIONS
+                    and len(args) == 1
+                    and is_reference(args[0])
+                ):
+                    return json_array_function(function_map[function_name], args[0])
                 sargs = ", ".join([str(arg) for arg in args])
                 expr = "{function_name}({sargs})".format(
                     function_name=function_map[function_name],
@@ -430,6 +538,17 @@ class Evaluator:
                     return "KEYS_OF(%s)" % ", ".join([str(function_name.obj)] + args)
                 elif function_name.attr == "values":
                     return "VALUES_OF(%s)" % ", ".join([str(function_name.obj)] + args)
+                elif function_name.attr == "near":
+                    # {"Embedding"}.near(asset_id, k=10)
+                    if len(args) not in [1, 2]:
+                        raise Exception("near() requires an asset_id, and optional k")
+                    # The column's metadata has the assetId, and
+                    # {'name'} is the column's (lowercase) name:
+                    obj = str(function_name.obj)
+                    name = obj[1:-1] if obj.startswith("{") else "NULL"
+                    return "NEAR(%s)" % ", ".join(
+                        ["json_extract(%s, '$.assetId')" % obj, name] + args
+                    )
                 else:
                     raise Exception("unknown method %r" % repr(function_name))
             else:
@@ -453,10 +572,16 @@ class Evaluator:
                 if not (
                     isinstance(comparators[0], str) and comparators[0].startswith("(")
                 ):
+                    if is_reference(comparators[0]):
+                        expr = json_array_function(
+                            "IN_OBJ", comparators[0], item=left
+                        )
+                    else:
+                        expr = "IN_OBJ(%s, %s)" % (left, comparators[0])
                     if ops[0] == " IN ":
-                        return "IN_OBJ(%s, %s)" % (left, comparators[0])
+                        return expr
                     elif ops[0] == " NOT IN ":
-                        return "NOT IN_OBJ(%s, %s)" % (left, comparators[0])
+                        return "NOT %s" % expr
 
             retval = ""
             for op, right in zip(ops, comparators):
@@ -535,15 +660,222 @@ class Evaluator:
             ifs = ",".join(
                 escape(astor.to_source(node).strip()) for node in node.generators[0].ifs
             )
-            return 'ListComprehension("%s", "%s", %s, "%s")' % (
+            expr = 'ListComprehension("%s", "%s", %s, "%s")' % (
                 escape(x),
                 escape(y),
                 json_list,
                 ifs,
             )
+            sql = self.eval_list_comprehension(node, json_list, expr)
+            if sql is not None:
+                # Lists of JSON are done in SQL:
+                return sql
+            return expr
 
         raise TypeError(node)
 
+    def eval_list_comprehension(self, node, json_list, fallback):
+        """
+        Translate a simple list comprehension over json_list into
+        SQL over json_each, or return None if it isn't simple
+        enough (or json_list is an expression). The SQL is only
+        used when json_list is a JSON array whose items have the
+        types that the SQL assumes; otherwise, fallback is.
+        """
+        if len(node.generators) != 1 or not is_reference(json_list):
+            return None
+        generator = node.generators[0]
+        if generator.is_async or not isinstance(generator.target, ast.Name):
+            return None
+
+        target = generator.target.id
+        # Conditions on each item for SQL to do what Python does:
+        self.item_guards = []
+        value = self.eval_item_node(node.elt, target)
+        conditions = [
+            self.eval_item_condition(test, target) for test in generator.ifs
+        ]
+        if value is None or None in conditions:
+            return None
+        value, value_type = value
+
+        # Like ListComprehension, None values are left out, and
+        # the results are formatted the same way:
+        conditions.append("(%s) IS NOT NULL" % value)
+        select = "SELECT LIST_REPR(%s, %s) FROM json_each(%s) AS item WHERE %s" % (
+            value,
+            value_type if value_type is not None else "NULL",
+            json_list,
+            " AND ".join(conditions),
+        )
+        # An empty list has no rows to aggregate:
+        sql = "IFNULL((%s), '[]')" % select
+        if self.item_guards:
+            sql = (
+                "CASE WHEN NOT EXISTS (SELECT 1 FROM json_each(%s) AS item WHERE NOT IFNULL(%s, 0)) THEN %s ELSE %s END"
+                % (json_list, " AND ".join(self.item_guards), sql, fallback)
+            )
+        return json_array_case(json_list, sql, fallback)
+
+    def eval_item_condition(self, node, target):
+        """
+        Translate an if clause of the list comprehension into
+        SQL, or return None if it can't be.
+        """
+        result = self.eval_item_node(node, target)
+        if result is None:
+            return None
+        sql, item_type = result
+        if not self.guard_truth(item_type):
+            return None
+        return sql
+
+    def guard_truth(self, item_type):
+        """
+        Guard a value of item_type used as a condition: SQL and
+        Python only agree on the truth of numbers. Returns False
+        if the value can't be used.
+        """
+        if item_type is None:
+            # A condition already
+            return True
+        category = type_category(item_type)
+        if category == "number":
+            return True
+        elif category is None:
+            self.item_guards.append("%s IN %s" % (item_type, NUMBER_TYPES))
+            return True
+        return False
+
+    def guard_comparison(self, left, op, right):
+        """
+        Guard a comparison of (sql, item_type) operands. Python
+        raises when ordering a number and a string, or None, and
+        doesn't compare JSON text, but SQL does. Returns False
+        if the comparison can't be used.
+        """
+        types = [left[1], right[1]]
+        categories = [type_category(item_type) for item_type in types]
+        if "null" in categories or "other" in categories:
+            return False
+        if isinstance(op, (ast.Eq, ast.NotEq)):
+            for item_type, category in zip(types, categories):
+                if category is None:
+                    self.item_guards.append("%s IN %s" % (item_type, SCALAR_TYPES))
+            return True
+
+        if None not in categories:
+            return categories[0] == categories[1]
+        elif categories[0] is None and categories[1] is None:
+            self.item_guards.append(
+                "((%s IN %s AND %s IN %s) OR (%s = 'text' AND %s = 'text'))"
+                % (types[0], NUMBER_TYPES, types[1], NUMBER_TYPES, types[0], types[1])
+            )
+        else:
+            category = categories[0] or categories[1]
+            item_type = types[0] if categories[0] is None else types[1]
+            self.item_guards.append(
+                "%s IN %s"
+                % (item_type, NUMBER_TYPES if category == "number" else "('text')")
+            )
+        return True
+
+    def eval_item_node(self, node, target):
+        """
+        Translate an expression of the list comprehension's
+        variable target (an item of the JSON list) into SQL, or
+        return None if it can't be.
+
+        Returns (sql, item_type), where item_type is SQL for the
+        JSON type of the value (a quoted literal for constants),
+        or None if the value is a condition (0 or 1).
+        """
+        if isinstance(node, ast.Name):
+            if node.id == target:
+                return "item.value", "item.type"
+        elif isinstance(node, ast.Subscript):
+            # target["key"][0]...
+            paths = []
+            while isinstance(node, ast.Subscript):
+                index = node.slice
+                if isinstance(index, ast.Index):
+                    ## Python 3.8
+                    index = index.value
+                if not isinstance(index, ast.Constant):
+                    return None
+                if isinstance(index.value, str) and re.match(r"^\w+$", index.value):
+                    paths.insert(0, '."%s"' % index.value)
+                elif type(index.value) is int and index.value >= 0:
+                    paths.insert(0, "[%s]" % index.value)
+                else:
+                    return None
+                node = node.value
+            if not (isinstance(node, ast.Name) and node.id == target):
+                return None
+            for position, path in enumerate(paths):
+                if path.startswith("["):
+                    # Python indexes strings too:
+                    self.item_guards.append(
+                        "%s IS NOT 'text'" % item_path_type("".join(paths[:position]))
+                    )
+            path = "".join(paths)
+            # Only JSON objects and arrays have paths:
+            return (
+                "CASE WHEN item.type IN ('object', 'array') THEN json_extract(item.value, '$%s') END"
+                % path,
+                item_path_type(path),
+            )
+        elif isinstance(node, ast.Constant):
+            if node.value is None:
+                return "NULL", "'null'"
+            elif isinstance(node.value, bool):
+                return ("1", "'true'") if node.value else ("0", "'false'")
+            elif isinstance(node.value, int):
+                return repr(node.value), "'integer'"
+            elif isinstance(node.value, float):
+                return repr(node.value), "'real'"
+            elif isinstance(node.value, str) and not set("{}") & set(node.value):
+                return "'%s'" % node.value.replace("'", "''"), "'text'"
+        elif isinstance(node, ast.Compare):
+            operators = {
+                ast.Eq: "=",
+                ast.NotEq: "!=",
+                ast.Lt: "<",
+                ast.LtE: "<=",
+                ast.Gt: ">",
+                ast.GtE: ">=",
+            }
+            operands = [self.eval_item_node(node.left, target)] + [
+                self.eval_item_node(comparator, target)
+                for comparator in node.comparators
+            ]
+            if None in operands or not all(type(op) in operators for op in node.ops):
+                return None
+            for left, op, right in zip(operands, node.ops, operands[1:]):
+                if not self.guard_comparison(left, op, right):
+                    return None
+            return (
+                "("
+                + " AND ".join(
+                    "%s %s %s" % (left[0], operators[type(op)], right[0])
+                    for left, op, right in zip(operands, node.ops, operands[1:])
+                )
+                + ")",
+                None,
+            )
+        elif isinstance(node, ast.BoolOp):
+            values = [self.eval_item_node(value, target) for value in node.values]
+            # Python's and/or return an operand, not a condition:
+            if None in values or any(value[1] is not None for value in values):
+                return None
+            op = " AND " if isinstance(node.op, ast.And) else " OR "
+            return "(" + op.join(value[0] for value in values) + ")", None
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = self.eval_item_node(node.operand, target)
+            if operand is not None and self.guard_truth(operand[1]):
+                return "(NOT %s)" % operand[0], None
+        return None
+
 
 def escape(string):
     s1 = str(string).replace("{'", "__lbrace__").replace("'}", "__rbrace__")
@@ -601,25 +933,39 @@ def eval_computed_columns(computed_columns, where_expr=None):
     )
 
 
-def update_state(
-    computed_columns,
-    metadata,
-    databases,
-    columns,
-    select_expr_as,
-    where_expr=None,
-):
+def freeze_computed_columns(computed_columns):
     """
-    The top-level function to evaluate computed columns and computed
-    expressions.
+    Turn (unified) computed_columns into a hashable tuple.
+    """
+    if not computed_columns:
+        return ()
+    return tuple(
+        (
+            name,
+            str(computed_columns[name]["field_expr"]),
+            computed_columns[name]["field_name"],
+            computed_columns[name]["type"],
+        )
+        for name in computed_columns
+    )
 
-    The side effects are that the fields are added to `metadata`,
-    the needed computed aggregates are added to `databases`,
-    the new computed columns are added to `columns`, and the
-    additional select-as expressions are added to select_expr_as.
 
-    Returns the SQL where clause, if `where_expr` is provided.
+@functools.lru_cache(maxsize=TRANSLATION_CACHE_SIZE)
+def translate(frozen_computed_columns, where_expr, schema):
+    """
+    Translate computed columns and a where expression into SQL,
+    given the schema as a tuple of (column name, field name).
+
+    Results are cached, so the same filter is only parsed once
+    per schema. Returns a tuple of (where_sql, databases,
+    new_columns) where databases are the aggregate sub-selects
+    and new_columns are (column_name, field_expr, type,
+    field_name) tuples, in order.
     """
+    computed_columns = {
+        name: {"field_expr": field_expr, "field_name": field_name, "type": column_type}
+        for (name, field_expr, field_name, column_type) in frozen_computed_columns
+    }
     new_columns, select_map, where_sql = eval_computed_columns(
         computed_columns, where_expr
     )
@@ -634,13 +980,13 @@ def update_state(
         return "'%s'" % name.lower()
 
     columns_to_field_name = {
-        name_to_key(name): metadata[name]["field_name"] for name in metadata
+        name_to_key(name): field_name for (name, field_name) in schema
     }
     columns_to_field_name.update(
         {name_to_key(name): new_columns[name]["field_name"] for name in new_columns}
     )
     columns_to_field_expr = {
-        name_to_key(name): metadata[name]["field_name"] for name in metadata
+        name_to_key(name): field_name for (name, field_name) in schema
     }
     columns_to_field_expr.update(
         {name_to_key(name): new_columns[name]["field_expr"] for name in new_columns}
@@ -650,6 +996,7 @@ def update_state(
         where_sql = where_sql.format(**columns_to_field_name)
 
     ## Database views to select from:
+    databases = []
     for select_name in select_map:
         select_expr = select_map[select_name]
         database = "(SELECT rowid, %s AS %s FROM datagrid)" % (
@@ -659,7 +1006,8 @@ def update_state(
         database = database.format(**columns_to_field_expr)
         databases.append(database)
 
-    ## Add to metadata, columns and add to select_expr_as:
+    ## Computed columns, in order:
+    columns = []
     for column_name in new_columns:
         field_expr = new_columns[column_name]["field_expr"].format(
             **columns_to_field_name
@@ -670,6 +1018,39 @@ def update_state(
         ## names should replace {"prev column"} with prev column
         ## expr_field:
         columns_to_field_name[name_to_key(column_name)] = field_expr
+        columns.append((column_name, field_expr, field_type, field_name))
+
+    return where_sql, tuple(databases), tuple(columns)
+
+
+def update_state(
+    computed_columns,
+    metadata,
+    databases,
+    columns,
+    select_expr_as,
+    where_expr=None,
+):
+    """
+    The top-level function to evaluate computed columns and computed
+    expressions.
+
+    The side effects are that the fields are added to `metadata`,
+    the needed computed aggregates are added to `databases`,
+    the new computed columns are added to `columns`, and the
+    additional select-as expressions are added to select_expr_as.
+
+    Returns the SQL where clause, if `where_expr` is provided.
+    """
+    schema = tuple((name, metadata[name]["field_name"]) for name in metadata)
+    where_sql, new_databases, new_columns = translate(
+        freeze_computed_columns(computed_columns), where_expr, schema
+    )
+
+    databases.extend(new_databases)
+
+    ## Add to metadata, columns and add to select_expr_as:
+    for column_name, field_expr, field_type, field_name in new_columns:
         columns.append(column_name)
         metadata[column_name] = {
             "field_expr": field_expr,
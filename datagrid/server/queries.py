@@ -11,20 +11,28 @@
 #    All rights reserved                             #
 ######################################################
 
+import array
 import ast
+import base64
+import functools
 import io
 import json
 import logging
 import math
 import os
+import pickle
+import queue
 import re
 import sqlite3
 import statistics
 import inspect
 import string
+import threading
 import time
 import urllib
-from collections import Counter, defaultdict
+from collections import ChainMap, defaultdict
+from types import MappingProxyType
+from urllib.request import pathname2url
 
 import numpy as np
 import PIL.Image
@@ -35,21 +43,49 @@ try:
 except ImportError:
     st = None
 
+from .._datatypes import embedding
+from .._datatypes.sketches import QuantileSketch
 from .._datatypes.utils import (
+    create_table_index,
     generate_thumbnail,
     get_color,
+    has_table,
     image_to_fp,
     is_nan,
     pytype_to_dgtype,
     experiment_get_asset,
 )
 from .computed_columns import unify_computed_columns, update_state
-from .utils import Cache, process_about, safe_compile, safe_env
+from .utils import (
+    Cache,
+    RestrictedUnpickler,
+    hash_arguments,
+    process_about,
+    safe_compile,
+    safe_env,
+)
 
 LOGGER = logging.getLogger(__name__)
 KANGAS_ROOT = os.environ.get("KANGAS_ROOT", ".")
+# Index the columns that pages are sorted and grouped by:
+AUTO_INDEX = os.environ.get("KANGAS_AUTO_INDEX", "false").lower() in [
+    "1",
+    "true",
+    "yes",
+]
 MAX_CATEGORIES = 20
 HISTOGRAM_BINS = 10
+# Larger groups are summarized as they stream by, with sketches:
+HISTOGRAM_SKETCH_SIZE = 100000
+# Number of parsed list and dict values to keep, for the Python
+# functions:
+PARSED_VALUE_CACHE_SIZE = 10000
+# Number of compiled list comprehensions to keep:
+COMPILED_CODE_CACHE_SIZE = 256
+# Number of nearest-neighbor searches to keep, per connection:
+NEAREST_CACHE_SIZE = 100
+
+LIST_COMPREHENSION_LOCAL = threading.local()
 
 CUSTOM_CODE_INIT = """
 import matplotlib.pyplot as plt
@@ -63,31 +99,143 @@ import math
 
 VALID_CHARS = string.ascii_letters + string.digits + "_"
 
-PROJECTION_TRACE_CACHE = Cache(100)
-
-if st is None or not st.runtime.exists():
-    class st:
-        CACHE = {}
-
-        @classmethod
-        def cache_data(cls, persist=None):
-            def decorator(f):
-                def wrapper(*args, **kwargs):
-                    # if you want arguments names as a list:
-                    signature = inspect.signature(f)
-                    bindings = signature.bind(*args, **kwargs)
-                    arguments = bindings.arguments
-                    key = tuple(
-                        [f.__name__]
-                        + [v for k, v in arguments.items() if not k.startswith("_")]
+# Applied to every pooled, read-only query connection:
+SQLITE_PRAGMAS = {
+    "query_only": 1,
+    "mmap_size": 268435456,  # 256 MB
+    "cache_size": -65536,  # 64 MB
+    "temp_store": "MEMORY",
+}
+
+# Projection traces can be several MB each:
+PROJECTION_TRACE_CACHE = Cache(100, max_bytes=256 * 1024 * 1024)
+# Maps (db_path, signature, group_by, where, computed columns) to count:
+QUERY_COUNT_CACHE = Cache(100)
+
+# Maps db_path to (signature, metadata snapshot):
+METADATA_CACHE = {}
+# (db_path, field_name) of columns already auto-indexed:
+AUTO_INDEXED = set()
+# Maps (db_path, field_name) to the (signature, time) of a failed
+# auto-index, which is retried once the datagrid changes, or after
+# AUTO_INDEX_RETRY_SECONDS:
+AUTO_INDEX_FAILED = {}
+AUTO_INDEX_RETRY_SECONDS = 600
+# Seconds to wait for a datagrid's write lock, when auto-indexing:
+AUTO_INDEX_TIMEOUT = 0.5
+# Maps (db_path, signature after an auto-index) to the signature
+# before it, as an index doesn't change the data:
+AUTO_INDEX_SIGNATURES = {}
+
+# Maps a hash of (function name, arguments, datagrid signature) to
+# the result, for query functions when Streamlit isn't running:
+QUERY_RESULT_CACHE = Cache(1000, max_bytes=256 * 1024 * 1024)
+# Optional directory to also keep results of persist="disk" functions:
+QUERY_CACHE_DIR = os.environ.get("KANGAS_CACHE_DIR")
+QUERY_CACHE_DIR_BYTES = 1024 * 1024 * 1024
+# The (module, name) globals allowed in the results there; they
+# are bytes, str, numbers, lists and dicts, which need none:
+QUERY_CACHE_SAFE = set()
+NOT_CACHED = object()
+
+
+def cache_data(persist=None):
+    """
+    Decorator to cache a query function's results, using
+    st.cache_data when Streamlit is running, and query_cache()
+    otherwise.
+    """
+    if st is not None and st.runtime.exists():
+        return st.cache_data(persist=persist)
+    return query_cache(persist=persist)
+
+
+def query_cache(persist=None):
+    """
+    Decorator to cache a query function's results in
+    QUERY_RESULT_CACHE, keyed by a hash of its arguments (except
+    those starting with "_"). Results for a dgid are invalidated
+    when the datagrid file changes. If persist is "disk" and
+    QUERY_CACHE_DIR is set, results are also kept there.
+    """
+
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            bindings = signature.bind(*args, **kwargs)
+            bindings.apply_defaults()
+            arguments = {
+                name: value
+                for name, value in bindings.arguments.items()
+                if not name.startswith("_")
+            }
+            if "dgid" in arguments:
+                try:
+                    arguments["dgid signature"] = get_dg_signature(
+                        get_dg_path(arguments["dgid"])
                     )
-                    if key not in st.CACHE:
-                        st.CACHE[key] = f(*args, **kwargs)
-                    return st.CACHE[key]
+                except OSError:
+                    pass
+            key = hash_arguments(f.__name__, arguments)
+
+            value = QUERY_RESULT_CACHE.get(key, NOT_CACHED)
+            if value is NOT_CACHED:
+                use_disk = persist == "disk" and QUERY_CACHE_DIR
+                if use_disk:
+                    value = read_cache_file(key)
+                if value is NOT_CACHED:
+                    value = f(*args, **kwargs)
+                    if use_disk:
+                        write_cache_file(key, value)
+                QUERY_RESULT_CACHE.put(key, value)
+            return value
 
-                return wrapper
+        return wrapper
 
-            return decorator
+    return decorator
+
+
+def read_cache_file(key):
+    """
+    Read a result from QUERY_CACHE_DIR, or return NOT_CACHED.
+    """
+    filename = os.path.join(QUERY_CACHE_DIR, key + ".pickle")
+    try:
+        with open(filename, "rb") as fp:
+            return RestrictedUnpickler(QUERY_CACHE_SAFE, fp).load()
+    except Exception:
+        return NOT_CACHED
+
+
+def write_cache_file(key, value):
+    """
+    Write a result to QUERY_CACHE_DIR, removing the oldest
+    results if the directory is over QUERY_CACHE_DIR_BYTES.
+    """
+    filename = os.path.join(QUERY_CACHE_DIR, key + ".pickle")
+    try:
+        os.makedirs(QUERY_CACHE_DIR, exist_ok=True)
+        temp_filename = "%s.%s.tmp" % (filename, threading.get_ident())
+        with open(temp_filename, "wb") as fp:
+            pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, filename)
+
+        entries = [
+            entry
+            for entry in os.scandir(QUERY_CACHE_DIR)
+            if entry.name.endswith(".pickle")
+        ]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= QUERY_CACHE_DIR_BYTES:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+    except Exception:
+        LOGGER.debug("unable to write cache file %r", filename)
 
 
 def sqlite_query_explain(
@@ -336,12 +484,162 @@ class StdevFunc:
         return math.sqrt(self.S / (self.k - 1))  # To use MySQL version, change to k-2
 
 
+class ListReprFunc:
+    """
+    LIST_REPR(value, type)
+
+    Collects the results of a list comprehension done in SQL,
+    and formats them the way ListComprehension() does. type is
+    the JSON type of value, as objects and arrays are passed as
+    JSON text.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def step(self, value, value_type):
+        if value_type in ["object", "array"]:
+            value = json.loads(value)
+        self.results.append(process_results(value))
+
+    def finalize(self):
+        return "[" + (",".join(self.results)) + "]"
+
+
+class HistogramFunc:
+    """
+    HISTOGRAM(value, minimum, maximum)
+
+    Collects a group's numbers into a compact float buffer, and
+    returns only the histogram bins and statistics, as JSON.
+    Groups larger than HISTOGRAM_SKETCH_SIZE (with a known
+    range) are binned and summed a buffer at a time, with
+    approximate quantiles from a QuantileSketch.
+    """
+
+    def __init__(self):
+        self.values = array.array("d")
+        self.minimum = None
+        self.maximum = None
+        self.sketch = None
+
+    def step(self, value, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        if value is not None:
+            try:
+                self.values.append(float(value))
+            except Exception:
+                pass
+            if (
+                len(self.values) >= HISTOGRAM_SKETCH_SIZE
+                and minimum is not None
+                and maximum is not None
+            ):
+                self.summarize_buffer()
+
+    def get_buffer(self):
+        np_values = np.frombuffer(self.values, dtype=np.float64)
+        return np_values[~np.isnan(np_values)]
+
+    def summarize_buffer(self):
+        np_values = self.get_buffer()
+        if self.sketch is None:
+            self.sketch = QuantileSketch()
+            self.bins = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+            self.count = 0
+            self.total = 0.0
+            self.shift = np_values[0].item() if len(np_values) > 0 else 0.0
+            self.shifted_total = 0.0
+            self.shifted_squares = 0.0
+            self.smallest = math.inf
+            self.largest = -math.inf
+        if len(np_values) > 0:
+            self.bins += np.histogram(
+                np_values, bins=HISTOGRAM_BINS, range=(self.minimum, self.maximum)
+            )[0]
+            shifted = np_values - self.shift
+            self.count += len(np_values)
+            self.total += np_values.sum().item()
+            self.shifted_total += shifted.sum().item()
+            self.shifted_squares += (shifted * shifted).sum().item()
+            self.smallest = min(self.smallest, np_values.min().item())
+            self.largest = max(self.largest, np_values.max().item())
+            self.sketch.update(np_values.tolist())
+        self.values = array.array("d")
+
+    def finalize(self):
+        if self.sketch is None:
+            return json.dumps(
+                histogram_summary(self.get_buffer(), self.minimum, self.maximum)
+            )
+
+        self.summarize_buffer()
+        if self.count < 2:
+            # Only NaNs were streamed:
+            return json.dumps(
+                histogram_summary(
+                    np.concatenate(self.sketch.levels), self.minimum, self.maximum
+                )
+            )
+        squares = self.shifted_total * self.shifted_total / self.count
+        variance = max((self.shifted_squares - squares) / (self.count - 1), 0.0)
+        quantiles = self.sketch.quantiles([0.25, 0.50, 0.75])
+        return json.dumps(
+            {
+                "bins": self.bins.tolist(),
+                "labels": np.histogram_bin_edges(
+                    [], bins=HISTOGRAM_BINS, range=(self.minimum, self.maximum)
+                ).tolist(),
+                "min": self.minimum,
+                "max": self.maximum,
+                "statistics": {
+                    "count": self.count,
+                    "min": self.smallest,
+                    "max": self.largest,
+                    "mean": self.total / self.count,
+                    "median": quantiles[1],
+                    "std": math.sqrt(variance),
+                    "25%": quantiles[0],
+                    "50%": quantiles[1],
+                    "75%": quantiles[2],
+                    "sum": self.total,
+                },
+            }
+        )
+
+
+UNPARSEABLE = object()
+
+
+@functools.lru_cache(maxsize=PARSED_VALUE_CACHE_SIZE)
+def _parse_value(string):
+    try:
+        return json.loads(string)
+    except Exception:
+        pass
+    try:
+        return ast.literal_eval(string)
+    except Exception:
+        return UNPARSEABLE
+
+
+def parse_value(string):
+    """
+    Parse a stored value, as JSON or else as a Python literal.
+    Recently parsed values are memoized (don't mutate them).
+    Raises ValueError if it can't be parsed.
+    """
+    value = _parse_value(string)
+    if value is UNPARSEABLE:
+        raise ValueError("unable to parse %r" % (string,))
+    return value
+
+
 def FLATTEN(lists):
     if lists:
         try:
-            return str(
-                [item for sublist in ast.literal_eval(lists) for item in sublist]
-            )
+            return str([item for sublist in parse_value(lists) for item in sublist])
         except Exception:
             pass
 
@@ -358,7 +656,7 @@ def SPLIT(string, delim=None, maxsplit=-1):
 def KEYS_OF(obj):
     if obj:
         try:
-            return str(list(ast.literal_eval(obj).keys()))
+            return str(list(parse_value(obj).keys()))
         except Exception:
             pass
 
@@ -368,7 +666,7 @@ def KEYS_OF(obj):
 def VALUES_OF(obj):
     if obj:
         try:
-            return str(list(ast.literal_eval(obj).values()))
+            return str(list(parse_value(obj).values()))
         except Exception:
             pass
 
@@ -379,7 +677,7 @@ def LENGTH(string_or_obj):
     ## Comes in as a string, but might be "[...]"
     if string_or_obj:
         try:
-            return len(ast.literal_eval(string_or_obj))
+            return len(parse_value(string_or_obj))
         except Exception:
             return len(string_or_obj)
     return 0
@@ -401,7 +699,7 @@ def SUM_OF_LIST(string_or_obj):
     ## Comes in as a string, but might be "[...]"
     if string_or_obj:
         try:
-            return sum(ast.literal_eval(string_or_obj))
+            return sum(parse_value(string_or_obj))
         except Exception:
             return sum(string_or_obj)
     return 0
@@ -411,7 +709,7 @@ def MEAN(string_or_obj):
     ## Comes in as a string, but might be "[...]"
     if string_or_obj:
         try:
-            return statistics.mean(ast.literal_eval(string_or_obj))
+            return statistics.mean(parse_value(string_or_obj))
         except Exception:
             return statistics.mean(string_or_obj)
     return 0
@@ -420,7 +718,7 @@ def MEAN(string_or_obj):
 def IN_OBJ(item, string_or_obj):
     if string_or_obj:
         try:
-            return item in list(ast.literal_eval(string_or_obj))
+            return item in list(parse_value(string_or_obj))
         except Exception:
             return item in string_or_obj
     return False
@@ -429,7 +727,7 @@ def IN_OBJ(item, string_or_obj):
 def ANY_IN_GROUP(group):
     if group:
         try:
-            decoded_group = ast.literal_eval(group)
+            decoded_group = parse_value(group)
         except Exception:
             decoded_group = None
         if isinstance(decoded_group, list):
@@ -445,7 +743,7 @@ def ALL_IN_GROUP(group):
     ## is empty
     if group:
         try:
-            decoded_group = ast.literal_eval(group)
+            decoded_group = parse_value(group)
         except Exception:
             decoded_group = None
         if isinstance(decoded_group, list):
@@ -472,14 +770,39 @@ def unescape(string):
         return ""
 
 
+@functools.lru_cache(maxsize=COMPILED_CODE_CACHE_SIZE)
+def compile_list_comprehension(x, ifs):
+    """
+    Compile the (escaped) expression and if clauses of a list
+    comprehension. Returns (code, compiled_ifs).
+    """
+    code = safe_compile(unescape(x))
+    if ifs:
+        decoded_ifs = [unescape(exp) for exp in ifs.split(",")]
+    else:
+        decoded_ifs = []
+    compiled_ifs = tuple(safe_compile(exp) for exp in decoded_ifs)
+    return code, compiled_ifs
+
+
+def get_list_comprehension_env():
+    """
+    Get this thread's environment for evaluating list
+    comprehensions.
+    """
+    if not hasattr(LIST_COMPREHENSION_LOCAL, "env"):
+        LIST_COMPREHENSION_LOCAL.env = safe_env()
+    return LIST_COMPREHENSION_LOCAL.env
+
+
 def ListComprehension(x, y, gen, ifs):
     ## [x for y in gen ifs]
     results = []
     gen = unescape(gen)
     if gen:
-        x, y = unescape(x), unescape(y)
-        code = safe_compile(x)
-        env = safe_env()
+        y = unescape(y)
+        code, compiled_ifs = compile_list_comprehension(x, ifs)
+        env = get_list_comprehension_env()
         try:
             ## FIXME: a string that is a number is json-like
             decoded_gen = json.loads(gen)
@@ -490,50 +813,81 @@ def ListComprehension(x, y, gen, ifs):
             except Exception:
                 decoded_gen = gen
 
-        ## first, we prepare ifs:
-        if ifs:
-            decoded_ifs = [unescape(exp) for exp in ifs.split(",")]
-        else:
-            decoded_ifs = []
-        compiled_ifs = [safe_compile(exp) for exp in decoded_ifs]
-
-        # dict:
-        if isinstance(decoded_gen, dict):
-            env[y] = decoded_gen
+        try:
+            # dict:
+            if isinstance(decoded_gen, dict):
+                env[y] = decoded_gen
 
-            # Short circuit logic:
-            doit = all(eval(exp, env) for exp in compiled_ifs)
+                # Short circuit logic:
+                doit = all(eval(exp, env) for exp in compiled_ifs)
 
-            if doit:
-                try:
-                    result = eval(code, env)
-                except Exception:
-                    result = None
-                if result is not None:
-                    results.append(process_results(result))
-        else:
-            # List of dicts:
-            for row in decoded_gen:
-                # so that item.key will be found:
-                env[y] = row
+                if doit:
+                    try:
+                        result = eval(code, env)
+                    except Exception:
+                        result = None
+                    if result is not None:
+                        results.append(process_results(result))
+            else:
+                # List of dicts:
+                for row in decoded_gen:
+                    # so that item.key will be found:
+                    env[y] = row
 
-                doit = all([eval(exp, env) for exp in compiled_ifs])
+                    doit = all([eval(exp, env) for exp in compiled_ifs])
 
-                if not doit:
-                    continue
+                    if not doit:
+                        continue
 
-                try:
-                    result = eval(code, env)
-                except Exception:
-                    result = None
-                if result is not None:
-                    results.append(process_results(result))
+                    try:
+                        result = eval(code, env)
+                    except Exception:
+                        result = None
+                    if result is not None:
+                        results.append(process_results(result))
+        finally:
+            # The environment is reused by the next call:
+            env.pop(y, None)
     retval = "[" + (",".join(results)) + "]"
     return retval
 
 
+def make_near_function(conn):
+    """
+    Make the NEAR(value, name, asset_id, k=10) function of a
+    connection: is value one of the k embeddings nearest to
+    asset_id, in the column name (any case, or NULL for
+    asset_id's column)? Each search is done once per
+    connection.
+    """
+
+    @functools.lru_cache(maxsize=NEAREST_CACHE_SIZE)
+    def nearest_asset_ids(name, asset_id, k):
+        if name is not None:
+            row = conn.execute(
+                "SELECT name FROM nearest_centroids WHERE lower(name) = ?;",
+                [name.lower()],
+            ).fetchone()
+            if row is None:
+                raise Exception("no nearest-neighbor index for column %r" % name)
+            name = row[0]
+        return frozenset(
+            nearest_asset_id
+            for nearest_asset_id, distance in embedding.nearest(
+                conn, asset_id, k, name=name
+            )
+        )
+
+    def NEAR(value, name, asset_id, k=10):
+        return value in nearest_asset_ids(name, asset_id, int(k))
+
+    return NEAR
+
+
 def add_python_functions(conn):
     conn.create_aggregate("STDEV", 1, StdevFunc)
+    conn.create_aggregate("HISTOGRAM", 3, HistogramFunc)
+    conn.create_aggregate("LIST_REPR", 2, ListReprFunc)
     conn.create_function("ANY_IN_GROUP", 1, ANY_IN_GROUP)
     conn.create_function("ALL_IN_GROUP", 1, ALL_IN_GROUP)
     conn.create_function("FLATTEN", 1, FLATTEN)
@@ -546,20 +900,250 @@ def add_python_functions(conn):
     conn.create_function("VALUES_OF", 1, VALUES_OF)
     conn.create_function("IN_OBJ", 2, IN_OBJ)
     conn.create_function("ListComprehension", 4, ListComprehension)
+    conn.create_function("NEAR", -1, make_near_function(conn))
+
+
+def _get_file_signature(db_path):
+    stat = os.stat(db_path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_dg_signature(db_path):
+    """
+    Get a value that changes whenever the datagrid file is
+    modified, or replaced by a new file (but not when it is
+    just auto-indexed).
+    """
+    signature = _get_file_signature(db_path)
+    return AUTO_INDEX_SIGNATURES.get((db_path, signature), signature)
+
+
+class ConnectionPool:
+    """
+    Per-thread, read-only SQLite connections, keyed by the
+    datagrid path and its signature. A connection is opened (and
+    the Python functions registered) once per thread, and reopened
+    only when the datagrid file changes on disk.
+    """
+
+    def __init__(self, pragmas=None):
+        self.pragmas = pragmas if pragmas is not None else SQLITE_PRAGMAS
+        self._local = threading.local()
+
+    def _get_connections(self):
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        return self._local.connections
+
+    def connect(self, db_path):
+        uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(db_path))
+        conn = sqlite3.connect(uri, uri=True)
+        for name, value in self.pragmas.items():
+            conn.execute("PRAGMA %s = %s;" % (name, value))
+        add_python_functions(conn)
+        return conn
+
+    def get(self, db_path):
+        signature = get_dg_signature(db_path)
+        connections = self._get_connections()
+        if db_path in connections:
+            conn, conn_signature = connections[db_path]
+            if conn_signature == signature:
+                return conn
+            # The file has changed; don't reuse:
+            conn.close()
+
+        conn = self.connect(db_path)
+        connections[db_path] = (conn, signature)
+        return conn
+
+    def clear(self):
+        """
+        Close this thread's connections.
+        """
+        connections = self._get_connections()
+        for conn, signature in connections.values():
+            conn.close()
+        connections.clear()
+
+
+CONNECTION_POOL = ConnectionPool()
 
 
 def get_database_connection(dgid):
+    """
+    Get a pooled, read-only connection to the datagrid for
+    the current thread. Don't close it.
+    """
     db_path = get_dg_path(dgid)
-    conn = sqlite3.connect(db_path)
-    add_python_functions(conn)
-    return conn
+    return CONNECTION_POOL.get(db_path)
 
 
-def get_completions(dgid, computed_columns):
+class ThumbnailStore:
+    """
+    Thumbnails of a datagrid's assets, in any size, kept in a
+    sidecar SQLite file next to the datagrid, so that writing
+    them doesn't change the datagrid itself. Thumbnails are
+    written by a background thread.
+    """
+
+    def __init__(self, db_path):
+        self.path = db_path + ".thumbnails"
+        self.disabled = False
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS thumbnails (asset_id TEXT, size TEXT, annotations TEXT, thumbnail BLOB, PRIMARY KEY (asset_id, size, annotations));"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, asset_id, size, annotations):
+        """
+        Get a thumbnail, or None if there isn't one (yet).
+        """
+        if self.disabled:
+            return None
+        try:
+            row = (
+                self.connect()
+                .execute(
+                    "SELECT thumbnail FROM thumbnails WHERE asset_id = ? AND size = ? AND annotations = ?;",
+                    [asset_id, size, annotations],
+                )
+                .fetchone()
+            )
+        except sqlite3.Error:
+            LOGGER.debug("unable to read thumbnails from %r", self.path)
+            self.disabled = True
+            return None
+        return row[0] if row else None
+
+    def put(self, asset_id, size, annotations, thumbnail):
+        """
+        Queue a thumbnail to be written in the background.
+        """
+        if self.disabled:
+            return
+        self.queue.put((asset_id, size, annotations, thumbnail))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write, daemon=True)
+                self.thread.start()
+
+    def write(self):
+        while True:
+            rows = [self.queue.get()]
+            while not self.queue.empty() and len(rows) < 100:
+                rows.append(self.queue.get())
+            try:
+                conn = self.connect()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO thumbnails (asset_id, size, annotations, thumbnail) VALUES (?, ?, ?, ?);",
+                    rows,
+                )
+                conn.commit()
+            except sqlite3.Error:
+                LOGGER.debug("unable to write thumbnails to %r", self.path)
+                self.disabled = True
+
+
+# Maps db_path to its ThumbnailStore:
+THUMBNAIL_STORES = {}
+THUMBNAIL_STORES_LOCK = threading.Lock()
+
+
+def get_thumbnail_store(dgid):
     db_path = get_dg_path(dgid)
-    conn = sqlite3.connect(db_path)
+    with THUMBNAIL_STORES_LOCK:
+        if db_path not in THUMBNAIL_STORES:
+            THUMBNAIL_STORES[db_path] = ThumbnailStore(db_path)
+        return THUMBNAIL_STORES[db_path]
+
+
+def get_thumbnail_annotations(asset_metadata):
+    """
+    Get the annotations drawn on the thumbnail made when an
+    asset was logged (those in its metadata), or None.
+    """
+    metadata = json.loads(asset_metadata) if asset_metadata else {}
+    annotations = metadata.get("annotations")
+    if isinstance(annotations, str):
+        annotations = json.loads(annotations)
+    return annotations or None
+
+
+def select_thumbnail(
+    _experiment,
+    experiment_id,
+    dgid,
+    asset_id,
+    annotations=None,
+    size=None,
+    return_image=False,
+):
+    """
+    Get the PNG thumbnail of an asset (or a PIL image, if
+    return_image). size is None for the default thumbnail, or
+    a (width, height) to fit it in.
+
+    The thumbnail made when the asset was logged is used if
+    there is one, and it has the same annotations drawn on it;
+    otherwise, it is made (once) from the asset, and kept in the
+    datagrid's ThumbnailStore.
+    """
+    thumbnail = None
+    if size is None:
+        try:
+            row = (
+                get_database_connection(dgid)
+                .execute(
+                    "SELECT asset_thumbnail, asset_metadata FROM assets WHERE asset_id = ?;",
+                    [asset_id],
+                )
+                .fetchone()
+            )
+        except sqlite3.Error:
+            row = None
+        if row and row[0]:
+            if get_thumbnail_annotations(row[1]) == (annotations or None):
+                thumbnail = row[0]
+
+    if thumbnail is None:
+        store = get_thumbnail_store(dgid)
+        size_key = "%sx%s" % tuple(size) if size else ""
+        annotations_key = json.dumps(annotations, sort_keys=True) if annotations else ""
+        thumbnail = store.get(asset_id, size_key, annotations_key)
+        if thumbnail is None:
+            asset_data = experiment_get_asset(
+                _experiment, experiment_id, asset_id, return_type="binary"
+            )
+            thumbnail = generate_thumbnail(
+                asset_data,
+                size=size,
+                force=size is not None,
+                annotations=annotations,
+                asset_id=asset_id,
+            )
+            store.put(asset_id, size_key, annotations_key, thumbnail)
+
+    if return_image:
+        return PIL.Image.open(io.BytesIO(thumbnail))
+    return thumbnail
+
+
+def get_completions(dgid, computed_columns):
     unify_computed_columns(computed_columns)
-    rows = conn.execute("SELECT name, other, type from metadata;").fetchall()
+    metadata = get_cached_metadata(dgid)
+    rows = [(name, value["other"], value["type"]) for name, value in metadata.items()]
     if computed_columns:
         rows.extend(
             [(key, None, computed_columns[key]["type"]) for key in computed_columns]
@@ -666,11 +1250,6 @@ def get_completions(dgid, computed_columns):
             if datatype == "TEXT":
                 results['{"%s"}.' % (name,)].update(string_methods)
         else:
-            try:
-                other = json.loads(other)
-            except Exception:
-                continue
-
             results["["].add('[x for x in {"%s"}]' % name)
             if "completions" in other:
                 for comp in other["completions"].keys():
@@ -754,6 +1333,84 @@ def _get_metadata(conn):
     }
 
 
+def get_cached_metadata(dgid):
+    """
+    Get the metadata for all columns of a datagrid, parsed once
+    per version of the datagrid file.
+
+    Returns a read-only snapshot shared between queries and
+    threads; don't mutate it (or its "other" values). Use
+    get_dg_metadata() to get a per-query copy.
+    """
+    db_path = get_dg_path(dgid)
+    signature = get_dg_signature(db_path)
+    cached = METADATA_CACHE.get(db_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    conn = get_database_connection(dgid)
+    metadata = get_metadata(conn)
+    snapshot = MappingProxyType(
+        {name: MappingProxyType(value) for name, value in metadata.items()}
+    )
+    METADATA_CACHE[db_path] = (signature, snapshot)
+    return snapshot
+
+
+def auto_index(dgid, field_name):
+    """
+    If AUTO_INDEX is set, index a field of the datagrid table,
+    once. Computed columns can't be indexed. A failed index is
+    retried once the datagrid changes, or after a while.
+
+    The datagrid keeps its signature, so that the cached
+    results of queries stay valid.
+    """
+    if not AUTO_INDEX or not re.match(r"^column_\d+$", field_name):
+        return
+
+    db_path = get_dg_path(dgid)
+    if (db_path, field_name) in AUTO_INDEXED:
+        return
+
+    signature = get_dg_signature(db_path)
+    failed = AUTO_INDEX_FAILED.get((db_path, field_name))
+    if failed is not None:
+        failed_signature, failed_time = failed
+        if (
+            failed_signature == signature
+            and time.time() - failed_time < AUTO_INDEX_RETRY_SECONDS
+        ):
+            return
+
+    try:
+        conn = sqlite3.connect(db_path, timeout=AUTO_INDEX_TIMEOUT)
+        try:
+            # Lock, so that other changes aren't mistaken for the index's:
+            conn.execute("BEGIN IMMEDIATE;")
+            signature = get_dg_signature(db_path)
+            create_table_index(conn, "datagrid", field_name)
+            AUTO_INDEX_SIGNATURES[(db_path, _get_file_signature(db_path))] = signature
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        LOGGER.debug("unable to index %r: %s", field_name, exc)
+        AUTO_INDEX_FAILED[(db_path, field_name)] = (signature, time.time())
+        return
+
+    AUTO_INDEX_FAILED.pop((db_path, field_name), None)
+    AUTO_INDEXED.add((db_path, field_name))
+
+
+def get_dg_metadata(dgid):
+    """
+    Get the metadata for a single query. Additions, such as
+    those made by update_state() for computed columns, go into
+    this query's overlay, leaving the cached snapshot untouched.
+    """
+    return ChainMap({}, get_cached_metadata(dgid))
+
+
 def plural(count, noun):
     if noun.endswith("'"):
         nouns = noun
@@ -768,10 +1425,14 @@ def plural(count, noun):
     return "%s %s" % (count, nouns)
 
 
-def category(cur, metadata, counts, column):
+def category(cur, metadata, counts, column, distinct_values=None):
     """
     Given counts = {"Animal": 37, "Plant": 12}
     add in those categories not listed
+
+    distinct_values is an optional dict, mapping column to
+    its distinct values, used to share that query between
+    many groups.
     """
     if column in metadata:
         if metadata[column]["type"] == "INTEGER":
@@ -782,9 +1443,19 @@ def category(cur, metadata, counts, column):
                 zeros.update(counts)
                 return zeros
         elif metadata[column]["type"] == "TEXT":
-            field_name = metadata[column]["field_name"]
-            cur.execute(f"SELECT DISTINCT {field_name} from datagrid;")
-            all_values = [text[0] for text in cur.fetchall()]
+            other = metadata[column].get("other") or {}
+            if other.get("count_unique", 0) > 2 * MAX_CATEGORIES:
+                # The sketched distinct count shows there are too
+                # many values to list them all:
+                return counts
+            if distinct_values is not None and column in distinct_values:
+                all_values = distinct_values[column]
+            else:
+                field_name = metadata[column]["field_name"]
+                cur.execute(f"SELECT DISTINCT {field_name} from datagrid;")
+                all_values = [text[0] for text in cur.fetchall()]
+                if distinct_values is not None:
+                    distinct_values[column] = all_values
             if len(all_values) <= MAX_CATEGORIES:
                 zeros = {key: 0 for key in all_values}
                 zeros.update(counts)
@@ -793,7 +1464,25 @@ def category(cur, metadata, counts, column):
     return counts
 
 
-def histogram(cur, metadata, values, column):
+def get_histogram_range(metadata, column):
+    """
+    Get the pre-computed (minimum, maximum) of a column, or
+    (None, None) if the column doesn't have stats.
+    """
+    stats = metadata[column]
+    if "minimum" not in stats or stats["minimum"] is None:
+        LOGGER.debug(
+            "column %r does not have pre-computed stats; computing on the fly", column
+        )
+        return None, None
+    return stats["minimum"], stats["maximum"]
+
+
+def histogram_summary(np_values, minimum=None, maximum=None):
+    """
+    Bin the values, and compute their statistics. If
+    minimum or maximum is None, use the range of the values.
+    """
     statistics = {
         "count": 0,
         "min": 0,
@@ -807,51 +1496,19 @@ def histogram(cur, metadata, values, column):
         ## "count (NaN)": 0,
         "sum": 0,
     }
-    stats = metadata[column]
-    column_type = stats["type"]
-    name = stats.get("name", column)
-
-    if values:
-        np_values = np.array(values, dtype=np.float64)
-        np_values = np_values[~np.isnan(np_values)]
-    else:
-        # How can this happen? The field changed
-        # probably using random.random()
-        np_values = np.array([], dtype=np.float64)
-
-    if "minimum" not in stats or stats["minimum"] is None:
-        LOGGER.debug(
-            "column %r does not have pre-computed stats; computing on the fly", column
-        )
-        if values:
+    if minimum is None or maximum is None:
+        if len(np_values) > 0:
             minimum = np_values.min().item()
             maximum = np_values.max().item()
         else:
             minimum = maximum = 0
-    else:
-        minimum = stats["minimum"]
-        maximum = stats["maximum"]
-
-    LOGGER.debug("Computing histogram...")
-    # If show counts, do this:
-    if True:
-        counts, labels = np.histogram(
-            np_values, bins=HISTOGRAM_BINS, range=(minimum, maximum)
-        )
-    else:
-        # if show means do this:
-        # First, compute each bar set:
-        positions = [[] for n in range(HISTOGRAM_BINS)]
-        for value in np_values:
-            position = math.floor(((value - minimum) / maximum) * HISTOGRAM_BINS)
-            positions[position].append(value)
-        counts = np.array(
-            [sum(position) / len(position) if position else 0 for position in positions]
-        )
-        labels = np.arange(minimum, maximum, (maximum - minimum) / HISTOGRAM_BINS)
+
+    counts, labels = np.histogram(
+        np_values, bins=HISTOGRAM_BINS, range=(minimum, maximum)
+    )
 
     # Compute stats for this set:
-    if values:
+    if len(np_values) > 0:
         try:
             quantiles = np.nanquantile(np_values, q=[0.25, 0.50, 0.75], axis=0)
             std = np.nanstd(np_values, axis=0, ddof=1).item()
@@ -873,16 +1530,38 @@ def histogram(cur, metadata, values, column):
         except Exception:
             LOGGER.debug("failed in computing statistics")
 
-    LOGGER.debug("Done!")
     return {
-        "type": "histogram",
         "bins": counts.tolist(),
         "labels": labels.tolist(),
         "min": minimum,
         "max": maximum,
+        "statistics": statistics,
+    }
+
+
+def histogram(cur, metadata, summary, column):
+    """
+    Build the histogram results from the HISTOGRAM()
+    aggregate's summary of the values (or None, if there
+    were none).
+    """
+    stats = metadata[column]
+    column_type = stats["type"]
+    name = stats.get("name", column)
+
+    if summary is None:
+        minimum, maximum = get_histogram_range(metadata, column)
+        summary = histogram_summary(np.array([], dtype=np.float64), minimum, maximum)
+
+    return {
+        "type": "histogram",
+        "bins": summary["bins"],
+        "labels": summary["labels"],
+        "min": summary["min"],
+        "max": summary["max"],
         "columnType": column_type,
         "column": name,
-        "statistics": statistics,
+        "statistics": summary["statistics"],
     }
 
 
@@ -1016,42 +1695,290 @@ def select_group_by_rows(
         LOGGER.error("SQL: %s", exc)
         raise Exception(str(exc))
 
-    return rows
-
-
-def get_group_by_rows(
-    cur,
-    group_by_field_name,
-    group_by_field_expr,
-    field_name,
-    field_expr,
-    column_value,
-    where,
-    databases,
-    select_expr_as,
-    distinct=False,
-):
-    env = {
-        "group_by_field_name": group_by_field_name,
-        "group_by_field_expr": group_by_field_expr,
-        "field_name": field_name,
-        "field_expr": field_expr,
-        "column_value": column_value,
-        "where": where,
-        "databases": ", ".join(databases),
-        "select_expr_as": ", ".join(select_expr_as),
-        "distinct": "DISTINCT " if distinct else "",
-    }
-
-    select_sql = "SELECT value FROM (SELECT {select_expr_as}, {group_by_field_expr} AS {group_by_field_name}, GROUP_CONCAT({distinct}REPLACE(IFNULL({field_expr},'None'), ',', '&comma;')) as value FROM {databases} WHERE {where} GROUP BY {group_by_field_name}) WHERE {group_by_field_name} is {column_value}"
-    selection_sql = select_sql.format(**env)
+    return rows
+
+
+def get_group_by_rows(
+    cur,
+    group_by_field_name,
+    group_by_field_expr,
+    field_name,
+    field_expr,
+    column_value,
+    where,
+    databases,
+    select_expr_as,
+    distinct=False,
+):
+    env = {
+        "group_by_field_name": group_by_field_name,
+        "group_by_field_expr": group_by_field_expr,
+        "field_name": field_name,
+        "field_expr": field_expr,
+        "column_value": column_value,
+        "where": where,
+        "databases": ", ".join(databases),
+        "select_expr_as": ", ".join(select_expr_as),
+        "distinct": "DISTINCT " if distinct else "",
+    }
+
+    select_sql = "SELECT value FROM (SELECT {select_expr_as}, {group_by_field_expr} AS {group_by_field_name}, GROUP_CONCAT({distinct}REPLACE(IFNULL({field_expr},'None'), ',', '&comma;')) as value FROM {databases} WHERE {where} GROUP BY {group_by_field_name}) WHERE {group_by_field_name} is {column_value}"
+    selection_sql = select_sql.format(**env)
+
+    LOGGER.debug("SQL %s", selection_sql)
+    start_time = time.time()
+    cur.execute(selection_sql)
+    LOGGER.debug("SQL %s seconds", time.time() - start_time)
+    rows = cur.fetchall()
+    return rows
+
+
+def get_group_aggregates(
+    cur,
+    group_by_field_name,
+    aggregates,
+    group_filter,
+    where,
+    databases,
+    select_expr_as,
+    parameters=None,
+):
+    """
+    Compute the given aggregate expressions (over field names)
+    for each group matching group_filter. Returns a dict mapping
+    each group value to a tuple of its aggregate values.
+    """
+    env = {
+        "group_by_field_name": group_by_field_name,
+        "aggregates": ", ".join(aggregates),
+        "group_filter": group_filter,
+        "where": where,
+        "databases": ", ".join(databases),
+        "select_expr_as": ", ".join(select_expr_as),
+    }
+    select_sql = "SELECT {group_by_field_name}, {aggregates} FROM (SELECT {select_expr_as} FROM {databases} WHERE {where}) WHERE {group_filter} GROUP BY {group_by_field_name};"
+    selection_sql = select_sql.format(**env)
+
+    LOGGER.debug("SQL %s", selection_sql)
+    start_time = time.time()
+    cur.execute(selection_sql, parameters or [])
+    LOGGER.debug("SQL %s seconds", time.time() - start_time)
+    return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
+
+def get_category_counts(
+    cur,
+    group_by_field_name,
+    field_name,
+    group_filter,
+    where,
+    databases,
+    select_expr_as,
+):
+    """
+    Count each group's values of a column in SQL.
+
+    Returns a dict mapping each group value to (counts, total,
+    unique), where counts maps the group's least-frequent values
+    (as strings) to their counts, in increasing order, and holds
+    at most MAX_CATEGORIES + 1 of them.
+    """
+    env = {
+        "group_by_field_name": group_by_field_name,
+        "field_name": field_name,
+        "group_filter": group_filter,
+        "where": where,
+        "databases": ", ".join(databases),
+        "select_expr_as": ", ".join(select_expr_as),
+        "limit": MAX_CATEGORIES + 1,
+    }
+    select_sql = "SELECT group_value, value, count, total, unique_count FROM (SELECT {group_by_field_name} AS group_value, CAST(IFNULL({field_name}, 'None') AS TEXT) AS value, COUNT(*) AS count, SUM(COUNT(*)) OVER (PARTITION BY {group_by_field_name}) AS total, COUNT(*) OVER (PARTITION BY {group_by_field_name}) AS unique_count, ROW_NUMBER() OVER (PARTITION BY {group_by_field_name} ORDER BY COUNT(*), CAST(IFNULL({field_name}, 'None') AS TEXT)) AS position FROM (SELECT {select_expr_as} FROM {databases} WHERE {where}) WHERE {group_filter} GROUP BY group_value, value) WHERE position <= {limit} ORDER BY position;"
+    selection_sql = select_sql.format(**env)
+
+    LOGGER.debug("SQL %s", selection_sql)
+    start_time = time.time()
+    cur.execute(selection_sql)
+    LOGGER.debug("SQL %s seconds", time.time() - start_time)
+    results = {}
+    for group_value, value, count, total, unique_count in cur.fetchall():
+        if group_value not in results:
+            results[group_value] = ({}, total, unique_count)
+        results[group_value][0][value] = count
+    return results
+
+
+def select_group_summaries(
+    dgid,
+    group_by,
+    group_values,
+    column_names,
+    where_expr=None,
+    computed_columns=None,
+    where_description=None,
+    column_offset=0,
+    column_limit=None,
+    distinct=True,
+):
+    """
+    Summarize many (group, column) cells of a grouped page at
+    once, restricted to the page's groups, rather than with one
+    full-table aggregation per cell.
+
+    Args:
+        dgid: the datagrid id
+        group_by: (str) the name of the column being grouped on
+        group_values: (list) the values of the groups to summarize
+        column_names: (list of str) the columns to summarize
+        where_expr: (optional, str) a Python-like filter
+        computed_columns: (optional, dict) computed columns
+        where_description: (optional, str) included in the results
+        column_offset: (int) offset into each group's assets
+        column_limit: (optional, int) number of each group's assets
+        distinct: (bool) if True, only return distinct assets
+
+    Returns a dict mapping (group value, column name) to the
+    same results as select_histogram() (FLOAT columns),
+    select_category() (INTEGER and TEXT columns), and
+    select_asset_group() (asset columns). Columns of other
+    types are not included.
+    """
+    conn = get_database_connection(dgid)
+    cur = conn.cursor()
+
+    unify_computed_columns(computed_columns)
+    metadata = get_dg_metadata(dgid)
+    columns = list(metadata.keys())
+    select_expr_as = [get_field_name(column, metadata) for column in columns]
+    databases = ["datagrid"]
+    where = None
+
+    if computed_columns or where_expr:
+        where_sql = update_state(
+            computed_columns,
+            metadata,
+            databases,
+            columns,
+            select_expr_as,
+            where_expr,
+        )
+        if where_sql:
+            where = where_sql
+
+    where = where if where else "1"
+
+    group_by_field_name = get_field_name(group_by, metadata)
+
+    # Histograms and asset groups are aggregated in one
+    # pass; categories are counted per column:
+    # (column_name, kind, position of first aggregate):
+    summaries = []
+    aggregates = []
+    parameters = []
+    for column_name in column_names:
+        column_type = get_column_type(column_name, metadata)
+        field_name = get_field_name(column_name, metadata)
+        if column_type == "FLOAT":
+            summaries.append((column_name, "histogram", len(aggregates)))
+            aggregates.append("HISTOGRAM(%s, ?, ?)" % field_name)
+            parameters.extend(get_histogram_range(metadata, column_name))
+        elif column_type in ["INTEGER", "TEXT"]:
+            summaries.append((column_name, "category", None))
+        elif column_type.endswith("-ASSET"):
+            summaries.append((column_name, "asset-group", len(aggregates)))
+            aggregates.append(
+                "GROUP_CONCAT(%sREPLACE(IFNULL(%s,'None'), ',', '&comma;'))"
+                % ("DISTINCT " if distinct else "", field_name)
+            )
+            aggregates.append("COUNT(%s)" % field_name)
+
+    if not summaries or not group_values:
+        return {}
+
+    group_sql_values = [
+        get_column_value(value, group_by, metadata)
+        for value in group_values
+        if value is not None
+    ]
+    group_filters = []
+    if group_sql_values:
+        group_filters.append(
+            "%s IN (%s)"
+            % (group_by_field_name, ", ".join(str(v) for v in group_sql_values))
+        )
+    if None in group_values:
+        group_filters.append("%s IS NULL" % group_by_field_name)
+    group_filter = "(%s)" % " OR ".join(group_filters)
+
+    groups = {}
+    category_counts = {}
+    try:
+        if aggregates:
+            groups = get_group_aggregates(
+                cur,
+                group_by_field_name,
+                aggregates,
+                group_filter,
+                where,
+                databases,
+                select_expr_as,
+                parameters,
+            )
+        for column_name, kind, position in summaries:
+            if kind == "category":
+                category_counts[column_name] = get_category_counts(
+                    cur,
+                    group_by_field_name,
+                    get_field_name(column_name, metadata),
+                    group_filter,
+                    where,
+                    databases,
+                    select_expr_as,
+                )
+    except sqlite3.OperationalError as exc:
+        LOGGER.error("SQL: %s", exc)
+        raise Exception(str(exc))
+
+    distinct_values = {}
+    results = {}
+    for group_value in group_values:
+        row = groups.get(group_value)
+        column_value = get_column_value(group_value, group_by, metadata)
+        for column_name, kind, position in summaries:
+            if kind == "histogram":
+                results_json = histogram_results(
+                    cur,
+                    metadata,
+                    row[position] if row is not None else None,
+                    column_name,
+                    group_by,
+                    column_value,
+                    where_description,
+                    computed_columns,
+                )
+            elif kind == "category":
+                results_json = category_results(
+                    cur,
+                    metadata,
+                    category_counts[column_name].get(group_value),
+                    column_name,
+                    group_by,
+                    column_value,
+                    where_description,
+                    computed_columns,
+                    distinct_values,
+                )
+            else:
+                asset_type = get_column_type(column_name, metadata).split("-", 1)[0]
+                results_json = asset_group_results(
+                    row[position] if row is not None else None,
+                    row[position + 1] if row is not None else 0,
+                    asset_type.lower(),
+                    column_offset,
+                    column_limit,
+                )
+            results[(group_value, column_name)] = results_json
 
-    LOGGER.debug("SQL %s", selection_sql)
-    start_time = time.time()
-    cur.execute(selection_sql)
-    LOGGER.debug("SQL %s seconds", time.time() - start_time)
-    rows = cur.fetchall()
-    return rows
+    return results
 
 
 def select_histogram(
@@ -1068,7 +1995,7 @@ def select_histogram(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1088,39 +2015,56 @@ def select_histogram(
     where = where if where else "1"
 
     field_name = get_field_name(column_name, metadata)
-    field_expr = metadata[column_name]["field_expr"]
     group_by_field_name = get_field_name(group_by, metadata)
-    group_by_field_expr = get_field_expr(group_by, metadata)
+    minimum, maximum = get_histogram_range(metadata, column_name)
 
     column_value = get_column_value(column_value, group_by, metadata)
 
     try:
-        rows = get_group_by_rows(
+        groups = get_group_aggregates(
             cur,
             group_by_field_name,
-            group_by_field_expr,
-            field_name,
-            field_expr,
-            column_value,
+            ["HISTOGRAM(%s, ?, ?)" % field_name],
+            "%s IS %s" % (group_by_field_name, column_value),
             where,
             databases,
             select_expr_as,
+            [minimum, maximum],
         )
     except sqlite3.OperationalError as exc:
         LOGGER.error("SQL: %s", exc)
         raise Exception(str(exc))
 
-    # These should be numbers:
-    values = []
-    if rows:
-        row = rows[0]
-        if row:
-            if row[0]:
-                values = parse_comma_separated_values(row[0])
-            if not isinstance(values, (list, tuple)):
-                values = [values]
+    raw_value = list(groups.values())[0][0] if groups else None
+    return histogram_results(
+        cur,
+        metadata,
+        raw_value,
+        column_name,
+        group_by,
+        column_value,
+        where_description,
+        computed_columns,
+    )
+
+
+def histogram_results(
+    cur,
+    metadata,
+    raw_value,
+    column_name,
+    group_by,
+    column_value,
+    where_description,
+    computed_columns,
+):
+    """
+    Build the histogram results for one group, given the
+    group's HISTOGRAM() aggregate.
+    """
+    summary = json.loads(raw_value) if raw_value else None
 
-    results_json = histogram(cur, metadata, values, column_name)
+    results_json = histogram(cur, metadata, summary, column_name)
 
     results_json["groupBy"] = group_by
     results_json["groupByValue"] = column_value
@@ -1131,11 +2075,9 @@ def select_histogram(
 
 
 def select_metadata(dgid):
-    conn = get_database_connection(dgid)
-
-    metadata = get_metadata(conn)
+    metadata = get_cached_metadata(dgid)
 
-    return metadata
+    return {name: dict(value) for name, value in metadata.items()}
 
 
 def select_description(
@@ -1152,7 +2094,7 @@ def select_description(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1227,7 +2169,7 @@ def select_category(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1246,22 +2188,17 @@ def select_category(
 
     where = where if where else "1"
 
-    column_type = metadata[column_name]["type"]
     field_name = get_field_name(column_name, metadata)
-    field_expr = get_field_expr(column_name, metadata)
     group_by_field_name = get_field_name(group_by, metadata)
-    group_by_field_expr = get_field_expr(group_by, metadata)
 
     column_value = get_column_value(column_value, group_by, metadata)
 
     try:
-        rows = get_group_by_rows(
+        groups = get_category_counts(
             cur,
             group_by_field_name,
-            group_by_field_expr,
             field_name,
-            field_expr,
-            column_value,
+            "%s IS %s" % (group_by_field_name, column_value),
             where,
             databases,
             select_expr_as,
@@ -1270,79 +2207,94 @@ def select_category(
         LOGGER.error("SQL: %s", exc)
         raise Exception(str(exc))
 
+    value_counts = list(groups.values())[0] if groups else None
+    return category_results(
+        cur,
+        metadata,
+        value_counts,
+        column_name,
+        group_by,
+        column_value,
+        where_description,
+        computed_columns,
+    )
+
+
+def category_results(
+    cur,
+    metadata,
+    value_counts,
+    column_name,
+    group_by,
+    column_value,
+    where_description,
+    computed_columns,
+    distinct_values=None,
+):
+    """
+    Build the category results for one group, given the
+    group's (counts, total, unique) from get_category_counts().
+    """
+    column_type = metadata[column_name]["type"]
+    if value_counts is None:
+        # No such group:
+        return {"type": "verbatim", "value": "", "columnType": column_type}
+
     # These are categories (ints or strings):
-    results_json = {"type": "verbatim", "value": "", "columnType": column_type}
-    if rows:
-        row = rows[0]
-        if row:
-            raw_value = row[0]
-            if raw_value:
-                values = [v.replace("&comma;", ",") for v in raw_value.split(",")]
-            else:
-                values = []
-
-            counts = Counter(values)
-            length = len(values)
-            unique_values = list(counts.keys())
-            ulength = len(unique_values)
-
-            if length == 0:
-                results_json = {
-                    "type": "verbatim",
-                    "value": plural(length, "value"),
-                    "columnType": column_type,
-                }
-            elif length == 1:
-                results_json = {
-                    "type": "verbatim",
-                    "value": values[0],
-                    "columnType": column_type,
-                }
-            elif ulength == 1:
-                results_json = {
-                    "type": "verbatim",
-                    "value": "%s (%s of them)" % (values[0], length),
-                    "columnType": column_type,
-                }
-            elif ulength > MAX_CATEGORIES:
-                if length == ulength:
-                    results_json = {
-                        "type": "verbatim",
-                        "value": plural(length, "unique value"),
-                        "columnType": column_type,
-                    }
-                else:
-                    results_json = {
-                        "type": "verbatim",
-                        "value": (
-                            plural(length, "value")
-                            + ", "
-                            + ("%s %s" % (ulength, "unique"))
-                        ),
-                        "columnType": column_type,
-                    }
-            else:
-                counts = {
-                    key: value
-                    for (key, value) in sorted(counts.items(), key=lambda item: item[1])
-                }
-                counts = category(cur, metadata, counts, column_name)
-                # values: {"Animal": 37, "Plant": 12}
-                results_json = {
-                    "type": "category",
-                    "values": counts,
-                    "column": column_name,
-                    "columnType": column_type,
-                    "groupBy": group_by,
-                    "groupByValue": column_value,
-                    "whereDescription": where_description,
-                    "computedColumns": computed_columns,
-                }
+    counts, length, ulength = value_counts
+    values = list(counts.keys())
+
+    if length == 0:
+        results_json = {
+            "type": "verbatim",
+            "value": plural(length, "value"),
+            "columnType": column_type,
+        }
+    elif length == 1:
+        results_json = {
+            "type": "verbatim",
+            "value": values[0],
+            "columnType": column_type,
+        }
+    elif ulength == 1:
+        results_json = {
+            "type": "verbatim",
+            "value": "%s (%s of them)" % (values[0], length),
+            "columnType": column_type,
+        }
+    elif ulength > MAX_CATEGORIES:
+        if length == ulength:
+            results_json = {
+                "type": "verbatim",
+                "value": plural(length, "unique value"),
+                "columnType": column_type,
+            }
+        else:
+            results_json = {
+                "type": "verbatim",
+                "value": (
+                    plural(length, "value") + ", " + ("%s %s" % (ulength, "unique"))
+                ),
+                "columnType": column_type,
+            }
+    else:
+        counts = category(cur, metadata, dict(counts), column_name, distinct_values)
+        # values: {"Animal": 37, "Plant": 12}
+        results_json = {
+            "type": "category",
+            "values": counts,
+            "column": column_name,
+            "columnType": column_type,
+            "groupBy": group_by,
+            "groupByValue": column_value,
+            "whereDescription": where_description,
+            "computedColumns": computed_columns,
+        }
 
     return results_json
 
 
-@st.cache_data(persist="disk")
+@cache_data(persist="disk")
 def select_asset_group_thumbnail(
     _experiment,
     experiment_id,
@@ -1364,8 +2316,6 @@ def select_asset_group_thumbnail(
 
     gallery_cols, gallery_rows = gallery_size
     column_limit = gallery_cols * gallery_rows
-    background_color = tuple(background_color)
-    image_size = tuple(image_size)
 
     results_json = select_asset_group(
         _experiment,
@@ -1381,23 +2331,53 @@ def select_asset_group_thumbnail(
         where_expr,
         distinct,
     )
+    return build_asset_group_gallery(
+        _experiment,
+        experiment_id,
+        dgid,
+        results_json["values"],
+        gallery_size,
+        background_color,
+        image_size,
+        border_width,
+    )
+
+
+def build_asset_group_gallery(
+    _experiment,
+    experiment_id,
+    dgid,
+    asset_values,
+    gallery_size,
+    background_color,
+    image_size,
+    border_width,
+):
+    """
+    Render a gallery of thumbnails for the given asset values,
+    and return it as PNG bytes.
+    """
+    gallery_cols, gallery_rows = gallery_size
+    background_color = tuple(background_color)
+    image_size = tuple(image_size)
 
     gallery_pixel_size = (
         (image_size[0] + border_width) * gallery_cols + border_width,
         (image_size[1] + border_width) * gallery_rows + border_width,
     )
     images = []
-    for asset_id in results_json["values"]:
+    for asset_id in asset_values[: gallery_cols * gallery_rows]:
         if asset_id != "None":
-            image = select_asset(
+            # The PNG bytes, rather than the image, can be cached on disk:
+            thumbnail = select_asset(
                 _experiment,
                 experiment_id,
                 dgid,
                 asset_id,
                 thumbnail=True,
-                return_image=True,
             )
-            if image:
+            if thumbnail:
+                image = PIL.Image.open(io.BytesIO(thumbnail))
                 background = PIL.Image.new(
                     mode="RGBA", size=image_size, color=background_color
                 )
@@ -1425,7 +2405,7 @@ def select_asset_group_thumbnail(
     return fp.read()
 
 
-@st.cache_data(persist="disk")
+@cache_data(persist="disk")
 def select_asset_group(
     _experiment,
     experiment_id,
@@ -1444,7 +2424,7 @@ def select_asset_group(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1491,7 +2471,7 @@ def select_asset_group(
     env = {
         "group_by_field_name": group_by_field_name,
         "field_name": field_name,
-        "column_value": get_column_value(column_value, group_by, metadata),
+        "column_value": column_value,
         "where": where,
         "databases": ", ".join(databases),
         "select_expr_as": ", ".join(select_expr_as),
@@ -1515,30 +2495,35 @@ def select_asset_group(
         if total_row:
             total = total_row[0]
 
-    results_json = {
+    raw_value = rows[0][0] if rows and rows[0] else None
+    return asset_group_results(
+        raw_value,
+        total,
+        get_type_column_name(column_name, columns, column_types),
+        column_offset,
+        column_limit,
+    )
+
+
+def asset_group_results(raw_value, total, asset_type, column_offset, column_limit):
+    """
+    Build the asset-group results for one group, given the
+    group's GROUP_CONCAT-ed asset values.
+    """
+    values = raw_value.split(",") if raw_value else []
+    return {
         "type": "asset-group",
-        "assetType": get_type_column_name(column_name, columns, column_types),
-        "values": [],
+        "assetType": asset_type,
+        "values": (
+            values[column_offset : column_offset + column_limit]
+            if column_limit is not None
+            else values
+        ),
         "total": total,
     }
-    if rows:
-        row = rows[0]
-        if row and row[0]:
-            values = row[0].split(",")
-            results_json = {
-                "type": "asset-group",
-                "assetType": get_type_column_name(column_name, columns, column_types),
-                "values": (
-                    values[column_offset : column_offset + column_limit]
-                    if column_limit is not None
-                    else values
-                ),
-                "total": total,
-            }
-    return results_json
 
 
-@st.cache_data(persist="disk")
+@cache_data(persist="disk")
 def select_asset_group_metadata(
     _experiment,
     experiment_id,
@@ -1557,7 +2542,7 @@ def select_asset_group_metadata(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1704,7 +2689,7 @@ def verify_where(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1815,7 +2800,7 @@ def select_query_count(
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1835,6 +2820,18 @@ def select_query_count(
 
     where = where if where else "1"
 
+    db_path = get_dg_path(dgid)
+    key = (
+        db_path,
+        get_dg_signature(db_path),
+        group_by,
+        where_expr,
+        json.dumps(computed_columns, sort_keys=True, default=str),
+    )
+    total_rows = QUERY_COUNT_CACHE.get(key, None)
+    if total_rows is not None:
+        return total_rows
+
     env = {
         "where": where,
         "select_expr_as": ", ".join(select_expr_as),
@@ -1851,6 +2848,7 @@ def select_query_count(
     start_time = time.time()
     total_rows = cur.execute(selection_sql).fetchone()[0]
     LOGGER.debug("SQL %s seconds", time.time() - start_time)
+    QUERY_COUNT_CACHE.put(key, total_rows)
     return total_rows
 
 
@@ -1865,6 +2863,7 @@ def select_query(
     select_columns,
     computed_columns,
     where_expr=None,
+    cursor=None,
 ):
     result = select_query_page(
         dgid,
@@ -1877,6 +2876,7 @@ def select_query(
         select_columns,
         computed_columns,
         where_expr,
+        cursor=cursor,
     )
     result["total"] = select_query_count(
         dgid,
@@ -1887,6 +2887,72 @@ def select_query(
     return result
 
 
+def encode_cursor(sort_by, sort_desc, group_by, sort_value, tiebreak_value):
+    """
+    Encode the position after a row as an opaque cursor.
+    """
+    key = [sort_by, sort_desc, group_by, sort_value, tiebreak_value]
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor, sort_by, sort_desc, group_by):
+    """
+    Decode a cursor from encode_cursor(), checking that it
+    came from a query with the same ordering. Returns
+    (sort_value, tiebreak_value).
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+        (
+            cursor_sort_by,
+            cursor_sort_desc,
+            cursor_group_by,
+            sort_value,
+            tiebreak_value,
+        ) = key
+    except Exception:
+        raise Exception("invalid cursor: %r" % cursor)
+
+    if [cursor_sort_by, cursor_sort_desc, cursor_group_by] != [
+        sort_by,
+        sort_desc,
+        group_by,
+    ]:
+        raise Exception("cursor is from a query with a different ordering")
+
+    return sort_value, tiebreak_value
+
+
+def get_seek_where(field_names, values, sort_desc):
+    """
+    Build the SQL (and parameters) that selects the rows
+    ordered after the given values of field_names, in
+    SQLite's order, where NULL sorts first in ASC and last
+    in DESC.
+    """
+
+    def after(field_name, value):
+        if sort_desc == "DESC":
+            if value is None:
+                return "0", []
+            return "(%s < ? OR %s IS NULL)" % (field_name, field_name), [value]
+        else:
+            if value is None:
+                return "%s IS NOT NULL" % field_name, []
+            return "%s > ?" % field_name, [value]
+
+    field_name, value = field_names[0], values[0]
+    after_sql, parameters = after(field_name, value)
+    if len(field_names) == 1:
+        return after_sql, parameters
+
+    rest_sql, rest_parameters = get_seek_where(field_names[1:], values[1:], sort_desc)
+    return (
+        "(%s OR (%s IS ? AND %s))" % (after_sql, field_name, rest_sql),
+        parameters + [value] + rest_parameters,
+    )
+
+
 def select_query_page(
     dgid,
     offset,
@@ -1900,13 +2966,20 @@ def select_query_page(
     where_expr=None,
     debug=False,
     timestamp=None,
+    cursor=None,
 ):
+    """
+    Select a page of rows. Page with offset, or with the
+    opaque "cursor" returned with the previous page, which
+    seeks directly to the next page rather than skipping
+    over all of the previous rows.
+    """
     sort_desc = "DESC" if sort_desc else "ASC"
     conn = get_database_connection(dgid)
     cur = conn.cursor()
 
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     columns = list(metadata.keys())
     select_expr_as = [get_field_name(column, metadata) for column in columns]
     databases = ["datagrid"]
@@ -1927,7 +3000,11 @@ def select_query_page(
             where = where_sql
 
     where = where if where else "1"
-    limit = ("LIMIT %s OFFSET %s" % (limit, offset)) if limit is not None else ""
+    page_size = limit
+    if cursor is not None:
+        limit = ("LIMIT %s" % limit) if limit is not None else ""
+    else:
+        limit = ("LIMIT %s OFFSET %s" % (limit, offset)) if limit is not None else ""
 
     # Metadata now has computed_columns:
     if select_columns is None:
@@ -1940,41 +3017,59 @@ def select_query_page(
     select_fields = [get_field_name(column, metadata) for column in select_columns]
     sort_by_field_name = get_field_name(sort_by, metadata) if sort_by else "column_0"
     remove_columns = []
+    auto_index(dgid, sort_by_field_name)
 
     if group_by:
+        auto_index(dgid, get_field_name(group_by, metadata))
         if group_by not in select_columns:
             select_columns.append(group_by)
             select_fields.append(get_field_name(group_by, metadata))
             remove_columns.append(group_by)
 
         group_by_field_name = get_field_name(group_by, metadata)
+        # Groups are unique, so break ties in sort order with them:
+        tiebreak_field_name = group_by_field_name
         env = {
             "limit": limit,
             "group_by_field_name": group_by_field_name,
             "sort_by_field_name": sort_by_field_name,
+            "tiebreak_field_name": tiebreak_field_name,
             "where": where,
             "sort_desc": sort_desc,
             "select_expr_as": ", ".join(select_expr_as),
             "select_fields": ", ".join(select_fields),
             "databases": ", ".join(databases),
         }
-        select_sql = "SELECT {select_expr_as} FROM {databases} WHERE {where} GROUP BY {group_by_field_name} ORDER BY {sort_by_field_name} {sort_desc} {limit}"
+        select_sql = "SELECT {select_expr_as} FROM {databases} WHERE {where} GROUP BY {group_by_field_name}"
     else:
+        # Break ties in sort order with the row-id:
+        tiebreak_field_name = "column_0"
         env = {
             "limit": limit,
             "sort_by_field_name": sort_by_field_name,
+            "tiebreak_field_name": tiebreak_field_name,
             "where": where,
             "sort_desc": sort_desc,
             "select_expr_as": ", ".join(select_expr_as),
             "select_fields": ", ".join(select_fields),
             "databases": ", ".join(databases),
         }
-        select_sql = "SELECT {select_expr_as} FROM {databases} WHERE {where} ORDER BY {sort_by_field_name} {sort_desc} {limit}"
+        select_sql = "SELECT {select_expr_as} FROM {databases} WHERE {where}"
+
+    parameters = []
+    env["seek"] = "1"
+    if cursor is not None:
+        env["seek"], parameters = get_seek_where(
+            [sort_by_field_name, tiebreak_field_name],
+            decode_cursor(cursor, sort_by, sort_desc, group_by),
+            sort_desc,
+        )
 
-    if len(select_columns) != len(columns):
-        select_sql = "SELECT {select_fields} FROM (%s);" % select_sql
-    else:
-        select_sql = "%s;" % select_sql
+    # The sort and tiebreak values are selected last, for the cursor:
+    select_sql = (
+        "SELECT {select_fields}, {sort_by_field_name}, {tiebreak_field_name} FROM (%s) WHERE {seek} ORDER BY {sort_by_field_name} {sort_desc}, {tiebreak_field_name} {sort_desc} {limit};"
+        % select_sql
+    )
     selection_sql = select_sql.format(**env)
 
     if debug:
@@ -1982,7 +3077,7 @@ def select_query_page(
     LOGGER.debug("SQL %s", selection_sql)
     start_time = time.time()
     try:
-        cur.execute(selection_sql)
+        cur.execute(selection_sql, parameters)
     except sqlite3.OperationalError as exc:
         LOGGER.error("SQL: %s; %s", selection_sql, exc)
         raise Exception(str(exc))
@@ -1990,6 +3085,13 @@ def select_query_page(
     LOGGER.debug("SQL %s seconds", time.time() - start_time)
     rows = cur.fetchall()
 
+    next_cursor = None
+    if rows and page_size is not None and len(rows) == page_size:
+        next_cursor = encode_cursor(
+            sort_by, sort_desc, group_by, rows[-1][-2], rows[-1][-1]
+        )
+    rows = [row[:-2] for row in rows]
+
     if group_by:
         group_by_field_name = get_field_name(group_by, metadata)
         # Add cell messages for groups and assets:
@@ -2085,6 +3187,7 @@ def select_query_page(
         "nrows": len(rows),
         "ncols": len(select_columns),
         "rows": rows,
+        "cursor": next_cursor,
     }
 
 
@@ -2199,8 +3302,7 @@ def get_fields(dgid, metadata=None, computed_columns=None):
     """
     # NOTE: metadata does not contain computed_columns yet
     if metadata is None:
-        conn = get_database_connection(dgid)
-        metadata = get_metadata(conn)
+        metadata = get_dg_metadata(dgid)
 
     # Used to evaluate computed columns
     unify_computed_columns(computed_columns)
@@ -2334,6 +3436,46 @@ def get_fields(dgid, metadata=None, computed_columns=None):
     return fields
 
 
+def select_projection_rows(cur, asset_ids):
+    """
+    Get the projection and display fields of embedding assets,
+    without decoding their asset_data, as rows of (x, y, color,
+    name, text, row_id).
+    """
+    # asset_ids is a list of str
+    # Turn to string:
+    values = "(" + (",".join(["'%s'" % asset_id for asset_id in asset_ids])) + ")"
+    if values == "()":
+        return []
+
+    if has_table(cur.connection, "projections"):
+        xy = "projections.x, projections.y"
+        join = "LEFT JOIN projections ON projections.asset_id = assets.asset_id"
+    else:
+        xy = "NULL, NULL"
+        join = ""
+
+    sql = """SELECT {xy}, json_extract(asset_data, '$.projection_transform'),
+                    json_extract(asset_data, '$.color'),
+                    CASE WHEN json_type(asset_data, '$.name') IS NULL THEN 'Grouped'
+                         ELSE json_extract(asset_data, '$.name') END,
+                    json_extract(asset_data, '$.text'),
+                    json_extract(asset_data, '$.row_id')
+             FROM assets {join} WHERE assets.asset_id IN {values}""".format(
+        xy=xy,
+        join=join,
+        values=values,
+    )
+
+    rows = []
+    for x, y, transform, color, name, text, row_id in cur.execute(sql):
+        if x is None and transform is not None:
+            # Older datagrids keep the projection in asset_data:
+            x, y = json.loads(transform)[:2]
+        rows.append((x, y, color, name, text, row_id))
+    return rows
+
+
 def process_projection_asset_ids(
     name,
     cur,
@@ -2345,37 +3487,22 @@ def process_projection_asset_ids(
 ):
     # asset_ids is a list of str
     # side-effect: adds to traces
-    # Turn to string:
-    values = "(" + (",".join(["'%s'" % asset_id for asset_id in asset_ids])) + ")"
-    if values == "()":
-        return
-
-    sql = """SELECT asset_data FROM assets WHERE asset_id IN {values}""".format(
-        values=values,
-    )
-
     trace_data = {}
 
-    for asset_data_row in cur.execute(sql):
-        asset_data_raw = asset_data_row[0]
-        asset_data = json.loads(asset_data_raw)
-        transform = asset_data["projection_transform"]
+    for x, y, asset_color, asset_name, text, row_id in select_projection_rows(
+        cur, asset_ids
+    ):
         if color_override:
             color = color_override
-        elif asset_data["color"]:
-            color = asset_data["color"]
+        elif asset_color:
+            color = asset_color
         else:
             color = default_color
 
         if name:
             trace_name = name
         else:
-            trace_name = asset_data.get("name", "Grouped")
-
-        if "row_id" in asset_data:
-            row_id = asset_data["row_id"]
-        else:
-            row_id = None
+            trace_name = asset_name
 
         if trace_name not in trace_data:
             trace_data[trace_name] = {
@@ -2385,8 +3512,8 @@ def process_projection_asset_ids(
                 "customdata": [],
             }
 
-        trace_data[trace_name]["texts"].append(asset_data.get("text"))
-        trace_data[trace_name]["transform"].append(transform)
+        trace_data[trace_name]["texts"].append(text)
+        trace_data[trace_name]["transform"].append([x, y])
         trace_data[trace_name]["colors"].append(color)
         trace_data[trace_name]["customdata"].append(row_id)
 
@@ -2438,7 +3565,7 @@ def select_projection_data(
     conn = get_database_connection(dgid)
     cur = conn.cursor()
     unify_computed_columns(computed_columns)
-    metadata = get_metadata(conn)
+    metadata = get_dg_metadata(dgid)
     column_limit = None
     column_offset = 0
 
@@ -2456,7 +3583,8 @@ def select_projection_data(
             group_by,
             where_expr,
         )
-        if not PROJECTION_TRACE_CACHE.contains(key):
+        cached_traces = PROJECTION_TRACE_CACHE.get(key, None)
+        if cached_traces is None:
             rows = select_query_raw(
                 cur,
                 metadata,
@@ -2480,26 +3608,21 @@ def select_projection_data(
                 "lightgray",
             )
             PROJECTION_TRACE_CACHE.put(key, traces)
+            cached_traces = traces
         # Traces contains projection data; make copy:
-        traces = PROJECTION_TRACE_CACHE.get(key)[:]
+        traces = cached_traces[:]
 
         # Next, add the selected asset:
-        asset_data_raw = select_asset(_experiment, experiment_id, dgid, asset_id)
-        asset_data = json.loads(asset_data_raw)
-        transform = asset_data["projection_transform"]
-        if asset_data["color"]:
-            color = asset_data["color"]
-        else:
+        data = json.loads(asset_id.replace("&comma;", ","))
+        x, y, color, name, text, row_id = select_projection_rows(
+            cur, [data["asset_id"]]
+        )[0]
+        if not color:
             color = default_color
-        if "row_id" in asset_data:
-            row_id = asset_data["row_id"]
-        else:
-            row_id = None
-        text = asset_data.get("text", column_name)
 
         trace = {
-            "x": [transform[0]],
-            "y": [transform[1]],
+            "x": [x],
+            "y": [y],
             "text": text,
             "name": text,
             "type": "scatter",
@@ -2518,7 +3641,8 @@ def select_projection_data(
             group_by,
             where_expr,
         )
-        if not PROJECTION_TRACE_CACHE.contains(key):
+        cached_traces = PROJECTION_TRACE_CACHE.get(key, None)
+        if cached_traces is None:
             rows = select_group_by_rows(
                 column_name,
                 column_value,
@@ -2545,12 +3669,13 @@ def select_projection_data(
                         None,
                     )
             PROJECTION_TRACE_CACHE.put(key, traces)
+            cached_traces = traces
         # Traces contains projection data; make copy:
-        traces = PROJECTION_TRACE_CACHE.get(key)[:]
+        traces = cached_traces[:]
     return traces
 
 
-@st.cache_data(persist="disk")
+@cache_data(persist="disk")
 def select_asset(
     _experiment, experiment_id, dgid, asset_id, thumbnail=False, return_image=False
 ):
@@ -2559,23 +3684,23 @@ def select_asset(
     asset_type = "Image"
     asset_annotations = data.get("annotations")
     asset_id = data["asset_id"]
-    asset_data = experiment_get_asset(
-        _experiment, experiment_id, asset_id, return_type="binary"
-    )
 
     if thumbnail and asset_type in ["Image", "PointCloud"]:
-        thumbnail_data, thumbnail_image = generate_thumbnail(
-            asset_data, annotations=asset_annotations, return_image=True
+        return select_thumbnail(
+            _experiment,
+            experiment_id,
+            dgid,
+            asset_id,
+            annotations=asset_annotations,
+            return_image=return_image,
         )
-        if return_image:
-            return thumbnail_image
-        else:
-            return thumbnail_data
     else:
-        return asset_data
+        return experiment_get_asset(
+            _experiment, experiment_id, asset_id, return_type="binary"
+        )
 
 
-@st.cache_data(persist="disk")
+@cache_data(persist="disk")
 def select_asset_metadata(_experiment, experiment_id, dgid, asset_id):
     conn = get_database_connection(dgid)
     cur = conn.cursor()
@@ -2702,9 +3827,7 @@ try:
 except Exception as exc:
     STDERR = format_exc()
 STDOUT = printed
-""".format(
-        code="\n".join(["    %s" % line for line in code.split("\n")])
-    )
+""".format(code="\n".join(["    %s" % line for line in code.split("\n")]))
 
     restricted_globals = dict(__builtins__=utility_builtins)
 
@@ -2746,8 +3869,7 @@ STDOUT = printed
 
 
 def get_about(url, dgid):
-    db_path = get_dg_path(dgid)
-    conn = sqlite3.connect(db_path)
+    conn = get_database_connection(dgid)
 
     try:
         about_text = conn.execute(
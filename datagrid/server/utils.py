@@ -12,12 +12,16 @@
 ######################################################
 
 import base64
+import collections
+import hashlib
 import inspect
 import io
 import pickle
 import re
 import subprocess
 import sys
+import threading
+import time
 import urllib
 
 try:
@@ -275,32 +279,137 @@ def pickle_loads_embedding(ascii_string):
     return pickle_loads(safe, ascii_string)
 
 
+# Default for Cache.get(), meaning raise KeyError:
+MISSING = object()
+
+
 class Cache:
     """
-    LRU Cache.
+    LRU Cache, bounded by number of entries, and optionally by
+    total (estimated) bytes, with an optional time to live in
+    seconds. Safe to use from many threads.
 
     Note: Make sure you copy retrieved items to avoid
     changing it in cache.
     """
 
-    def __init__(self, size):
-        self.cache = {}
-        self.max_size = 100
+    def __init__(self, size, max_bytes=None, ttl=None, sizeof=None):
+        self.cache = collections.OrderedDict()
+        self.max_size = size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof if sizeof is not None else estimate_size
+        self.lock = threading.RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        # Returns the entry (value, size, time), or None; call
+        # with the lock held
+        entry = self.cache.get(key)
+        if entry is not None and self.ttl is not None:
+            if time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+        return entry
+
+    def _remove(self, key):
+        value, size, timestamp = self.cache.pop(key)
+        self.bytes -= size
 
     def contains(self, key):
-        return key in self.cache
+        with self.lock:
+            return self._lookup(key) is not None
 
     def put(self, key, value):
-        # Check size:
-        if len(self.cache) >= self.max_size:
-            # too many
-            first_in_key = list(self.cache.keys())[0]
-            # del the first-in
-            del self.cache[first_in_key]
-        self.cache[key] = value
-
-    def get(self, key):
-        return self.cache[key]
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.cache:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Too big to cache at all
+                return
+            self.cache[key] = (value, size, time.monotonic())
+            self.bytes += size
+            # Evict the least recently used:
+            while len(self.cache) > self.max_size or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self.cache)))
+                self.evictions += 1
+
+    def get(self, key, default=MISSING):
+        """
+        Get the value of key, marking it as recently used. If
+        the key is missing (or expired), return default, or raise
+        KeyError if there is no default.
+        """
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                if default is MISSING:
+                    raise KeyError(key)
+                return default
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return entry[0]
 
     def clear(self):
-        self.cache.clear()
+        with self.lock:
+            self.cache.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Get the cache's counters, and current size.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.cache),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def estimate_size(value):
+    """
+    Estimate the size of a value in bytes, by pickling it.
+    """
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+def stable_repr(value):
+    """
+    Like repr(), but the same for equal dicts and sets,
+    whatever their order.
+    """
+    if isinstance(value, dict):
+        items = sorted(
+            "%s: %s" % (stable_repr(key), stable_repr(item))
+            for key, item in value.items()
+        )
+        return "{%s}" % ", ".join(items)
+    elif isinstance(value, (set, frozenset)):
+        return "{%s}" % ", ".join(sorted(stable_repr(item) for item in value))
+    elif isinstance(value, (list, tuple)):
+        return "%s(%s)" % (
+            type(value).__name__,
+            ", ".join(stable_repr(item) for item in value),
+        )
+    return repr(value)
+
+
+def hash_arguments(*values):
+    """
+    Hash values (including unhashable ones, like dicts) to a
+    string that is the same in every process.
+    """
+    return hashlib.sha256(stable_repr(values).encode("utf-8")).hexdigest()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+######################################################
+#     _____                  _____      _     _      #
+#    (____ \       _        |  ___)    (_)   | |     #
+#     _   \ \ ____| |_  ____| | ___ ___ _  _ | |     #
+#    | |  | )/ _  |  _)/ _  | |(_  / __) |/ || |     #
+#    | |__/ ( ( | | | ( ( | | |__| | | | ( (_| |     #
+#    |_____/ \_||_|___)\_||_|_____/|_| |_|\____|     #
+#                                                    #
+#    Copyright (c) 2023-2024 Kangas Development Team #
+#    All rights reserved                             #
+######################################################
+
+import json
+import sqlite3
+
+import pytest
+
+from datagrid.server.computed_columns import Evaluator
+from datagrid.server.queries import add_python_functions
+
+
+def select_list_comprehension(expr, value):
+    """
+    Evaluate a list comprehension over {"tags"}, a column
+    holding the JSON value.
+    """
+    conn = sqlite3.connect(":memory:")
+    add_python_functions(conn)
+    conn.execute("CREATE TABLE datagrid (tags JSON);")
+    conn.execute("INSERT INTO datagrid VALUES (?);", [json.dumps(value)])
+    sql = Evaluator().eval_expr(expr).replace("{'tags'}", "tags")
+    return conn.execute("SELECT %s FROM datagrid;" % sql).fetchone()[0]
+
+
+@pytest.mark.parametrize(
+    "expr,expected",
+    [
+        ('[x["label"] for x in {"tags"}]', "[]"),
+        ('[x[0] for x in {"tags"}]', "['p','p']"),
+        ('[x for x in {"tags"} if x == "pq"]', "['pq','pq']"),
+        ('[x for x in {"tags"}]', "['pq','pq']"),
+    ],
+)
+def test_list_comprehension_of_strings(expr, expected):
+    assert select_list_comprehension(expr, ["pq", "pq"]) == expected
+
+
+def test_list_comprehension_compares_strings_to_numbers():
+    # As in Python, ordering strings and numbers is an error:
+    with pytest.raises(sqlite3.OperationalError):
+        select_list_comprehension('[x for x in {"tags"} if x > 1]', ["pq", "pq"])
+
+
+def test_list_comprehension_of_objects():
+    value = [{"label": "cat", "score": 0.7}, {"label": "dog", "score": 0.2}]
+    assert (
+        select_list_comprehension(
+            '[x["label"] for x in {"tags"} if x["score"] > 0.5]', value
+        )
+        == "['cat']"
+    )